@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import zlib
 import common
 import gdata
 import logging
@@ -23,8 +24,15 @@ def main():
     setUpLogger()
     printCommandLineOptions()
 
-    # SysInfo data
-    sinfo = common.SysInfo()
+    opt = gdata.getCommandLineOptions()
+
+    # SysInfo data, the cpu usage is measured between updates
+    sinfo = common.SysInfo(opt.time_between_updates)
+    for name, interval in ( (common.sysinfo.COLLECTOR_CPU, opt.cpu_interval),
+                (common.sysinfo.COLLECTOR_MEMORY, opt.memory_interval),
+                (common.sysinfo.COLLECTOR_PROCESSES, opt.processes_interval) ):
+        sinfo.getCollector(name).interval = interval
+        sinfo.getCollector(name).budget = opt.collector_budget
     sinfo.update()
     awakener = threading.Event()
 
@@ -32,24 +40,36 @@ def main():
     mcsock = None
     listen_sock = None
 
-    opt = gdata.getCommandLineOptions()
-
     try:
-        client_id, multicast_group, multicast_port = beginConnection(
-                                                    opt.broker_host, 
-                                                    opt.broker_port,
-                                                    opt.listen_port,
-                                                    sinfo,
-                                                    opt.connection_timeout)
+        client_id, multicast_group, multicast_port, update_format, delta, \
+            compress = beginConnection(opt.broker_host,
+                                        opt.broker_port,
+                                        opt.listen_port,
+                                        sinfo,
+                                        opt.connection_timeout,
+                                        opt.update_format,
+                                        not opt.full_updates,
+                                        not opt.no_zlib)
 
         # Start multicast socket
         mcsock = common.createMulticastSocket(multicast_port)
         common.joinMulticastGroup(mcsock, multicast_group)
 
+        # Deadband, the metrics without a bound are not compared
+        deadband = None
+        if opt.deadband_cpu is not None or opt.deadband_memory is not None:
+            memory = opt.deadband_memory
+            deadband = Deadband(opt.deadband_cpu,
+                                int(memory * 2**20) if memory is not None
+                                    else None,
+                                opt.deadband_full_every)
+
         # Begin auto-updating
         auto_update = AutoUpdater(opt.time_between_updates, opt.broker_host, 
                                 opt.broker_port, client_id, sinfo, awakener, 
-                                opt.connection_timeout, opt.update_max_tries)
+                                opt.connection_timeout, opt.update_max_tries,
+                                not opt.no_session, update_format, delta,
+                                compress, deadband)
         auto_update.daemon = True
         auto_update.start()
 
@@ -74,22 +94,49 @@ def main():
 
 #
 #
-def beginConnection(host, port, lport, sinfo, timeout):
-    hello = '%c %s %c %s %c' \
-            % (gdata.BEL, lport, gdata.ETX, buildXML(sinfo), gdata.ETX)
+def beginConnection(host, port, lport, sinfo, timeout, fmt=gdata.FMT_XML,
+                    delta=False, compress=False):
+    # XML and full updates are understood by every broker, the rest is offered
+    offers = [fmt] if fmt != gdata.FMT_XML else []
+    if delta:
+        offers.append(gdata.OPT_DELTA)
+    if compress:
+        offers.append(gdata.OPT_ZLIB)
+
+    offer = ','.join(offers)
+    xml = buildXML(sinfo)
 
     try:
+        hello = '%c %s %s %c %s %c' \
+                % (gdata.BEL, lport, offer, gdata.ETX, xml, gdata.ETX)
         ret_code, detail, response = sendThroughSocket(
                                 socket.create_connection((host, port), timeout),
                                 hello)
+
+        if ret_code != gdata.K_OK and offer:
+            # Old brokers reject the offer after the port (and may reset the
+            # connection before reading the XML), register again without it
+            logging.info('The broker does not accept the offer: %s' % offer)
+            hello = '%c %s %c %s %c' \
+                    % (gdata.BEL, lport, gdata.ETX, xml, gdata.ETX)
+            ret_code, detail, response = sendThroughSocket(
+                                socket.create_connection((host, port), timeout),
+                                hello)
         
         if ret_code == gdata.K_OK:
-            ret_id, multicast_group, multicast_port  = response.split()
+            fields = response.split()
+            ret_id, multicast_group, multicast_port = fields[:3]
             multicast_port = int(multicast_port)
+            fmt = fields[3] if len(fields) > 3 else gdata.FMT_XML
+            delta = gdata.OPT_DELTA in fields[4:]
+            compress = gdata.OPT_ZLIB in fields[4:]
 
             logging.debug('Received client ID: %s' % ret_id)
             logging.debug('Received multicast group: %s' % multicast_group)
             logging.debug('Received multicast port: %d' % multicast_port)
+            logging.debug('Updates format: %s' % fmt)
+            logging.debug('Processes delta: %s' % delta)
+            logging.debug('Compressed updates: %s' % compress)
 
         else:
             if ret_code:
@@ -101,7 +148,7 @@ def beginConnection(host, port, lport, sinfo, timeout):
         logging.critical("Error connecting to the broker: %s" % str(e))
         sys.exit(-1)
     
-    return ret_id, multicast_group, multicast_port
+    return ret_id, multicast_group, multicast_port, fmt, delta, compress
 
 #
 #
@@ -178,7 +225,7 @@ def _updateFromOther(sock, instruction, params, timeout):
         sock_to_other = socket.create_connection((ip, port), timeout)
         sock_to_other.sendall(instruction + '\n')
 
-        msg = common.recvEnd(sock_to_other, '\n\n') + '\n\n'
+        msg = common.SocketReader(sock_to_other).recvEnd('\n\n') + '\n\n'
         response_head, sep, rest = msg.partition(' ')
 
         if response_head != gdata.K_OK:
@@ -199,7 +246,7 @@ def _updateFromOther(sock, instruction, params, timeout):
 
 #
 #
-def sendThroughSocket(sock, to_send, delim='\n\n', wait_for_response=True):
+def sendThroughSocket(sock, to_send, wait_for_response=True, reader=None):
     code = ''
     detail = ''
     msg = ''
@@ -209,9 +256,20 @@ def sendThroughSocket(sock, to_send, delim='\n\n', wait_for_response=True):
         logging.debug('Message sent to server')
 
         if wait_for_response:
-            first, sep, msg = common.recvEnd(sock, delim).partition('\n')
+            if not reader:
+                reader = common.SocketReader(sock)
+
+            # The errors are a single line, the broker may keep the session
+            # open after them (resync), only the OK messages end with an
+            # empty line
+            first = reader.recvEnd('\n')
             code, sep, detail = first.partition(' ')
-            msg, sep, garbage = msg.partition('\n')
+
+            if code.strip() == gdata.K_OK:
+                line = reader.recvEnd('\n')
+                msg = line
+                while line:
+                    line = reader.recvEnd('\n')
 
             code.strip()
             detail.strip()
@@ -228,21 +286,57 @@ def sendThroughSocket(sock, to_send, delim='\n\n', wait_for_response=True):
 
 #
 #
-def buildXML(sinfo):
+def buildXML(sinfo, delta=False):
     XMLbuilder = common.sysinfoxml.SysInfoXMLBuilder()
 
     dao = sinfo.getSysInfoData()
-    XMLbuilder.setXMLData(dao)
+    XMLbuilder.setXMLData(dao, delta)
 
     return XMLbuilder.getAsString()
 
 #
 #
-def sendXML(sock, sinfo, client_id, wait_for_response=True):
-    xml = buildXML(sinfo)
-    msg = '%c %s %c %s %c' % (gdata.SOH, client_id, gdata.ETX, xml, gdata.ETX)
+def buildBin(sinfo, delta=False):
+    binbuilder = common.SysInfoBinBuilder()
+    binbuilder.setBinData(sinfo.getSysInfoData(), delta)
+
+    return binbuilder.getAsString()
+
+#
+#
+def buildUpdate(sinfo, client_id, fmt=gdata.FMT_XML, delta=False,
+                compress=False):
+    """buildUpdate(sinfo: SysInfo, client_id: str, fmt: str, delta: bool,
+                    compress: bool) -> str
+
+    Builds the update message of the monitor with its data encoded with fmt.
+    Binary and compressed data may contain ETX, so its size goes in the head.
+    If delta only the started and finished processes are sent.
+
+    """
+    if fmt == gdata.FMT_BIN:
+        data = buildBin(sinfo, delta)
+    else:
+        data = buildXML(sinfo, delta)
+
+    if compress:
+        data = zlib.compress(data)
+        fmt = '%s+%s' % (fmt, gdata.OPT_ZLIB)
+    elif fmt == gdata.FMT_XML:
+        return '%c %s %c %s %c' % (gdata.SOH, client_id, gdata.ETX, data,
+                                    gdata.ETX)
 
-    return sendThroughSocket(sock, msg, wait_for_response=wait_for_response)
+    return '%c %s %s %d %c%s%c' % (gdata.SOH, client_id, fmt, len(data),
+                                    gdata.ETX, data, gdata.ETX)
+
+#
+#
+def sendUpdate(sock, sinfo, client_id, fmt=gdata.FMT_XML, delta=False,
+                compress=False, wait_for_response=True, reader=None):
+    msg = buildUpdate(sinfo, client_id, fmt, delta, compress)
+
+    return sendThroughSocket(sock, msg, wait_for_response=wait_for_response,
+                                reader=reader)
 
 #
 #
@@ -264,7 +358,9 @@ def setUpLogger():
 #
 #
 class AutoUpdater(threading.Thread):
-    def __init__(self, tbu, host, port, client_id, sinfo, awakener, timeout, max_tries):
+    def __init__(self, tbu, host, port, client_id, sinfo, awakener, timeout, max_tries,
+                    use_session=True, update_format=gdata.FMT_XML, delta=False,
+                    compress=False, deadband=None):
         threading.Thread.__init__(self)
 
         self.tbu = tbu
@@ -276,6 +372,14 @@ class AutoUpdater(threading.Thread):
         self.timeout = timeout
         self.max_tries = max_tries
         self.tries = 0
+        self.use_session = use_session
+        self.update_format = update_format
+        self.delta = delta
+        self.compress = compress
+        self.resync = False     # The broker asked for a full update
+        self.session = None     # (socket, SocketReader) of the open session
+        self.deadband = deadband    # Deadband, None to send every update
+        self.requested = False  # Woken up to send an update right now
 
     #
     #
@@ -284,12 +388,13 @@ class AutoUpdater(threading.Thread):
 
         while True:
             try:
-                sock = socket.create_connection((self.host, self.port), self.timeout)
-                self.update(sock, self.sinfo, self.client_id)
+                sock, reader = self.connect()
+                self.update(sock, reader, self.sinfo, self.client_id)
 
                 self.tries = 0
 
             except socket.error, e:
+                self.closeSession()
                 self.tries += 1
                 logging.warning(
                         'Error creating socket to the server [attempt %d/%d]'
@@ -303,7 +408,8 @@ class AutoUpdater(threading.Thread):
                         thread.interrupt_main()
                     break
 
-                if self.awakener.wait(self.tbu): # sleep until tbu or someone calls awakener.set()
+                self.requested = self.awakener.wait(self.tbu) # sleep until tbu or someone calls awakener.set()
+                if self.requested:
                     self.awakener.clear() # reset the internal flag                
 
         if self.tries >= self.max_tries:
@@ -311,17 +417,179 @@ class AutoUpdater(threading.Thread):
 
     #
     #
-    def update(self, sock, sinfo, client_id):  
+    def connect(self):
+        """connect() -> socket, SocketReader
+
+        Returns the open session with the broker, or a new connection if it
+        isn't possible to open one (sessions disabled, old broker).
+
+        """
+        if self.session:
+            return self.session
+
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        reader = common.SocketReader(sock)
+
+        if self.use_session:
+            msg = '%c %s %c' % (gdata.SYN, self.client_id, gdata.ETX)
+            code, detail, stuff = sendThroughSocket(sock, msg, reader=reader)
+
+            if code == gdata.K_OK:
+                logging.debug('Session opened with the broker')
+                self.session = (sock, reader)
+                return self.session
+
+            if code == gdata.K_ERR_BAD_MESSAGE:
+                logging.info('The broker does not support sessions, sending ' \
+                             'every update through a new connection')
+                self.use_session = False
+
+            sock.close()
+            sock = socket.create_connection((self.host, self.port),
+                                            self.timeout)
+            reader = common.SocketReader(sock)
+
+        return sock, reader
+
+    #
+    #
+    def sendKeepAlive(self, sock, reader, dao):
+        """sendKeepAlive(sock: socket, reader: SocketReader, 
+                        dao: SysInfoDAO) -> str
+
+        Sends a keep alive (SYN message) in place of the update of dao, whose
+        data is inside the deadband, and returns the code answered.
+
+        """
+        # Not an update, the next one must follow the last one sent
+        dao.setSequence(dao.getSequence() - 1)
+        self.deadband.setSkipped()
+
+        msg = '%c %s %c' % (gdata.SYN, self.client_id, gdata.ETX)
+        code, detail, stuff = sendThroughSocket(sock, msg, reader=reader)
+
+        if code == gdata.K_ERR_BAD_MESSAGE:
+            logging.info('The broker does not support keep alives, sending ' \
+                         'every update')
+            self.deadband = None
+        else:
+            logging.debug('Keep alive sent')
+
+        return code
+
+    #
+    #
+    def closeSession(self):
+        if self.session:
+            self.session[0].close()
+            self.session = None
+
+    #
+    #
+    def update(self, sock, reader, sinfo, client_id):  
+        code = ''
         try:
             sinfo.update()
-            code, stuff, stuff = sendXML(sock, sinfo, client_id)
-            sock.close()
+            dao = sinfo.getSysInfoData()
+
+            # The updates requested by the broker are always sent
+            if self.deadband and not self.requested and not self.resync and \
+                    self.deadband.isInside(dao):
+                code = self.sendKeepAlive(sock, reader, dao)
+            else:
+                code, stuff, stuff = sendUpdate(sock, sinfo, client_id,
+                                            self.update_format,
+                                            self.delta and not self.resync,
+                                            self.compress, reader=reader)
+                if self.deadband:
+                    self.deadband.setSent(dao if code == gdata.K_OK else None)
+
+            if not self.session:
+                sock.close()
         except socket.error, e:
             logging.debug('Error sending update to the server')
 
+        self.resync = code == gdata.K_ERR_RESYNC
+        if self.resync:
+            # Missed update, send the full data right now
+            logging.debug('Full update requested by the broker')
+            self.awakener.set()
+            return
+
+        if self.session and code != gdata.K_OK:
+            # The broker closes the session on errors, open a new one in the 
+            # next update
+            logging.debug('Session closed (%s)' % code)
+            self.closeSession()
+
+            if code in ('', gdata.K_ERR_MONITOR_UNREACHABLE, gdata.K_ERR_TIMEOUT):
+                return
+
         if code == gdata.K_ERR_MONITOR_UNREACHABLE:
             logging.info('Client kicked from server. To avoid this try reducing the time between updates.')
             thread.interrupt_main()
+        elif code == gdata.K_ERR_BUSY:
+            logging.info('Broker busy, update discarded')
+
+#
+## Tells the updates whose data is close enough to the last one sent, so a keep
+## alive is sent in their place
+class Deadband(object):
+
+    def __init__(self, cpu, memory, full_every):
+        self.cpu = cpu                  # Percentage of every cpu, or None
+        self.memory = memory            # Bytes of used memory and swap, or None
+        self.full_every = full_every    # Intervals between updates, at most
+
+        self._sent = None       # (cpu, memory, swap) of the last update sent
+        self._skipped = 0       # Keep alives since the last update sent
+
+    def isInside(self, dao):
+        """isInside(dao: SysInfoDAO) -> bool
+
+        Tests if the data of dao is inside the deadband, its running
+        processes haven't changed and the last update sent is recent enough.
+        The metrics without a bound are not compared.
+
+        """
+        if self._sent is None or self._skipped + 1 >= self.full_every or \
+                dao.getStartedProcesses() or dao.getFinishedProcesses():
+            return False
+
+        cpu, memory, swap = self._sample(dao)
+        sent_cpu, sent_memory, sent_swap = self._sent
+
+        if self.cpu is not None and (len(cpu) != len(sent_cpu) or
+                any( abs(used - sent) > self.cpu
+                        for used, sent in zip(cpu, sent_cpu) )):
+            return False
+
+        return self.memory is None or \
+                (abs(memory - sent_memory) <= self.memory and
+                 abs(swap - sent_swap) <= self.memory)
+
+    def setSent(self, dao):
+        """setSent(dao: SysInfoDAO) -> void
+
+        Takes the data of dao as the last update sent, None if it failed so
+        the next one is sent too.
+
+        """
+        self._sent = self._sample(dao) if dao is not None else None
+        self._skipped = 0
+
+    def setSkipped(self):
+        """setSkipped() -> void
+
+        Counts a keep alive sent in place of an update.
+
+        """
+        self._skipped += 1
+
+    # The values are copied, the DAO is updated in place
+    def _sample(self, dao):
+        return tuple(dao.getUsedCPUPercentage()), dao.getUsedVirtualMemory(), \
+                dao.getUsedSwap()
 
 def printCommandLineOptions():
     """printOptions() -> void 
@@ -337,6 +605,17 @@ def printCommandLineOptions():
     logging.debug("Connection timeout: " + str(options.connection_timeout) )
     logging.debug("Connection queue size: " + str(options.connection_queue_size))
     logging.debug("Time between updates: " + str(options.time_between_updates))
+    logging.debug("CPU interval: " + str(options.cpu_interval))
+    logging.debug("Memory interval: " + str(options.memory_interval))
+    logging.debug("Processes interval: " + str(options.processes_interval))
+    logging.debug("Collector budget: " + str(options.collector_budget))
+    logging.debug("Deadband CPU: " + str(options.deadband_cpu))
+    logging.debug("Deadband memory: " + str(options.deadband_memory))
+    logging.debug("Deadband full update every: " +
+                    str(options.deadband_full_every))
+    logging.debug("Sessions disabled: " + str(options.no_session))
+    logging.debug("Update format: " + options.update_format)
+    logging.debug("Full updates: " + str(options.full_updates))
     logging.debug("Logfile: " + options.logfile.name)
 
 #
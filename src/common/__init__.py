@@ -1,10 +1,13 @@
 #
 # -*- coding: utf-8 -*-
 
-from sysinfo import SysInfo, SysInfoDAO
+from sysinfo import SysInfo, SysInfoDAO, Collector
 from sysinfoxml import SysInfoXMLBuilder, SysInfoXMLParser
+from sysinfobin import SysInfoBinBuilder, SysInfoBinParser
 from rwlock import ReadWriteLock
 from util import assertType, assertAttribute, assertContainsType
 
 from sockutil import createServerTCPSocket, createMulticastSocket, \
-                joinMulticastGroup, leaveMulticastGroup, recvEnd, recvAll
\ No newline at end of file
+                joinMulticastGroup, leaveMulticastGroup, recvEnd, recvAll, \
+                SocketReader, FrameBuffer, Poller, createWakeUpPair, \
+                joinChunks, compressChunks, sendAllChunks
\ No newline at end of file
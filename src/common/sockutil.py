@@ -3,13 +3,367 @@
 # Imports
 # -------
 
+import zlib
+import errno
+import select
 import socket
 import struct
 import logging
 
+# Default size of the buffer used on every recv() call of a SocketReader
+DEF_RECV_BUFFER_SIZE = 65536
+# Size of the blocks sent of a streamed message
+DEF_SEND_BUFFER_SIZE = 65536
+
+# Classes
+# -------
+
+class FrameBuffer(object):
+    """Accumulates received data and splits it in delimited frames.
+
+    Data is stored as a list of the received blocks, every block is searched
+    for the delimiter only once (plus the few bytes that could hold the
+    beginning of a delimiter split between two blocks), so building a frame
+    is linear on its size whatever the size of the blocks.
+
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+        self._end = None
+
+        # Search state for the delimiter self._end
+        self._next = 0      # Index of the first chunk not searched yet
+        self._offset = 0    # Bytes in the chunks already searched
+        self._tail = ''     # Last len(end) - 1 bytes of the searched chunks
+
+    def feed(self, data):
+        """feed(data: str) -> void
+
+        Appends received data to the buffer.
+
+        """
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def getFrame(self, end):
+        """getFrame(end: str) -> str | None
+
+        Removes and returns the data until the next 'end' delimiter, without
+        the delimiter. Returns None if the buffer does not hold a whole frame.
+
+        """
+        if end != self._end:
+            self._end = end
+            self._resetSearch()
+
+        keep = len(end) - 1
+        chunks = self._chunks
+
+        while self._next < len(chunks):
+            window = self._tail + chunks[self._next]
+            pos = window.find(end)
+
+            if pos >= 0:
+                idx = self._offset - len(self._tail) + pos
+                total = ''.join(chunks)
+                rest = total[idx + len(end):]
+
+                self._chunks = [rest] if rest else []
+                self._size = len(rest)
+                self._resetSearch()
+                return total[:idx]
+
+            self._offset += len(chunks[self._next])
+            self._tail = window[max(0, len(window) - keep):]
+            self._next += 1
+
+        return None
+
+    def getBytes(self, size):
+        """getBytes(size: int) -> str | None
+
+        Removes and returns the next 'size' bytes. Returns None if the buffer
+        holds less than 'size' bytes.
+
+        """
+        if self._size < size:
+            return None
+
+        total = ''.join(self._chunks)
+        rest = total[size:]
+
+        self._chunks = [rest] if rest else []
+        self._size = len(rest)
+        self._resetSearch()
+        return total[:size]
+
+    def flush(self):
+        """flush() -> str
+
+        Removes and returns all the data in the buffer.
+
+        """
+        total = ''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        self._resetSearch()
+        return total
+
+    def size(self):
+        """size() -> int
+
+        Returns the number of bytes in the buffer.
+
+        """
+        return self._size
+
+    def _resetSearch(self):
+        self._next = 0
+        self._offset = 0
+        self._tail = ''
+
+#
+#
+class SocketReader(object):
+    """Buffered reader over a connected stream socket.
+
+    Reads the socket in blocks of 'bufsize' bytes and splits the received data
+    in frames terminated by a delimiter (ETX, '\\n', '\\n\\n', ...). The bytes
+    received after the end of a frame are kept in the reader and returned by
+    the following calls, so a single reader must be used for all the reads of
+    a connection.
+
+    """
+
+    def __init__(self, sock, bufsize=DEF_RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.bufsize = bufsize
+        self._frames = FrameBuffer()
+
+    def recvEnd(self, end):
+        """recvEnd(end: str) -> str
+
+        Returns the data received until the next 'end' delimiter, without the
+        delimiter. If the connection is closed before the delimiter arrives
+        all the pending data is returned (an empty string if there is none).
+
+        """
+        while True:
+            frame = self._frames.getFrame(end)
+            if frame is not None:
+                return frame
+
+            data = self.sock.recv(self.bufsize)
+            if not data:
+                # No data implies disconnection
+                return self._frames.flush()
+
+            self._frames.feed(data)
+
+    def recvSize(self, size):
+        """recvSize(size: int) -> str
+
+        Returns the next 'size' received bytes. If the connection is closed
+        before all of them arrive the pending data is returned.
+
+        """
+        while True:
+            data = self._frames.getBytes(size)
+            if data is not None:
+                return data
+
+            data = self.sock.recv(max(self.bufsize, size - self._frames.size()))
+            if not data:
+                # No data implies disconnection
+                return self._frames.flush()
+
+            self._frames.feed(data)
+
+    def recvCompressed(self):
+        """recvCompressed() -> str
+
+        Returns the data of a message sent with compressChunks() once it has
+        been received whole, decompressed.
+
+        Raises ValueError if the message is malformed or truncated.
+
+        """
+        decompressor = zlib.decompressobj()
+        parts = []
+
+        try:
+            while True:
+                size = int(self.recvEnd('\n'))
+                if not size:
+                    break
+
+                data = self.recvSize(size)
+                if len(data) != size:
+                    raise ValueError("Truncated compressed block")
+                parts.append(decompressor.decompress(data))
+
+            parts.append(decompressor.flush())
+        except zlib.error, e:
+            raise ValueError("Corrupted compressed data: %s" % str(e))
+
+        return ''.join(parts)
+
+    def hasPendingData(self):
+        """hasPendingData() -> bool
+
+        Tests if there is received data not returned yet.
+
+        """
+        return self._frames.size() > 0
+
+#
+#
+class Poller(object):
+    """Readiness notification over select.poll(), or select.select() on the
+    platforms without poll.
+
+    Every registered descriptor is watched for reading unless disabled with
+    modify().
+
+    """
+
+    def __init__(self):
+        self._read = set()
+        self._write = set()
+        self._poll = select.poll() if hasattr(select, 'poll') else None
+
+    def register(self, fd):
+        self._read.add(fd)
+        self._update(fd)
+
+    def modify(self, fd, read=None, write=None):
+        if read is not None:
+            if read: self._read.add(fd)
+            else: self._read.discard(fd)
+        if write is not None:
+            if write: self._write.add(fd)
+            else: self._write.discard(fd)
+        self._update(fd)
+
+    def unregister(self, fd):
+        self._read.discard(fd)
+        self._write.discard(fd)
+        if self._poll:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        """poll(timeout: float) -> [ (int, bool, bool) ]
+
+        Returns a list of (fd, readable, writable) of the ready descriptors.
+
+        """
+        if self._poll:
+            try:
+                events = self._poll.poll(timeout * 1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR: return []
+                raise
+
+            err = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            return [ (fd, bool(ev & (select.POLLIN | err)),
+                        bool(ev & (select.POLLOUT | err)))
+                        for fd, ev in events ]
+
+        try:
+            i, o, e = select.select(self._read, self._write, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR: return []
+            raise
+
+        o = set(o)
+        return [ (fd, fd in i, fd in o) for fd in set(i) | o ]
+
+    def _update(self, fd):
+        if self._poll:
+            mask = 0
+            if fd in self._read: mask |= select.POLLIN | select.POLLPRI
+            if fd in self._write: mask |= select.POLLOUT
+            self._poll.register(fd, mask)
+
 # Functions
 # ---------
 
+def createWakeUpPair():
+    """createWakeUpPair() -> socket.socket, socket.socket
+
+    Returns a connected pair of sockets (reader, writer) used to wake up a
+    thread waiting on a Poller. The writer is non-blocking.
+
+    os.pipe() descriptors can't be used with select() on every platform.
+
+    """
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        lsock.bind( ('127.0.0.1', 0) )
+        lsock.listen(1)
+        wsock = socket.create_connection(lsock.getsockname())
+        rsock, addr = lsock.accept()
+    finally:
+        lsock.close()
+
+    wsock.setblocking(0)
+    return rsock, wsock
+
+
+def joinChunks(parts, size=DEF_SEND_BUFFER_SIZE):
+    """joinChunks(parts: iterable of str, size: int) -> iterator of str
+
+    Joins the consecutive parts of a message in blocks of at least 'size'
+    bytes (but the last one), so a message made of many small parts can be
+    sent with few calls without building it whole in memory.
+
+    """
+    chunk = []
+    length = 0
+
+    for part in parts:
+        chunk.append(part)
+        length += len(part)
+
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+
+    if chunk:
+        yield ''.join(chunk)
+
+def compressChunks(chunks, level=zlib.Z_DEFAULT_COMPRESSION):
+    """compressChunks(chunks: iterable of str, level: int) -> iterator of str
+
+    Compresses a streamed message with zlib as it is produced. Every block of
+    compressed data is preceded by a line with its size and the last block is
+    empty ('0\\n'), see SocketReader.recvCompressed().
+
+    """
+    compressor = zlib.compressobj(level)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield '%d\n%s' % (len(data), data)
+
+    data = compressor.flush()
+    yield '%d\n%s0\n' % (len(data), data)
+
+def sendAllChunks(sock, chunks):
+    """sendAllChunks(sock: socket, chunks: iterable of str) -> void
+
+    Sends all the blocks of a streamed message, as they are produced.
+
+    """
+    for chunk in chunks:
+        sock.sendall(chunk)
+
+
 def recvAll(sock):
     """recvEnd(sock) -> received_data[]
 
@@ -37,6 +391,9 @@ def recvEnd(sock, end):
 
     Reads data from the socket until the 'end' data is received
 
+    Reads one byte at a time to never consume data beyond 'end', use a
+    SocketReader to read the frames of a connection.
+
     """
     total_data='';data=''
     while True:
@@ -56,15 +413,21 @@ def recvEnd(sock, end):
     return total_data
 
 
-def createServerTCPSocket(host, port, listen_size):
-    """createServerTCPSocket(host: str, port: int, listen_size: int) 
-        -> socket.socket
+def createServerTCPSocket(host, port, listen_size, reuse_port=False):
+    """createServerTCPSocket(host: str, port: int, listen_size: int,
+                                reuse_port: bool) -> socket.socket
 
     Creates a new TCP socket, binds it to the specified host and port with a
-    queue of size 'listen_size'
+    queue of size 'listen_size'. The port can be bound again right after the
+    socket is closed (SO_REUSEADDR), to restart a server. If 'reuse_port'
+    several sockets can be bound to the same port (SO_REUSEPORT), the kernel
+    spreads the connections among them.
 
     """
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind( (host, port) )
     sock.listen(listen_size)
     return sock
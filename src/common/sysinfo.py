@@ -4,10 +4,13 @@
 import os
 import sys
 import math
+import atexit
 import time
 import util
 import psutil          # https://code.google.com/p/psutil/wiki/Documentation
 import platform
+import threading
+import collections
 
 
 # Determines the operating system in module load time
@@ -34,25 +37,77 @@ elif OS_IS_WIN:
     OS_VERSION, _, _, _ = platform.win32_ver()
     osGetCPULoadAvg = lambda : 0.0, 0.0, 0.0
 
+# Seconds of cpu times the used percentages are computed over, by default
+DEF_CPU_WINDOW = 2.0
+
+# Seconds between the samples of the cpu times
+CPU_SAMPLE_INTERVAL = 0.5
+
+# Seconds a collector is run before its time, so the updates sent every
+# interval seconds don't skip it because of their jitter
+COLLECTOR_SLACK = 0.05
+
+# Collectors of every SysInfo, in the order they are run
+COLLECTOR_CPU = 'cpu'
+COLLECTOR_MEMORY = 'memory'
+COLLECTOR_PROCESSES = 'processes'
+
 
 ## Encapsulate methods to retrieve system information
 class SysInfo:
 
-    def __init__(self):
+    def __init__(self, cpu_window=DEF_CPU_WINDOW):
         self._dao = SysInfoDAO()
+        self._cpu_sampler = CPUSampler(cpu_window)
+        self._proc_scanner = ProcessScanner()
+
+        self._collectors = [ ]
+        self.addCollector(Collector(COLLECTOR_CPU, self._updateCPU))
+        self.addCollector(Collector(COLLECTOR_MEMORY, self._updateMemory))
+        self.addCollector(Collector(COLLECTOR_PROCESSES, self._updateProcesses,
+                                    skip=self._skipProcesses))
 
     def update(self):
         """update() -> void
 
         Updates information of the system state at the time of the call to 
-        this function.
+        this function. The collectors not due yet keep their previous values.
 
         """
-        self._updateCPU()
-        self._updateMemory()
-        self._updateProcesses()
+        now = time.time()
+        for collector in self._collectors:
+            if collector.isDue(now):
+                collector.collect(now)
+            else:
+                collector.skip()
 
         self._dao.setTimestamp(time.gmtime())
+        self._dao.setSequence(self._dao.getSequence() + 1)
+
+    def addCollector(self, collector):
+        """addCollector(collector: Collector) -> void
+
+        Adds a collector run by update(), after the previous ones.
+
+        Raises ValueError if there is already a collector with its name.
+
+        """
+        if collector.name in [ c.name for c in self._collectors ]:
+            raise ValueError("Duplicated collector: %s" % collector.name)
+        self._collectors.append(collector)
+
+    def getCollector(self, name):
+        """getCollector(name: str) -> Collector
+
+        Returns the collector name, to change its interval or budget.
+
+        Raises KeyError if there isn't any collector with that name.
+
+        """
+        for collector in self._collectors:
+            if collector.name == name:
+                return collector
+        raise KeyError(name)
 
     def _updateMemory(self):
         """_updateMemory() -> void
@@ -76,10 +131,21 @@ class SysInfo:
     def _updateCPU(self, interval=0.1):
         """_updateCPU() -> void
 
-        Updates the system's cpu stats.
+        Updates the system's cpu stats with the latest percentages of the
+        background sampler, started by the first call. Only the first call
+        waits interval seconds, there isn't any sample to compare with yet.
 
         """
-        self._dao.setUsedCPUPercentage( psutil.cpu_percent(interval, True) )
+        sampler = self._cpu_sampler
+        if sampler.ident is None:
+            sampler.start()
+            atexit.register(sampler.stop)   # Before the modules are cleared
+
+        used = sampler.getUsedPercentages()
+        if used is None:
+            used = psutil.cpu_percent(interval, True)
+
+        self._dao.setUsedCPUPercentage(used)
         self._dao.setCPULoadAvg( osGetCPULoadAvg() )
         
 
@@ -92,17 +158,20 @@ class SysInfo:
         """
         dao = self._dao
 
-        run_procs = frozenset( [ (p.pid, p.name) \
-                                for p in psutil.process_iter()] )
-        old_procs = dao.getRunningProcesses()
-
-        started_procs = run_procs - old_procs if old_procs else frozenset()
-        finished_procs = old_procs - run_procs if old_procs else frozenset()
+        run_procs, started_procs, finished_procs = self._proc_scanner.scan()
+        if not dao.getRunningProcesses():
+            started_procs = finished_procs = frozenset()
 
         dao.setRunningProcesses(run_procs)
         dao.setStartedProcesses(started_procs)
         dao.setFinishedProcesses(finished_procs)
 
+    # The running processes are kept, the started and finished ones are always
+    # the changes since the previous update
+    def _skipProcesses(self):
+        self._dao.setStartedProcesses(frozenset())
+        self._dao.setFinishedProcesses(frozenset())
+
     def getSysInfoData(self):
         """getSystemInfoData() -> SysInfoDAO
 
@@ -114,6 +183,193 @@ class SysInfo:
         return self._dao
 
 
+#
+## Source of system information, the function collect is run by SysInfo.update()
+## at most every interval seconds (0 on every update) and skip on the updates
+## it isn't due
+class Collector(object):
+
+    def __init__(self, name, collect, interval=0.0, budget=None, skip=None):
+        self.name = name
+        self.interval = interval
+        self.budget = budget    # Fraction of the time, None without limit
+        self.cost = 0.0         # Seconds spent by the last collection
+
+        self._collect = collect
+        self._skip = skip
+        self._next = 0.0        # Time it is due
+
+    def isDue(self, now):
+        """isDue(now: float) -> bool
+
+        Tests if the collector must be run at the time now.
+
+        """
+        return now + COLLECTOR_SLACK >= self._next
+
+    def collect(self, now):
+        """collect(now: float) -> void
+
+        Runs the collector and schedules the next run after its interval, or
+        later if it would spend more than its budget.
+
+        """
+        started = time.time()
+        self._collect()
+        self.cost = time.time() - started
+
+        wait = self.interval
+        if self.budget:
+            wait = max(wait, self.cost / self.budget)
+        self._next = now + wait
+
+    def skip(self):
+        """skip() -> void
+
+        Called on the updates the collector isn't due.
+
+        """
+        if self._skip is not None:
+            self._skip()
+
+
+#
+## Samples the cumulative cpu times in the background, so the used percentage
+## of every cpu over the last window seconds is read without waiting
+class CPUSampler(threading.Thread):
+
+    def __init__(self, window=DEF_CPU_WINDOW, interval=CPU_SAMPLE_INTERVAL):
+        super(CPUSampler, self).__init__()
+        self.daemon = True
+
+        self.window = window
+        self.interval = interval
+
+        self._samples = collections.deque()     # (time, cpu times), oldest first
+        self._lock = threading.Lock()
+        self._awakener = threading.Event()
+        self._active = True
+
+    ## Override
+    def run(self):
+        while self._active:
+            self._sample()
+            self._awakener.wait(self.interval)
+            self._awakener.clear()
+
+    def stop(self):
+        """stop() -> void
+
+        Stops sampling and waits until the sampler thread ends.
+
+        """
+        self._active = False
+        self._awakener.set()
+        self.join()
+
+    def getUsedPercentages(self):
+        """getUsedPercentages() -> [float]
+
+        Returns the used percentage of every cpu from the oldest sample of the
+        window to the latest one, or None until there are two samples.
+
+        """
+        with self._lock:
+            if len(self._samples) < 2:
+                return None
+            first = self._samples[0][1]
+            last = self._samples[-1][1]
+
+        return [ self._usedPercentage(old, new) for old, new in zip(first, last) ]
+
+    # Appends the current cpu times and drops the samples no longer needed:
+    # the oldest one kept is the newest one at least window seconds old
+    def _sample(self):
+        now = time.time()
+        times = psutil.cpu_times(percpu=True)
+
+        with self._lock:
+            samples = self._samples
+            samples.append( (now, times) )
+            while len(samples) > 2 and now - samples[1][0] >= self.window:
+                samples.popleft()
+
+    # Same as psutil.cpu_percent(), busy time is all but the idle one
+    def _usedPercentage(self, old, new):
+        total = sum(new) - sum(old)
+        if total <= 0:
+            return 0.0
+
+        busy = total - (new.idle - old.idle)
+        return round(min(max(busy * 100.0 / total, 0.0), 100.0), 1)
+
+
+#
+## Lists the running processes reading only the names of the new pids, the
+## rest are taken from the previous scan. A pid reused between two scans keeps
+## the name of its previous process
+class ProcessScanner(object):
+
+    def __init__(self):
+        self._names = { }       # pid -> name of the processes running
+
+    def scan(self):
+        """scan() -> frozenset, frozenset, frozenset
+
+        Returns the (pid, name) of the processes running, the ones started
+        and the ones finished since the previous scan.
+
+        """
+        names = { }
+        started = [ ]
+        for pid in _listPids():
+            name = self._names.get(pid)
+            if name is None:
+                name = _readProcessName(pid)
+                if name is None:
+                    continue                # Finished while scanning
+                started.append( (pid, name) )
+            names[pid] = name
+
+        finished = [ (pid, name) for pid, name in self._names.iteritems()
+                        if pid not in names ]
+        self._names = names
+
+        return frozenset(names.iteritems()), frozenset(started), \
+                frozenset(finished)
+
+
+# Pids of the processes running
+def _listPids():
+    if OS_IS_LINUX:
+        return [ int(entry) for entry in os.listdir('/proc') if entry.isdigit() ]
+    return psutil.get_pid_list()
+
+# Name of the process pid, None if it doesn't exist any more. As psutil, the
+# names truncated by the kernel are taken from the command line when it starts
+# with them
+def _readProcessName(pid):
+    if OS_IS_LINUX:
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                stat = f.read()
+            name = stat[stat.find('(') + 1:stat.rfind(')')]
+
+            if len(name) >= 15:
+                with open('/proc/%d/cmdline' % pid) as f:
+                    extended_name = os.path.basename(f.read().split('\0')[0])
+                if extended_name.startswith(name):
+                    name = extended_name
+        except IOError:
+            return None
+        return name
+
+    try:
+        return psutil.Process(pid).name
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+
+
 ## Encapsualte system information data 
 class SysInfoDAO:
 
@@ -144,6 +400,11 @@ class SysInfoDAO:
         self._started_procs = frozenset()
         self._finished_procs = frozenset()
 
+        # Number of the update, and if only started and finished processes
+        # were received (the running ones must be rebuilt from the last ones)
+        self._sequence = 0
+        self._procs_delta = False
+
     #
     # Getters
     #
@@ -240,6 +501,23 @@ class SysInfoDAO:
     def getFinishedProcesses(self):
         return self._finished_procs
 
+    def getSequence(self):
+        """getSequence() -> int
+
+        Returns the number of updates of the data, 0 if it is unknown.
+
+        """
+        return self._sequence
+
+    def isProcessesDelta(self):
+        """isProcessesDelta() -> bool
+
+        Tests if the data carries only the started and finished processes, so
+        the running ones are not known.
+
+        """
+        return self._procs_delta
+
     #
     # Setters
     #
@@ -333,6 +611,14 @@ class SysInfoDAO:
             self._finished_procs = procs
         else:
             self._finished_procs = frozenset(procs)
+
+    def setSequence(self, seq):
+        util.assertType(seq, (int, long), "Expected integer value")
+        self._sequence = seq
+
+    def setProcessesDelta(self, delta):
+        util.assertType(delta, bool, "Expected boolean value")
+        self._procs_delta = delta
 #
 #
 if __name__ == '__main__':
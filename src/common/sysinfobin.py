@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""sysinfobin.py - Compact binary encoding of a SysInfoDAO
+
+Alternative to the XML of sysinfoxml for the monitor updates, the numbers
+are packed with fixed widths (network byte order) and the process names are
+sent once in a string table referenced by index from the process lists.
+
+Layout (version 2):
+
+    header      magic 'DRB', version, timestamp (seconds, UTC), cpu arch,
+                number of cpus, load avg 1/5/15, RAM total/used/free/
+                avaliable, swap total/used/free, sequence number, flags
+    cpu usage   one unsigned short per cpu, hundredths of percent
+    strings     machine name, os name, os version: length + bytes
+    names       number of names, length of the table, names separated by '\\0'
+    processes   running, started and finished: count + (pid, name index)
+
+With the flag BIN_FLAG_DELTA the running processes list is empty, only the
+started and finished ones are sent.
+
+"""
+
+import time
+import struct
+import calendar
+import sysinfo
+
+BIN_MAGIC = 'DRB'
+BIN_VERSION = 2
+BIN_FLAG_DELTA = 0x1
+
+_header = struct.Struct('!3sBIBH3d7QIB')
+_count = struct.Struct('!I')
+_string = struct.Struct('!H')
+_names = struct.Struct('!II')
+
+#
+#
+class SysInfoBinBuilder():
+
+    def __init__(self):
+        self._data = None
+
+    def setBinData(self, sinfodao, delta=False):
+        """setBinData(sinfodao: SysInfoDAO, delta: bool) -> void
+
+        Sets the data returned encoded by getAsString(). If delta the running
+        processes are left out, only the started and finished ones are set.
+
+        """
+        dao = sinfodao
+        cpu_usage = dao.getUsedCPUPercentage()
+        flags = BIN_FLAG_DELTA if delta else 0
+
+        parts = [ _header.pack(BIN_MAGIC, BIN_VERSION,
+                        calendar.timegm(dao.getTimestamp()),
+                        dao.getCPUArchitecture(), len(cpu_usage),
+                        *(tuple(dao.getCPULoadAvg()) + dao.getVirtualMemory() +
+                          dao.getSwapMemory() + (dao.getSequence(), flags)) ),
+                  struct.pack('!%dH' % len(cpu_usage),
+                        *[ int(round(used * 100)) for used in cpu_usage ]) ]
+
+        for text in (dao.getMachineName(), dao.getOSName(), dao.getOSVersion()):
+            text = _encode(text)
+            parts.append(_string.pack(len(text)))
+            parts.append(text)
+
+        # Process lists as (pid, name index) pairs over a table of names
+        index = {}
+        plists = []
+        running = dao.getRunningProcesses() if not delta else ()
+        for procs in (running, dao.getStartedProcesses(),
+                        dao.getFinishedProcesses()):
+            pairs = []
+            for pid, name in procs:
+                idx = index.get(name)
+                if idx is None:
+                    idx = index[name] = len(index)
+                pairs.append(pid)
+                pairs.append(idx)
+            plists.append(pairs)
+
+        names = [None] * len(index)
+        for name, idx in index.iteritems():
+            names[idx] = _encode(name)
+        table = '\0'.join(names)
+
+        parts.append(_names.pack(len(names), len(table)))
+        parts.append(table)
+
+        for pairs in plists:
+            parts.append(_count.pack(len(pairs) / 2))
+            parts.append(struct.pack('!%dI' % len(pairs), *pairs))
+
+        self._data = ''.join(parts)
+
+    def getAsString(self):
+        """getAsString() -> str
+
+        Returns the previous given data encoded.
+
+        """
+        if self._data is not None:
+            return self._data
+
+        raise Exception('There is no data to encode')
+
+#
+#
+class SysInfoBinParser:
+
+    def __init__(self):
+        self._dao = sysinfo.SysInfoDAO()
+
+    def parseBin(self, data):
+        """parseBin(data: str) -> void
+
+        Parses the data of the given encoded string.
+
+        Raises an AttributeError if the data can't be understood.
+
+        """
+        try:
+            dao = sysinfo.SysInfoDAO()          # Work over isolated DAO
+
+            header = _header.unpack_from(data, 0)
+            offset = _header.size
+
+            magic, version, tstamp, arch, ncpus = header[:5]
+            if magic != BIN_MAGIC or version != BIN_VERSION:
+                raise AttributeError("Unknown binary data format")
+
+            dao.setTimestamp(time.gmtime(tstamp))
+            dao.setCPUArchitecture(arch)
+            dao.setCPULoadAvg(header[5:8])
+            dao.setTotalVirtualMemory(header[8])
+            dao.setUsedVirtualMemory(header[9])
+            dao.setFreeVirtualMemory(header[10])
+            dao.setAvaliableVirtualMemory(header[11])
+            dao.setTotalSwapMemory(header[12])
+            dao.setUsedSwapMemory(header[13])
+            dao.setFreeSwapMemory(header[14])
+            dao.setSequence(header[15])
+            dao.setProcessesDelta(bool(header[16] & BIN_FLAG_DELTA))
+
+            cpu_usage = struct.unpack_from('!%dH' % ncpus, data, offset)
+            dao.setUsedCPUPercentage([ used / 100.0 for used in cpu_usage ])
+            offset += 2 * ncpus
+
+            texts = []
+            for i in xrange(3):
+                size, = _string.unpack_from(data, offset)
+                offset += _string.size
+                texts.append(_slice(data, offset, size))
+                offset += size
+
+            dao.setMachineName(texts[0])
+            dao.setOSName(texts[1])
+            dao.setOSVersion(texts[2])
+
+            nnames, size = _names.unpack_from(data, offset)
+            offset += _names.size
+            names = _slice(data, offset, size).split('\0') if nnames else []
+            offset += size
+
+            if len(names) != nnames:
+                raise AttributeError("Corrupted process names table")
+
+            for setfunc in (dao.setRunningProcesses, dao.setStartedProcesses,
+                            dao.setFinishedProcesses):
+                count, = _count.unpack_from(data, offset)
+                offset += _count.size
+                pairs = struct.unpack_from('!%dI' % (2 * count), data, offset)
+                offset += 8 * count
+
+                setfunc(frozenset(
+                    zip(pairs[0::2], [ names[i] for i in pairs[1::2] ]) ))
+
+            self._dao = dao # Once the data is consistend store the new DAO
+
+        except struct.error, e:
+            raise AttributeError("Truncated binary data: %s" % str(e))
+        except IndexError, e:
+            raise AttributeError("Process name out of the names table")
+
+    def getSysInfoData(self):
+        """getSystemInfoData() -> SysInfoDAO
+
+        Returns the internal reference to the DAO used to store the system
+        information.
+
+        """
+        return self._dao
+
+# Functions
+# ---------
+
+def _encode(text):
+    if text is None:
+        return ''
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+def _slice(data, offset, size):
+    if offset + size > len(data):
+        raise AttributeError("Truncated binary data")
+    return data[offset:offset + size]
+
+#
+#
+if __name__ == '__main__':
+
+    import sysinfoxml
+
+    sinfo = sysinfo.SysInfo()
+    sinfoBin = SysInfoBinBuilder()
+    sinfoParser = SysInfoBinParser()
+
+    sinfo.update()
+    odao = sinfo.getSysInfoData()
+
+    sinfoBin.setBinData(odao)
+    sinfoParser.parseBin(sinfoBin.getAsString())
+
+    ndao = sinfoParser.getSysInfoData()
+
+    xmlBuilder = sysinfoxml.SysInfoXMLBuilder()
+    xmlBuilder.setXMLData(odao)
+
+    print "Binary size:", len(sinfoBin.getAsString())
+    print "XML size:", len(xmlBuilder.getAsString())
+    print "Match timestamp:", odao.getTimestamp() == ndao.getTimestamp()
+    print "Match client name:", odao.getMachineName() == ndao.getMachineName()
+    print "Match cpu arch:", odao.getCPUArchitecture() == ndao.getCPUArchitecture()
+    print "Match cpu load avg:", odao.getCPULoadAvg() == ndao.getCPULoadAvg()
+    print "Match cpu usage %:", odao.getUsedCPUPercentage() == ndao.getUsedCPUPercentage()
+    print "Match virtual mem:", odao.getVirtualMemory() == ndao.getVirtualMemory()
+    print "Match swap mem:", odao.getSwapMemory() == ndao.getSwapMemory()
+    print "Match running procs:", odao.getRunningProcesses() == ndao.getRunningProcesses()
+    print "Match started procs:", odao.getStartedProcesses() == ndao.getStartedProcesses()
+    print "Match finished procs:", odao.getFinishedProcesses() == ndao.getFinishedProcesses()
@@ -19,30 +19,44 @@ tag_names = {
             }
 
 attr_names = {
-                'name' : 'name', 'timestamp' : 'timestamp'
+                'name' : 'name', 'timestamp' : 'timestamp',
+                'sequence' : 'seq', 'delta' : 'delta'
                 }
 
 timestamp_format = "%d/%m/%Y %H:%M:%S %Z"
 
+# Sections of the XML that can be chosen, in document order
+section_names = ('os', 'cpu', 'memory', 'processes')
+
 #
 #
 class SysInfoXMLBuilder():
 
     
 
-    def setXMLData(self, sinfodao):
-        """setXMLData(sysinfo : SysInfo) -> void
+    def setXMLData(self, sinfodao, delta=False, sections=None):
+        """setXMLData(sysinfo : SysInfo, delta: bool, sections: iterable)
+            -> void
+
+        Sets the data for the XML returned by getXML(). If delta the running
+        processes are left out, only the started and finished ones are set.
 
-        Sets the data for the XML returned by getXML()
+        If sections is given only those of section_names are set, besides the
+        machine name and timestamp.
 
         """
         self.root = etree.Element( tag_names['root'] )
 
         self._setXMLDescriptiveData(sinfodao)
-        self._setXMLOSData(sinfodao)
-        self._setXMLCPUData(sinfodao)
-        self._setXMLMemoryData(sinfodao)
-        self._setXMLProcesessData(sinfodao)
+
+        if sections is None or 'os' in sections:
+            self._setXMLOSData(sinfodao)
+        if sections is None or 'cpu' in sections:
+            self._setXMLCPUData(sinfodao)
+        if sections is None or 'memory' in sections:
+            self._setXMLMemoryData(sinfodao)
+        if sections is None or 'processes' in sections:
+            self._setXMLProcesessData(sinfodao, delta)
 
     def getAsString(self):
         """getAsString() -> str
@@ -104,12 +118,19 @@ class SysInfoXMLBuilder():
         etree.SubElement( swap, tag_names['used'] ).text = smem[1]
         etree.SubElement( swap, tag_names['free'] ).text = smem[2]
 
-    def _setXMLProcesessData(self, dao):
+    def _setXMLProcesessData(self, dao, delta):
         # Sets processes data
 
         processes = etree.SubElement( self.root, tag_names['processes'] )
 
-        for p in dao.getRunningProcesses():
+        if dao.getSequence():
+            processes.set(attr_names['sequence'], str(dao.getSequence()))
+
+        if delta:
+            processes.set(attr_names['delta'], '1')
+        
+        running = dao.getRunningProcesses() if not delta else ()
+        for p in running:
             rp = etree.SubElement( processes, tag_names['running'] )
             rp.set(attr_names['name'], p[1])
             rp.text = str(p[0])
@@ -289,6 +310,14 @@ class SysInfoXMLParser:
         processes = root.find(main_tag)
 
         if processes != None:
+            try:
+                dao.setSequence(
+                    int(processes.attrib.get(attr_names['sequence'], 0)) )
+            except ValueError:
+                raise AttributeError("Wrong processes sequence number")
+            dao.setProcessesDelta(
+                processes.attrib.get(attr_names['delta']) == '1' )
+
             self._parseProcessesDataSubElements(processes, tag_names['running'],
                                                     dao.setRunningProcesses )
             self._parseProcessesDataSubElements(processes, tag_names['started'],
@@ -13,12 +13,35 @@ DEF_LISTEN_QUEUE_SIZE = 100
 DEF_LISTEN_IFACE = '0.0.0.0'
 DEF_MAX_TIME_GC = 30.0
 DEF_MAX_UPDATE_TRIES = 5
+DEF_WORKER_POOL_SIZE = 32
+DEF_WORKER_QUEUE_SIZE = 256
+DEF_HISTORY_SIZE = 300
+DEF_SNAPSHOT_INTERVAL = 30.0
+DEF_FLEETMAP_INTERVAL = 1.0
+DEF_PROCESSES = 1
+DEF_RELAY_INTERVAL = 1.0
+DEF_DEADBAND_FULL_EVERY = 10
+
+# Server engines
+ENGINE_THREADS = 'threads'      # Every connection is served by a worker thread
+ENGINE_EVENTS = 'events'        # Event loop, workers only process requests
 
 # Greeting messages client/server 
 SOH = '%c' % 0x1
 STX = '%c' % 0x2
 ETX = '%c' % 0x3
 BEL = '%c' % 0x7
+SYN = '%c' % 0x16   # Opens a monitor session (many SOH through one connection)
+DC2 = '%c' % 0x12   # Opens a relay session of a child broker (many ETB)
+ETB = '%c' % 0x17   # Batch of monitors relayed by a child broker
+
+# Encodings of the monitor updates, negotiated in the BEL message
+FMT_XML = 'xml'     # SysInfoXMLBuilder, payload delimited by ETX
+FMT_BIN = 'bin'     # SysInfoBinBuilder, payload with its size in the head
+UPDATE_FORMATS = (FMT_BIN, FMT_XML)     # Supported, in order of preference
+OPT_DELTA = 'delta' # Updates may carry only the started/finished processes
+OPT_ZLIB = 'zlib'   # Updates compressed, sized and encoded as '<format>+zlib'
+UPDATE_OPTIONS = (OPT_DELTA, OPT_ZLIB)  # Supported, answered in this order
 
 # Fixed ports
 SERVER_PORT = 6666
@@ -36,6 +59,12 @@ CMD_GET = 'get'
 CMD_UPDATE_ALL = 'update all'
 CMD_GET_ALL = 'get all'
 CMD_LIST = 'list'
+CMD_HISTORY = 'history'
+CMD_AGG = 'agg'
+CMD_TOP = 'top'
+CMD_FIND_PROCESS = 'find process'
+CMD_FIELDS = 'fields'
+CMD_ZLIB = 'zlib'
 
 # Specific direct commands
 CMD_QUIT = 'quit'
@@ -49,6 +78,8 @@ K_ERR_MONITOR_UNREACHABLE = '502'
 K_ERR_BAD_MESSAGE = '503'
 K_ERR_TIMEOUT = '504'
 K_ERR_UNKNOWN_CMD = '505'
+K_ERR_BUSY = '506'
+K_ERR_RESYNC = '507'    # Processes delta not applicable, full update needed
 
 # Command line options
 # --------------------
@@ -90,6 +121,62 @@ def initSrvCommandLineOptions(cmd_line_options, version):
                 default=DEF_LISTEN_QUEUE_SIZE, 
                 help="max amount of clients waiting for being accepted")
 
+    parser.add_argument('-se', '--server-engine', default=ENGINE_THREADS,
+                choices=(ENGINE_THREADS, ENGINE_EVENTS),
+                help='connections handling engine (default: %s)' 
+                % ENGINE_THREADS)
+
+    parser.add_argument('-np', '--processes', type=int, default=DEF_PROCESSES,
+                help='worker processes sharing the ports, each one serves ' \
+                     'a part of the monitors (default: %d)' % DEF_PROCESSES)
+
+    parser.add_argument('-wps', '--worker-pool-size', type=int,
+                default=DEF_WORKER_POOL_SIZE,
+                help='worker threads serving the connections/requests')
+
+    parser.add_argument('-wqs', '--worker-queue-size', type=int,
+                default=DEF_WORKER_QUEUE_SIZE,
+                help='max connections/requests waiting for a worker, the ' \
+                     'rest are rejected with a busy error')
+
+    parser.add_argument('-hs', '--history-size', type=int,
+                default=DEF_HISTORY_SIZE,
+                help='samples of every monitor kept for the history ' \
+                     'command, 0 disables it (default: %d)' % DEF_HISTORY_SIZE)
+
+    parser.add_argument('-sf', '--snapshot-file', default=None,
+                help='file where the monitors data is saved to restore it ' \
+                     'when the broker is restarted (default: disabled)')
+
+    parser.add_argument('-si', '--snapshot-interval', type=float,
+                default=DEF_SNAPSHOT_INTERVAL,
+                help='seconds between the writes of the changes to the ' \
+                     'snapshot file (default: %.0f)' % DEF_SNAPSHOT_INTERVAL)
+
+    parser.add_argument('-mf', '--map-file', default=None,
+                help='memory-mapped file where the latest metrics of the ' \
+                     'monitors are published for local readers ' \
+                     '(default: disabled)')
+
+    parser.add_argument('-mi', '--map-interval', type=float,
+                default=DEF_FLEETMAP_INTERVAL,
+                help='seconds between the publications to the map file ' \
+                     '(default: %.0f)' % DEF_FLEETMAP_INTERVAL)
+
+    parser.add_argument('-uhost', '--upstream-host', default=None,
+                help='upstream broker the monitors are relayed to, this ' \
+                     'broker becomes its child (default: disabled)')
+
+    parser.add_argument('-uport', '--upstream-port', type=int,
+                default=SERVER_PORT,
+                help='monitors port of the upstream broker (default: %d)'
+                     % SERVER_PORT)
+
+    parser.add_argument('-ri', '--relay-interval', type=float,
+                default=DEF_RELAY_INTERVAL,
+                help='seconds between the batches relayed to the upstream ' \
+                     'broker (default: %.0f)' % DEF_RELAY_INTERVAL)
+
     parser.add_argument('-mg', '--multicast-group', default='227.123.123.123',
                 help='multicast group ip')
 
@@ -153,6 +240,57 @@ def initCliCommandLineOptions(cmd_line_options, version):
             help='time between every update sent to the server (default: 2)',
             default=2.0)
 
+    parser.add_argument('-ci', '--cpu-interval', type=float, default=0.0,
+            help='minimum time between the samples of the cpu usage sent ' \
+            'in the updates (default: 0, every update)')
+
+    parser.add_argument('-mi', '--memory-interval', type=float, default=0.0,
+            help='minimum time between the samples of the memory usage ' \
+            'sent in the updates (default: 0, every update)')
+
+    parser.add_argument('-pi', '--processes-interval', type=float,
+            default=0.0, help='minimum time between the scans of the ' \
+            'running processes sent in the updates (default: 0, every update)')
+
+    parser.add_argument('-cb', '--collector-budget', type=float,
+            default=None, help='fraction of the time the cpu, memory and ' \
+            'processes samples may spend, a slower sample is delayed until ' \
+            'it fits, e.g. 0.05 (default: no limit)')
+
+    parser.add_argument('-dbc', '--deadband-cpu', type=float, default=None,
+            help='send a keep alive instead of an update when the usage of ' \
+            'every cpu is within this percentage of the last update sent ' \
+            'and the running processes haven\'t changed, along with -dbm ' \
+            'if given (default: disabled, the cpu is not compared)')
+
+    parser.add_argument('-dbm', '--deadband-memory', type=float, default=None,
+            help='send a keep alive instead of an update when the used ' \
+            'memory and swap are within these megabytes of the last update ' \
+            'sent and the running processes haven\'t changed, along with ' \
+            '-dbc if given (default: disabled, the memory is not compared)')
+
+    parser.add_argument('-dbf', '--deadband-full-every', type=int,
+            default=DEF_DEADBAND_FULL_EVERY, help='send an update at least ' \
+            'every these intervals when the deadband is enabled (default: ' \
+            '%d)' % DEF_DEADBAND_FULL_EVERY)
+
+    parser.add_argument('-ns', '--no-session', action='store_true',
+            default=False, help='send every update through a new ' \
+            'connection instead of keeping a session open with the broker')
+
+    parser.add_argument('-fu', '--full-updates', action='store_true',
+            default=False, help='send the whole list of running processes ' \
+            'on every update instead of the started and finished ones')
+
+    parser.add_argument('-nz', '--no-zlib', action='store_true',
+            default=False, help='send the updates uncompressed instead of ' \
+            'compressed with zlib')
+
+    parser.add_argument('-uf', '--update-format', default=FMT_BIN,
+            choices=UPDATE_FORMATS, help='encoding of the updates offered ' \
+            'to the broker, XML is used if the broker does not accept it ' \
+            '(default: %s)' % FMT_BIN)
+
     parser.add_argument('-lf', '--logfile', type=argparse.FileType('a'),
                 default=sys.stderr,  help='logging file (default [stderr])')
 
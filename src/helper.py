@@ -45,6 +45,54 @@ def isCmdGetAll(msg):
     """
     return msg.lower() == gdata.CMD_GET_ALL.lower()
 
+def isCmdHistory(msg):
+    """isCmdHistory(msg: str) -> bool
+
+    Tests if msg is the history command.
+
+    """
+    return msg.lower() == gdata.CMD_HISTORY.lower()
+
+def isCmdAgg(msg):
+    """isCmdAgg(msg: str) -> bool
+
+    Tests if msg is the aggregate command.
+
+    """
+    return msg.lower() == gdata.CMD_AGG.lower()
+
+def isCmdTop(msg):
+    """isCmdTop(msg: str) -> bool
+
+    Tests if msg is the top command.
+
+    """
+    return msg.lower() == gdata.CMD_TOP.lower()
+
+def isCmdFindProcess(msg):
+    """isCmdFindProcess(msg: str) -> bool
+
+    Tests if msg starts with the find process command.
+
+    """
+    return msg.lower().split()[:2] == gdata.CMD_FIND_PROCESS.split()
+
+def isCmdFields(msg):
+    """isCmdFields(msg: str) -> bool
+
+    Tests if msg is the fields option of the get commands.
+
+    """
+    return msg.lower() == gdata.CMD_FIELDS.lower()
+
+def isCmdZlib(msg):
+    """isCmdZlib(msg: str) -> bool
+
+    Tests if msg is the compression option of the get commands.
+
+    """
+    return msg.lower() == gdata.CMD_ZLIB.lower()
+
 def isCmdUpdate(msg):
     """isCmdUpdate(msg) -> bool
 
@@ -77,6 +125,31 @@ def isSOH(msg):
     """
     return msg == gdata.SOH
 
+def isSYN(msg):
+    """isSYN(msg: str) -> bool
+
+    Tests if the message is the one sended by a monitor to open a session.
+
+    """
+    return msg == gdata.SYN
+
+def isDC2(msg):
+    """isDC2(msg: str) -> bool
+
+    Tests if the message is the one sended by a child broker to open a relay
+    session.
+
+    """
+    return msg == gdata.DC2
+
+def isETB(msg):
+    """isETB(msg: str) -> bool
+
+    Tests if the message is a batch of monitors relayed by a child broker.
+
+    """
+    return msg == gdata.ETB
+
 def getOkMessage(ok_desc = '', data = ''):
     """getOkMessage(msg = '') -> str
 
@@ -88,6 +161,15 @@ def getOkMessage(ok_desc = '', data = ''):
     else:
         return ("%s %s\n\n" % (gdata.K_OK, ok_desc))
 
+def getOkMessageHead(ok_desc = ''):
+    """getOkMessageHead(ok_desc = '') -> str
+
+    Returns the first line of an ok message streamed in parts, it must be
+    followed by the data and an empty line ('\\n\\n').
+
+    """
+    return ("%s %s\n" % (gdata.K_OK, ok_desc))
+
 def getErrorMessage(err_code, err_msg):
     """getErrorMessage(err_code: str, err_msg: str) -> str
 
@@ -142,4 +224,20 @@ def getUnknownCmdError(msg = ''):
     Returns an unknown command error message with he given text
 
     """
-    return getErrorMessage(gdata.K_ERR_UNKNOWN_CMD, msg)
\ No newline at end of file
+    return getErrorMessage(gdata.K_ERR_UNKNOWN_CMD, msg)
+
+def getBusyError(msg = ''):
+    """getBusyError(msg = '') -> str
+
+    Returns a server busy error message with the given text.
+
+    """
+    return getErrorMessage(gdata.K_ERR_BUSY, msg)
+
+def getResyncError(msg = ''):
+    """getResyncError(msg = '') -> str
+
+    Returns a message asking a monitor for a full update with the given text.
+
+    """
+    return getErrorMessage(gdata.K_ERR_RESYNC, msg)
\ No newline at end of file
@@ -4,14 +4,23 @@
 # Imports
 # -------
 
+import os
 import sys
+import Queue
+import signal
 import gdata
 import common
-import select
 import socket
 import logging
+import srvpool
 import srvdata
+import srvevents
+import srvcluster
+import srvrelay
+import srvfleetmap
+import srvsnapshot
 import srvhandlers
+import multiprocessing
 
 # Program Data
 # ------------
@@ -21,6 +30,13 @@ __author__ = "Josep Pon Farreny, Marc Piñol Pueyo"
 __license__ = "MIT"
 __status__ = "Development"
 
+# Maximum time blocked waiting for connections, bounds the delay to expire the
+# idle monitor sessions
+POLL_INTERVAL = 0.5
+
+# Flags of the worker processes already finishing, shared with them
+_stopping = None
+
 # Functions
 # ---------
 
@@ -34,37 +50,224 @@ def main():
     # Get command line options
     opt = gdata.getCommandLineOptions()
 
+    if opt.processes > 1:
+        runWorkers(opt)
+    else:
+        # A service stop saves the snapshot as a Ctrl+C
+        signal.signal(signal.SIGTERM, _interrupt)
+        serve(opt)
+
+def serve(opt):
+    """serve(opt: Namespace) -> void
+
+    Runs the broker in this process until it is interrupted.
+
+    """
     # Set up sockets
-    mon_sock, cli_sock, m_sock = setUpSockets()
+    mon_sock, cli_sock, m_sock = setUpSockets(opt.processes > 1)
+    snapshot = None
+    fleetmap = None
+    relay = None
 
     try:
+        # Restores the monitors saved by the previous run and saves them from
+        # now on
+        if opt.snapshot_file:
+            snapshot = startSnapshot(opt)
+
+        # Publishes the metrics of the monitors for the local readers
+        if opt.map_file:
+            fleetmap = startFleetMap(opt)
+
+        # Relays the monitors to the upstream broker
+        if opt.upstream_host:
+            relay = startRelay(opt)
+
         # Starts the data base garbage collector
-        # In order to clean the memory regularly the gc will run at most every
-        # 30 seconds
-        gc_time = min(opt.data_life_time / 2, gdata.DEF_MAX_TIME_GC) 
+        # The gc runs when the next monitor data gets old, and in order to
+        # clean the memory regularly at least every 30 seconds
+        gc_time = gdata.DEF_MAX_TIME_GC
         db_gc = srvdata.DBGarbageCollector(gc_time, opt.data_life_time)
         db_gc.start()
-        logging.info("DB Garbage collector started (runs every: %fs)" % gc_time)
+        logging.info("DB Garbage collector started (runs at most every: %fs)"
+                        % gc_time)
 
         # Starts runs the main loop, close all the sockets at exit
-        mainLoop(mon_sock, cli_sock, m_sock)
+        if opt.server_engine == gdata.ENGINE_EVENTS:
+            eventsLoop(mon_sock, cli_sock, m_sock)
+        else:
+            mainLoop(mon_sock, cli_sock, m_sock)
 
         # Stop the garbage collector
         srvdata.DBGarbageCollector.stop(db_gc)
         logging.info("DB Garbage collector stoped")
 
     finally:
+        if relay:
+            relay.stop()
+            logging.info("Relay forwarder stoped")
+
+        if fleetmap:
+            fleetmap.stop()
+            logging.info("Fleet map writer stoped")
+
+        if snapshot:
+            snapshot.stop()
+            logging.info("Snapshot saved")
+
         mon_sock.close()
         logging.info("Monitors socket closed")
         cli_sock.close()
         logging.info("Commands socket closed")
         m_sock.close()
 
+def runWorkers(opt):
+    """runWorkers(opt: Namespace) -> void
+
+    Runs the broker in opt.processes worker processes sharing its ports (see
+    srvcluster) until it is interrupted or one of them ends, then stops all
+    of them.
+
+    """
+    global _stopping
+
+    srvcluster.createCluster(opt.processes)
+    _stopping = multiprocessing.RawArray('b', opt.processes)
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    workers = [ multiprocessing.Process(target=_serveWorker, args=(i, opt),
+                                        name='worker-%d' % i)
+                for i in xrange(opt.processes) ]
+
+    try:
+        for worker in workers:
+            worker.start()
+        logging.info("Started %d worker processes" % len(workers))
+
+        while all(worker.is_alive() for worker in workers):
+            workers[0].join(POLL_INTERVAL)
+
+        logging.critical("A worker process ended unexpectedly")
+
+    except KeyboardInterrupt:
+        logging.info("Finishing due to KeyboardInterrupt")
+    finally:
+        # The workers finish as interrupted by the user, unless they are
+        # finishing already (the SIGTERM was sent to the whole group)
+        for i, worker in enumerate(workers):
+            if worker.is_alive() and not _stopping[i]:
+                os.kill(worker.pid, signal.SIGTERM)
+        for worker in workers:
+            if worker.pid is not None:
+                worker.join()
+
+        srvcluster.destroyCluster()
+        logging.info("All worker processes terminated")
+
+# Main function of a worker process, only the parent receives the Ctrl+C of
+# the user and terminates the workers
+def _serveWorker(index, opt):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _interruptWorker)
+
+    srvcluster.initWorker(index)
+    logging.info("Worker %d started (pid %d)" % (index, os.getpid()))
+
+    serve(opt)
+
+# Signal handler, finishes the process as a Ctrl+C. Only once, the next
+# signals would interrupt its cleanup
+def _interrupt(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+# Signal handler of the worker processes, tells the parent it is finishing
+def _interruptWorker(signum, frame):
+    _stopping[srvcluster.worker] = 1
+    _interrupt(signum, frame)
+
+def startSnapshot(opt):
+    """startSnapshot(opt: Namespace) -> SnapshotWriter
+
+    Restores the monitors of the snapshot file and starts the thread that
+    saves the changes in it, the program is terminated if the file is not a
+    snapshot.
+
+    """
+    try:
+        restored = srvsnapshot.loadSnapshot(opt.snapshot_file,
+                                            opt.data_life_time,
+                                            opt.history_size)
+    except ValueError, e:
+        logging.critical("Can't load the snapshot %s: %s"
+                            % (opt.snapshot_file, str(e)) )
+        sys.exit(-1)
+
+    logging.info("Restored %d monitors from %s" % (restored,
+                                                    opt.snapshot_file))
+
+    snapshot = srvsnapshot.SnapshotWriter(opt.snapshot_file,
+                                            opt.snapshot_interval)
+    snapshot.daemon = True
+    snapshot.start()
+    logging.info("Snapshot writer started (every %.1fs)"
+                    % opt.snapshot_interval)
+
+    return snapshot
+
+def startFleetMap(opt):
+    """startFleetMap(opt: Namespace) -> FleetMapWriter
+
+    Creates the fleet map file and starts the thread that publishes the
+    monitors in it, the program is terminated if it can't be created.
+
+    """
+    fleetmap = srvfleetmap.FleetMapWriter(opt.map_file, opt.map_interval)
+    try:
+        fleetmap.create()
+    except (IOError, OSError), e:
+        logging.critical("Can't create the fleet map %s: %s"
+                            % (opt.map_file, str(e)) )
+        sys.exit(-1)
+
+    fleetmap.daemon = True
+    fleetmap.start()
+    logging.info("Fleet map writer started (every %.1fs)" % opt.map_interval)
+
+    return fleetmap
+
+def startRelay(opt):
+    """startRelay(opt: Namespace) -> RelayForwarder
+
+    Starts the thread that relays the monitors of this broker to the
+    upstream broker.
+
+    """
+    name = "%s:%d" % (socket.gethostname(), opt.mon_port)
+    if srvcluster.workers > 1:
+        name += "/%d" % srvcluster.worker
+
+    relay = srvrelay.RelayForwarder(name, opt.upstream_host,
+                                    opt.upstream_port, opt.relay_interval,
+                                    opt.connection_timeout)
+    relay.daemon = True
+    relay.start()
+    logging.info("Relaying the monitors to %s:%d (every %.1fs)"
+                    % (opt.upstream_host, opt.upstream_port,
+                        opt.relay_interval))
+
+    return relay
+
 def mainLoop(mon_sock, cli_sock, m_sock):
     """mainLoop(mon_sock: socket, cli_sock: socket, m_sock: socket) -> void
 
     Main logic of the applications, listens to mon_sock and cli_sock and 
-    starts threads to handle the petitions.
+    queues the accepted connections to a pool of worker threads. When the
+    queue is full the new connections are rejected with a busy error.
+
+    Idle monitor sessions and command connections are watched here too and
+    queued again when the monitor sends a new update or the client a new
+    command.
 
     """
     opt = gdata.getCommandLineOptions()
@@ -72,30 +275,69 @@ def mainLoop(mon_sock, cli_sock, m_sock):
     mg_ip = opt.multicast_group
     mg_port = opt.multicast_group_port
 
-    insocks = set([mon_sock, cli_sock])
+    pool = srvpool.WorkerPool(opt.worker_pool_size, opt.worker_queue_size)
+    pool.start()
+
+    poller = common.Poller()
+    sessions = srvhandlers.IdleSessions(poller, opt.data_life_time)
+    commands = srvhandlers.IdleSessions(poller, timeout)
+
+    mon_fd = mon_sock.fileno()
+    cli_fd = cli_sock.fileno()
+    sessions_fd = sessions.fileno()
+    commands_fd = commands.fileno()
+    for fd in (mon_fd, cli_fd, sessions_fd, commands_fd):
+        poller.register(fd)
+
+    # Monitors handed over by the other worker processes
+    handoff_fd = None
+    if srvcluster.workers > 1:
+        handoff_fd = srvcluster.handOffFileno()
+        poller.register(handoff_fd)
+
     logging.info("Server running press Ctrl+C to Quit!")
 
     try:
         while True:
-            i, o , e = select.select(insocks, [], [])
-
-            for s in i:
-                t = None
-                if s is mon_sock:
-                    ns, addr = s.accept()
+            for fd, readable, writable in poller.poll(POLL_INTERVAL):
+                if fd == mon_fd:
+                    ns, addr = mon_sock.accept()
                     logging.debug("New monitor connexion from %s:%d" % addr)
 
-                    t = srvhandlers.MonitorHandler(ns, timeout)
-                    t.start()
+                    h = srvhandlers.MonitorHandler(ns, timeout, sessions)
+                    _submitHandler(pool, h.run, ns, addr)
 
-                else:
-                    # If is not mon_sock then it is conn_sock
-                    ns, addr = s.accept()
+                elif fd == cli_fd:
+                    ns, addr = cli_sock.accept()
                     logging.debug("New command connexion from %s:%d" % addr)
 
-                    t = srvhandlers.CommandHandler(ns, m_sock, mg_ip, mg_port,
-                                                    timeout)
-                    t.start()
+                    h = srvhandlers.CommandHandler(ns, m_sock, mg_ip, mg_port,
+                                                    timeout, commands)
+                    _submitHandler(pool, h.run, ns, addr)
+
+                elif fd == sessions_fd:
+                    sessions.collect()
+
+                elif fd == commands_fd:
+                    commands.collect()
+
+                elif fd == handoff_fd:
+                    ns = srvcluster.receiveHandOff()
+                    try:
+                        h = srvhandlers.MonitorHandler(ns, timeout, sessions)
+                    except socket.error:
+                        ns.close()      # Closed by the monitor meanwhile
+                        continue
+
+                    _submitHandler(pool, h.run, ns, h.addr)
+
+                else:
+                    # New data in an idle session or command connection
+                    h = sessions.resume(fd) or commands.resume(fd)
+                    if h: _submitHandler(pool, h.resume, h.sock, h.addr)
+
+            sessions.expire()
+            commands.expire()
 
     except KeyboardInterrupt:
         logging.info("Finishing due to KeyboardInterrupt")
@@ -104,19 +346,56 @@ def mainLoop(mon_sock, cli_sock, m_sock):
         if opt.debug:
             import traceback; traceback.print_exc(sys.stderr)
     finally:
-        logging.info("Waiting threads termination")
-        waitThreads()
-        logging.info("All threads terminated")
+        logging.info("Waiting workers termination")
+        pool.stop()
+        sessions.closeAll()
+        commands.closeAll()
+        logging.info("All workers terminated")
+
+def _submitHandler(pool, func, sock, addr):
+    # Queues func to the pool or rejects the connection if the pool is full
+    try:
+        pool.submit(func)
+    except Queue.Full:
+        logging.warning("Workers queue full, rejected %s:%d" % addr)
+        srvhandlers.rejectBusy(sock)
+
+def eventsLoop(mon_sock, cli_sock, m_sock):
+    """eventsLoop(mon_sock: socket, cli_sock: socket, m_sock: socket) -> void
+
+    Alternative to mainLoop(), serves mon_sock and cli_sock from a single
+    event loop that hands the requests to a pool of worker threads.
+
+    """
+    opt = gdata.getCommandLineOptions()
 
-def waitThreads():
-    srvhandlers.MonitorHandler.waitAll()
-    srvhandlers.CommandHandler.waitAll()
-    
+    server = srvevents.EventLoopServer(mon_sock, cli_sock, m_sock,
+                                        opt.multicast_group,
+                                        opt.multicast_group_port,
+                                        opt.connection_timeout,
+                                        opt.worker_pool_size,
+                                        opt.worker_queue_size,
+                                        opt.data_life_time)
+    logging.info("Server running press Ctrl+C to Quit!")
 
-def setUpSockets():
-    """setUpSockets() -> tcp_socket, multicast_socket
+    try:
+        server.serveForever()
+    except KeyboardInterrupt:
+        logging.info("Finishing due to KeyboardInterrupt")
+    except Exception, e:
+        logging.critical("Finishing due to unknown exception:\n%s" % str(e))
+        if opt.debug:
+            import traceback; traceback.print_exc(sys.stderr)
+    finally:
+        logging.info("Waiting workers termination")
+        server.close()
+        logging.info("All workers terminated")
 
-    Sets up the clients connection socket and the multicast socket.
+def setUpSockets(reuse_port=False):
+    """setUpSockets(reuse_port: bool) -> tcp_socket, multicast_socket
+
+    Sets up the clients connection socket and the multicast socket. If
+    'reuse_port' the ports are shared with the other worker processes.
 
     """
     opt = gdata.getCommandLineOptions()
@@ -127,10 +406,12 @@ def setUpSockets():
 
     # Bind conn_sock
     try:
-        mon_sock = common.createServerTCPSocket(iface, opt.mon_port, queue_size)
+        mon_sock = common.createServerTCPSocket(iface, opt.mon_port,
+                                                queue_size, reuse_port)
         logging.info('Monitor socket bound to %s:%d' % (iface, opt.mon_port))
 
-        cmd_sock = common.createServerTCPSocket(iface, opt.cmd_port, queue_size)
+        cmd_sock = common.createServerTCPSocket(iface, opt.cmd_port,
+                                                queue_size, reuse_port)
         logging.info('Client socket bound to %s:%d' % (iface, opt.cmd_port))
 
         # Set multicast socket options (only send)
@@ -180,6 +461,49 @@ def checkCommandLineOptions():
             "The given multicast group is not a valid multicast ip")
         sys.exit(-1)
 
+    # Check worker pool and queue sizes
+    if opt.worker_pool_size < 1 or opt.worker_queue_size < 1:
+        logging.critical("The worker pool and queue sizes must be at least 1")
+        sys.exit(-1)
+
+    # Check history size
+    if opt.history_size < 0:
+        logging.critical("The history size can't be negative")
+        sys.exit(-1)
+
+    # Check snapshot interval
+    if opt.snapshot_interval <= 0:
+        logging.critical("The snapshot interval must be positive")
+        sys.exit(-1)
+
+    # Check fleet map interval
+    if opt.map_interval <= 0:
+        logging.critical("The map interval must be positive")
+        sys.exit(-1)
+
+    # Check relay interval, the relayed monitors expire in the upstream
+    # broker if it does not receive their batches
+    if opt.relay_interval <= 0:
+        logging.critical("The relay interval must be positive")
+        sys.exit(-1)
+
+    # Check worker processes, every one has a part of the monitors
+    if opt.processes < 1:
+        logging.critical("The number of processes must be at least 1")
+        sys.exit(-1)
+    elif opt.processes > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            logging.critical("Several processes need SO_REUSEPORT")
+            sys.exit(-1)
+        elif opt.server_engine != gdata.ENGINE_THREADS:
+            logging.critical("Several processes need the %s engine"
+                                % gdata.ENGINE_THREADS)
+            sys.exit(-1)
+        elif opt.snapshot_file or opt.map_file:
+            logging.critical("The snapshot and map files need a single "
+                                "process")
+            sys.exit(-1)
+
     # Check life time
     if opt.data_life_time < opt.connection_timeout * 2:
         logging.critical(
@@ -206,10 +530,22 @@ def printCommandLineOptions():
     logging.debug("Clients Port: " + str(o.cmd_port))
     logging.debug("Connection timeout: " + str(o.connection_timeout) )
     logging.debug("Connection queue size: " + str(o.connection_queue_size))
+    logging.debug("Server engine: " + o.server_engine)
+    logging.debug("Processes: " + str(o.processes))
+    logging.debug("Worker pool size: " + str(o.worker_pool_size))
+    logging.debug("Worker queue size: " + str(o.worker_queue_size))
     logging.debug("Multicast Group: " + o.multicast_group)
     logging.debug("Multicast Port: " + str(o.multicast_group_port))
     logging.debug("Multicast TTL: " + str(o.multicast_group_ttl))
     logging.debug("Data life time: " + str(o.data_life_time))
+    logging.debug("History size: " + str(o.history_size))
+    logging.debug("Snapshot file: " + str(o.snapshot_file))
+    logging.debug("Snapshot interval: " + str(o.snapshot_interval))
+    logging.debug("Map file: " + str(o.map_file))
+    logging.debug("Map interval: " + str(o.map_interval))
+    logging.debug("Upstream broker: %s:%d" % (o.upstream_host,
+                                                o.upstream_port))
+    logging.debug("Relay interval: " + str(o.relay_interval))
     logging.debug("Logfile: " + o.logfile.name)
 
 #
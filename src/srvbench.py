@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""srvbench.py - Load generator for the monitors interface of the broker
+
+Emulates a fleet of monitors. Every monitor registers itself once and then
+sends updates as fast as the broker answers them, opening a new connection
+for every update or, with -s, through a session like cli.AutoUpdater does.
+At the end prints the number of updates per second served by the broker.
+
+Example, comparing the two server engines:
+
+    src/srv.py -se threads          (or -se events)
+    src/srvbench.py -bhost 127.0.0.1 -bport 6666 -m 200 -j 4
+
+"""
+
+# Imports
+# -------
+
+import sys
+import zlib
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+
+import gdata
+import common
+
+
+# Functions
+# ---------
+
+def main():
+    opt = parseCommandLineOptions(sys.argv[1:])
+    xml = buildPayload(opt.processes, gdata.FMT_XML)
+    payload = buildPayload(opt.processes, opt.update_format)
+    if opt.zlib:
+        payload = zlib.compress(payload)
+
+    # Split the monitors between the processes
+    jobs = []
+    for j in xrange(opt.jobs):
+        first = j * opt.monitors / opt.jobs
+        last = (j + 1) * opt.monitors / opt.jobs
+        jobs.append( (opt.broker_host, opt.broker_port, first, last,
+                        opt.updates, xml, payload, opt.update_format,
+                        opt.zlib, opt.connection_timeout, opt.session) )
+
+    print "Payload size: %d bytes (%s%s)" % (len(payload), opt.update_format,
+                                            '+zlib' if opt.zlib else '')
+    print "Monitors: %d, updates per monitor: %d, processes: %d" \
+            % (opt.monitors, opt.updates, opt.jobs)
+
+    pool = multiprocessing.Pool(opt.jobs)
+    start = time.time()
+    results = pool.map(runMonitors, jobs)
+    elapsed = time.time() - start
+    pool.close()
+
+    conns = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    latency = sum(r[2] for r in results)
+
+    print "Elapsed: %.2fs" % elapsed
+    print "Updates: %d (errors: %d)" % (conns, errors)
+    print "Updates/s: %.1f" % (conns / elapsed)
+    if conns:
+        print "Mean latency: %.2fms" % (latency / conns * 1000)
+
+def runMonitors(job):
+    """runMonitors(job: tuple) -> (int, int, float)
+
+    Runs the monitors [first, last) of a job in threads and returns the
+    number of updates, the number of errors and the total latency.
+
+    """
+    host, port, first, last, updates, xml, payload, fmt, compress, timeout, \
+        session = job
+    results = []
+
+    threads = [ threading.Thread(target=runMonitor,
+                                 args=(host, port, gdata.SOCK_MIN_PORT + i,
+                                        updates, xml, payload, fmt, compress,
+                                        timeout, session, results))
+                for i in xrange(first, last) ]
+
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    return ( sum(r[0] for r in results), sum(r[1] for r in results),
+             sum(r[2] for r in results) )
+
+def runMonitor(host, port, lport, updates, xml, payload, fmt, compress,
+                timeout, session, results):
+    conns = 0; errors = 0; latency = 0.0
+
+    offers = [fmt, gdata.OPT_ZLIB] if compress else [fmt]
+    msg = '%c %d %s %c %s %c' % (gdata.BEL, lport, ','.join(offers),
+                                    gdata.ETX, xml, gdata.ETX)
+    try:
+        response = request(host, port, msg, 2, timeout)
+    except socket.error:
+        response = ''
+
+    if not response.startswith(gdata.K_OK):
+        results.append( (1, 1, 0.0) )
+        return
+
+    fields = response.split('\n')[1].split()
+    mid = fields[0]
+    encoding = '+'.join(offers)
+    if fields[3:] != offers:
+        results.append( (1, 1, 0.0) )  # Format not accepted by the broker
+        return
+    elif encoding == gdata.FMT_XML:
+        msg = '%c %s %c %s %c' % (gdata.SOH, mid, gdata.ETX, payload,
+                                    gdata.ETX)
+    else:
+        msg = '%c %s %s %d %c%s%c' % (gdata.SOH, mid, encoding, len(payload),
+                                        gdata.ETX, payload, gdata.ETX)
+
+    if session:
+        sock = socket.create_connection( (host, port), timeout )
+        reader = common.SocketReader(sock)
+        sock.sendall('%c %s %c' % (gdata.SYN, mid, gdata.ETX))
+        reader.recvEnd('\n\n')
+
+    for i in xrange(updates):
+        start = time.time()
+        try:
+            if session:
+                sock.sendall(msg)
+                response = reader.recvEnd('\n\n')
+            else:
+                response = request(host, port, msg, 1, timeout)
+
+            if not response.startswith(gdata.K_OK):
+                errors += 1
+        except socket.error:
+            errors += 1
+
+        latency += time.time() - start
+        conns += 1
+
+    if session:
+        sock.close()
+
+    results.append( (conns, errors, latency) )
+
+def request(host, port, msg, nresponses, timeout):
+    """request(host, port, msg, nresponses, timeout) -> str
+
+    Sends msg through a new connection and returns the first nresponses
+    responses joined.
+
+    """
+    sock = socket.create_connection( (host, port), timeout )
+    try:
+        sock.sendall(msg)
+        reader = common.SocketReader(sock)
+        return '\n\n'.join(reader.recvEnd('\n\n') for i in xrange(nresponses))
+    finally:
+        sock.close()
+
+def buildPayload(nprocs, fmt):
+    """buildPayload(nprocs: int, fmt: str) -> str
+
+    Returns a sample with nprocs running processes encoded with fmt.
+
+    """
+    dao = common.SysInfoDAO()
+    dao.setTimestamp(time.gmtime())
+    dao.setUsedCPUPercentage( (12.5, 3.0, 50.0, 7.5) )
+    dao.setCPULoadAvg( (0.5, 0.25, 0.125) )
+    dao.setTotalVirtualMemory(8 << 30)
+    dao.setUsedVirtualMemory(3 << 30)
+    dao.setFreeVirtualMemory(5 << 30)
+    dao.setAvaliableVirtualMemory(6 << 30)
+    dao.setRunningProcesses( (pid, 'process-%d' % pid)
+                                for pid in xrange(1, nprocs + 1) )
+
+    if fmt == gdata.FMT_BIN:
+        builder = common.SysInfoBinBuilder()
+        builder.setBinData(dao)
+    else:
+        builder = common.SysInfoXMLBuilder()
+        builder.setXMLData(dao)
+    return builder.getAsString()
+
+def parseCommandLineOptions(cmd_line_options):
+    parser = argparse.ArgumentParser(
+                description='Load generator for the DREMO broker')
+
+    parser.add_argument('-bhost', '--broker-host', required=True,
+            help='broker server host name/ip')
+
+    parser.add_argument('-bport', '--broker-port', required=True,
+            type=int, help='broker monitors port')
+
+    parser.add_argument('-m', '--monitors', type=int, default=100,
+            help='number of emulated monitors (default: 100)')
+
+    parser.add_argument('-u', '--updates', type=int, default=50,
+            help='updates sent by every monitor (default: 50)')
+
+    parser.add_argument('-p', '--processes', type=int, default=300,
+            help='running processes of every sample (default: 300)')
+
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+            help='client processes generating the load (default: 2)')
+
+    parser.add_argument('-s', '--session', action='store_true', default=False,
+            help='send the updates of every monitor through a session')
+
+    parser.add_argument('-uf', '--update-format', default=gdata.FMT_XML,
+            choices=gdata.UPDATE_FORMATS,
+            help='encoding of the updates (default: %s)' % gdata.FMT_XML)
+
+    parser.add_argument('-z', '--zlib', action='store_true', default=False,
+            help='send the updates compressed with zlib')
+
+    parser.add_argument('-cto', '--connection-timeout', type=float,
+            default=10.0, help='connection timeout (default: 10)')
+
+    return parser.parse_args(cmd_line_options)
+
+#
+#
+if __name__ == '__main__':
+    main()
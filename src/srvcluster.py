@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""srvcluster.py - Broker split in several worker processes
+
+With -np N the broker runs N worker processes sharing the monitors and
+commands ports (SO_REUSEPORT), the kernel spreads the connections among
+them. Every monitor belongs to one worker, chosen by its id, that keeps its
+data in its own srvdata. A worker accepting a connection of a monitor owned
+by another one peeks its first frame and hands the socket over to the owner,
+passing its descriptor through a Unix datagram socket.
+
+The commands are answered by any worker with the queries of this module,
+they ask the owner of a monitor or all the workers (through a Unix socket
+listened by every worker) and merge their answers. With a single process
+they just call srvdata.
+
+"""
+
+# Imports
+# -------
+
+import os
+import time
+import zlib
+import socket
+import struct
+import common
+import shutil
+import marshal
+import logging
+import srvdata
+import srvfleet
+import tempfile
+import threading
+import _multiprocessing
+
+# Data
+# ----
+
+worker = 0          # Index of this process
+workers = 1         # Number of worker processes
+
+# Seconds waiting for the answer of a worker
+QUERY_TIMEOUT = 30.0
+
+# Threads answering the queries of the other workers, the rest wait in the
+# backlog of the queries socket
+QUERY_THREADS = 4
+
+# Seconds between the peeks of a first frame not fully received
+PEEK_DELAY = 0.001
+
+_handoff_socks = [ ]    # (receiving, sending) Unix sockets of every worker
+_queries_dir = None     # Directory of the queries sockets
+
+_frame_size = struct.Struct('!I')
+
+# Queries answered to the other workers
+_QUERIES = dict( (f.__name__, f) for f in (
+                    srvdata.existsMonitorData, srvdata.keepAliveMonitor,
+                    srvdata.getMonitorAddress, srvdata.getMonitorXML,
+                    srvdata.getMonitorHistory, srvdata.getListOfMonitors,
+                    srvdata.getAllMonitorsXML, srvdata.getMetricValues,
+                    srvdata.getTopMonitors, srvdata.findProcess) )
+
+# Errors of the queries raised again in the worker asking them
+_ERRORS = { 'ValueError' : ValueError, 'KeyError' : KeyError }
+
+# Functions
+# ---------
+
+def createCluster(nworkers):
+    """createCluster(nworkers: int) -> void
+
+    Creates the channels between nworkers processes, must be called before
+    starting them.
+
+    """
+    global workers, _handoff_socks, _queries_dir
+
+    workers = nworkers
+    _handoff_socks = [ socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                        for i in xrange(nworkers) ]
+    _queries_dir = tempfile.mkdtemp(prefix='dremo-')
+
+def destroyCluster():
+    """destroyCluster() -> void
+
+    Removes the channels between the processes, once they have finished.
+
+    """
+    for receiving, sending in _handoff_socks:
+        receiving.close()
+        sending.close()
+    shutil.rmtree(_queries_dir, True)
+
+def initWorker(index):
+    """initWorker(index: int) -> void
+
+    Sets up the process of the worker index, in the worker process, and
+    starts answering the queries of the other workers.
+
+    """
+    global worker
+    worker = index
+
+    for i, (receiving, sending) in enumerate(_handoff_socks):
+        if i != index:
+            receiving.close()
+
+    server = _QueriesServer(_queryPath(index))
+    server.start()
+
+def ownerOf(mid):
+    """ownerOf(mid: str) -> int
+
+    Returns the index of the worker owning the monitor mid.
+
+    """
+    return (zlib.crc32(mid) & 0xffffffff) % workers
+
+def isLocal(mid):
+    """isLocal(mid: str) -> bool
+
+    Tests if the monitor mid belongs to this process.
+
+    """
+    return workers == 1 or ownerOf(mid) == worker
+
+def handOff(sock, mid):
+    """handOff(sock: socket, mid: str) -> void
+
+    Passes the connection sock of the monitor mid to its owner, the caller
+    must close its sock afterwards.
+
+    """
+    _multiprocessing.sendfd(_handoff_socks[ownerOf(mid)][1].fileno(),
+                            sock.fileno())
+
+def handOffFileno():
+    """handOffFileno() -> int
+
+    Returns the descriptor readable when another worker hands over a
+    connection, see receiveHandOff().
+
+    """
+    return _handoff_socks[worker][0].fileno()
+
+def receiveHandOff():
+    """receiveHandOff() -> socket
+
+    Returns the next connection handed over by another worker.
+
+    """
+    fd = _multiprocessing.recvfd(handOffFileno())
+    try:
+        return socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    finally:
+        os.close(fd)
+
+def peekFrame(sock, end, size):
+    """peekFrame(sock: socket, end: str, size: int) -> str
+
+    Returns the first frame received by sock, until the delimiter end or at
+    most size bytes, without removing it from the socket. Waits up to the
+    timeout of sock.
+
+    """
+    deadline = time.time() + (sock.gettimeout() or 0.0)
+
+    while True:
+        data = sock.recv(size, socket.MSG_PEEK)
+        if not data or end in data or len(data) >= size or \
+                time.time() > deadline:
+            return data
+        time.sleep(PEEK_DELAY)
+
+def existsMonitorData(mid):
+    """existsMonitorData(mid: str) -> bool
+
+    See srvdata.existsMonitorData(), asked to the owner of the monitor.
+
+    """
+    return _query(ownerOf(mid), 'existsMonitorData', mid)
+
+def keepAliveMonitor(mid):
+    """keepAliveMonitor(mid: str) -> void
+
+    See srvdata.keepAliveMonitor(), asked to the owner of the monitor.
+
+    """
+    _query(ownerOf(mid), 'keepAliveMonitor', mid)
+
+def getMonitorAddress(mid):
+    """getMonitorAddress(mid: str) -> str, str
+
+    See srvdata.getMonitorAddress(), asked to the owner of the monitor.
+
+    """
+    return _query(ownerOf(mid), 'getMonitorAddress', mid)
+
+def getMonitorXML(mid, sections=None):
+    """getMonitorXML(mid: str, sections: tuple) -> str, str, str
+
+    See srvdata.getMonitorXML(), asked to the owner of the monitor.
+
+    """
+    return _query(ownerOf(mid), 'getMonitorXML', mid, sections)
+
+def getMonitorHistory(mid, seconds=None):
+    """getMonitorHistory(mid: str, seconds: float) -> int, [ (tuple, tuple) ]
+
+    See srvdata.getMonitorHistory(), asked to the owner of the monitor.
+
+    """
+    return _query(ownerOf(mid), 'getMonitorHistory', mid, seconds)
+
+def getListOfMonitors():
+    """getListOfMonitors() -> [str]
+
+    See srvdata.getListOfMonitors(), the monitors of all the workers.
+
+    """
+    return _concat(_gather('getListOfMonitors'))
+
+def getAllMonitorsXML(sections=None):
+    """getAllMonitorsXML(sections: tuple) -> [ (str, str, str) ]
+
+    See srvdata.getAllMonitorsXML(), the monitors of all the workers.
+
+    """
+    return _concat(_gather('getAllMonitorsXML', sections))
+
+def findProcess(name):
+    """findProcess(name: str) -> [ (str, str, str, [int]) ]
+
+    See srvdata.findProcess(), the monitors of all the workers.
+
+    """
+    return _concat(_gather('findProcess', name))
+
+def aggregateMonitorsData(metric, func):
+    """aggregateMonitorsData(metric: str, func: str) -> float, int
+
+    See srvdata.aggregateMonitorsData(), over the values of all the workers.
+
+    """
+    if workers == 1:
+        return srvdata.aggregateMonitorsData(metric, func)
+
+    values = _concat(_gather('getMetricValues', metric))
+    return srvfleet.aggregateValues(values, func)
+
+def getTopMonitors(metric, n):
+    """getTopMonitors(metric: str, n: int) -> [ (str, str, str, float) ]
+
+    See srvdata.getTopMonitors(), the highest of the tops of all the workers.
+
+    """
+    topl = _concat(_gather('getTopMonitors', metric, n))
+    topl.sort(key=lambda mtop: (mtop[3], mtop[0]), reverse=True)
+    return topl[:n]
+
+# Joins the lists answered by the workers
+def _concat(answers):
+    if len(answers) == 1:
+        return answers[0]
+
+    joined = []
+    for answer in answers:
+        joined.extend(answer)
+    return joined
+
+# Answer of a query to a worker
+def _query(index, name, *args):
+    if index == worker:
+        return _QUERIES[name](*args)
+
+    sock = _sendQuery(index, name, args)
+    try:
+        return _recvAnswer(sock)
+    finally:
+        sock.close()
+
+# Answers of a query to all the workers, in their order. All of them are
+# asked before waiting for the first answer
+def _gather(name, *args):
+    if workers == 1:
+        return [ _QUERIES[name](*args) ]
+
+    socks = {}
+    try:
+        for index in xrange(workers):
+            if index != worker:
+                socks[index] = _sendQuery(index, name, args)
+
+        return [ _QUERIES[name](*args) if index == worker else
+                    _recvAnswer(socks[index]) for index in xrange(workers) ]
+    finally:
+        for sock in socks.itervalues():
+            sock.close()
+
+def _sendQuery(index, name, args):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(QUERY_TIMEOUT)
+        sock.connect(_queryPath(index))
+        _sendFrame(sock, marshal.dumps( (name, args) ))
+    except:
+        sock.close()
+        raise
+    return sock
+
+# Raises the errors of the query again, an IOError if it is unknown
+def _recvAnswer(sock):
+    error, result = marshal.loads(_recvFrame(common.SocketReader(sock)))
+    if error is not None:
+        raise _ERRORS.get(error[0], IOError)(error[1])
+    return result
+
+def _sendFrame(sock, data):
+    sock.sendall(_frame_size.pack(len(data)) + data)
+
+# Raises IOError if the connection is closed before the whole frame
+def _recvFrame(reader):
+    head = reader.recvSize(_frame_size.size)
+    if len(head) == _frame_size.size:
+        size = _frame_size.unpack(head)[0]
+        data = reader.recvSize(size)
+        if len(data) == size:
+            return data
+    raise IOError("Connection closed by the worker")
+
+def _queryPath(index):
+    return os.path.join(_queries_dir, 'w%d' % index)
+
+#
+## Answers the queries of the other workers with its own fixed set of threads,
+## so they never wait for the workers pool
+class _QueriesServer(object):
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(socket.SOMAXCONN)
+
+    def start(self):
+        for i in xrange(QUERY_THREADS):
+            answerer = threading.Thread(target=self._serve)
+            answerer.daemon = True
+            answerer.start()
+
+    def _serve(self):
+        while True:
+            ns, addr = self.sock.accept()
+            try:
+                self._answer(ns)
+            except Exception, e:
+                logging.error("Unhandled exception answering a query: %s"
+                                % str(e))
+
+    def _answer(self, sock):
+        try:
+            sock.settimeout(QUERY_TIMEOUT)
+            name, args = marshal.loads(_recvFrame(common.SocketReader(sock)))
+
+            try:
+                answer = (None, _QUERIES[name](*args))
+            except (ValueError, KeyError), e:
+                answer = ( (e.__class__.__name__, str(e)), None )
+            except Exception, e:
+                logging.error("Query %s failed: %s" % (name, str(e)))
+                answer = ( ('Exception', str(e)), None )
+
+            _sendFrame(sock, marshal.dumps(answer))
+        except IOError, e:
+            logging.warning("Error answering a query: %s" % str(e))
+        finally:
+            sock.close()
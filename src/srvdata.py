@@ -4,10 +4,15 @@
 # -------
 
 import time
+import heapq
+import gdata
 import common
 import hashlib
 import logging
 import threading
+import srvfleet
+import srvprocs
+import srvhistory
 
 # Data
 # ----
@@ -17,55 +22,177 @@ K_IP = 0
 K_PORT = 1
 K_SYSINFO = 2
 K_TIMESTAMP = 3
-K_RWLOCK = 4
+K_LOCK = 4          # Serializes the writers of the monitor data
+K_XML = 5           # (sysinfodao, { sections -> xml }) last sysinfodao
+                    # serialized as XML, sections None for the whole XML
+K_HISTORY = 6       # MetricsHistory of the last samples, None if disabled
 
-# Contains monitor information { id -> (ip, port, sysinfodao, time, rwlock) }
-monitor_db = { }
-# Exclusive acces to modify monitor_db
-monitor_db_lock = common.ReadWriteLock()
+# Number of partitions of the monitors DB, every one with its own locks
+DB_SHARDS = 16
+
+# Minimum time between two runs of the DBGarbageCollector
+MIN_GC_TIME = 0.1
+
+#
+## Partition of the monitors DB, the monitors are assigned by the hash of
+## their id.
+##
+## The db dict is a published snapshot that is never modified, so readers use
+## it without locks. Writers build a new version and replace the reference.
+class _Shard(object):
+
+    def __init__(self):
+        # Contains monitor information 
+        # { id -> [ip, port, sysinfodao, time, lock, (sysinfodao, xmls),
+        #          history] }
+        self.db = { }
+        # Exclusive acces to replace db
+        self.lock = threading.Lock()
+
+        # Expiry index, heap of (time, id, monitor data) with one entry per
+        # monitor. Keep-alives don't touch it, the time of an entry is
+        # refreshed when it reaches the top of the heap and the monitor has
+        # been kept alive since
+        self.expiry = [ ]
+        # Exclusive access to expiry, acquired after lock if both
+        self.expiry_lock = threading.Lock()
+
+monitor_db_shards = [ _Shard() for i in xrange(DB_SHARDS) ]
+
+# Latest metrics of all the monitors by columns, for the aggregate queries
+fleet_metrics = srvfleet.FleetMetrics()
+
+# Monitors running every process name, the owner of the entries of a monitor
+# is its data list
+process_index = srvprocs.ProcessIndex()
 
 # Functions
 # ---------
 
-def initializeNewMonitorData(ip, port):
-    """initializeNewMonitorData(ip: str, port: str) -> str
+def initializeNewMonitorData(ip, port, history_size=gdata.DEF_HISTORY_SIZE):
+    """initializeNewMonitorData(ip: str, port: str, history_size: int) -> str
 
     Generates a monitor id with the given ip and port and initializes an 
-    entry in the internal db for this new monitor id.
+    entry in the internal db for this new monitor id, keeping the metrics of
+    its last history_size updates.
 
     Returns the generated monitor id.
 
+    """
+    mid = monitorId(ip, port)
+
+    history = srvhistory.MetricsHistory(history_size) if history_size else None
+    mdata = [ip, port, None, time.time(), threading.Lock(), None, history]
+    _addMonitor(mid, mdata)
+
+    return mid
+
+def monitorId(ip, port):
+    """monitorId(ip: str, port: str) -> str
+
+    Returns the id of the monitor listening in the given ip and port.
+
     """
     common.assertType(ip, str, "Expected ip to be a string value")
     common.assertType(port, str, "Expected port to be a string value")
 
-    sha256 = hashlib.sha256()   
+    sha256 = hashlib.sha256()
     sha256.update(ip)
     sha256.update(port)
-    mid = sha256.hexdigest()
+    return sha256.hexdigest()
 
-    monitor_db_lock.acquireWrite()
-    monitor_db[mid] = [ip, port, None, time.time(), common.ReadWriteLock()]
-    monitor_db_lock.release()
+def restoreMonitorData(mid, ip, port, sinfodao,
+                        history_size=gdata.DEF_HISTORY_SIZE):
+    """restoreMonitorData(mid: str, ip: str, port: str, sinfodao: SysInfoDAO,
+                            history_size: int) -> void
 
-    return mid
+    Adds a monitor saved by a previous run of the broker (see srvsnapshot)
+    or relayed by a child broker (see srvrelay) with its last data, the
+    monitor keeps its id. Its history starts empty.
+
+    """
+    common.assertType(mid, str, "Expected monitor id to be a string value")
+    common.assertType(sinfodao, common.SysInfoDAO, "Expected SysInfoDAO")
+
+    history = srvhistory.MetricsHistory(history_size) if history_size else None
+    mdata = [ip, port, sinfodao, time.time(), threading.Lock(), None, history]
+    _addMonitor(mid, mdata)
+
+    mdata[K_LOCK].acquire()
+    if _getShard(mid).db.get(mid) is mdata:
+        fleet_metrics.update(mid, sinfodao)
+        process_index.update(mid, mdata, sinfodao.getRunningProcesses(),
+                                sinfodao.getRunningProcesses(), ())
+    mdata[K_LOCK].release()
+
+# Publish the data of a new monitor, replacing the one with the same id
+def _addMonitor(mid, mdata):
+    shard = _getShard(mid)
 
+    shard.lock.acquire()
+    old = shard.db.get(mid)
+    db = dict(shard.db)
+    db[mid] = mdata
+    shard.db = db
+    _pushExpiry(shard, mid, mdata)
+    shard.lock.release()
+
+    if old is not None:
+        _unindexMonitor(mid, old)   # Data of a previous registration
 
 def updateMonitorData(mid, sinfodao):
-    """updateMonitorData(mid: str, sinfodao: SysInfoDAO) -> void
+    """updateMonitorData(mid: str, sinfodao: SysInfoDAO) -> bool
 
     Updates the information of the specified client.
 
+    If sinfodao only carries the started and finished processes they are 
+    applied to the stored running processes, which requires that sinfodao
+    follows the stored data. Otherwise nothing is updated and False is
+    returned, the monitor must send all its running processes.
+
     """
     common.assertType(mid, str, "Expeced monitor id to be a string value")
     common.assertType(sinfodao, common.SysInfoDAO, "Expected SysInfoDAO")
 
     mdata = _getMonitor(mid)
 
-    mdata[K_RWLOCK].acquireWrite()
-    mdata[K_SYSINFO] = sinfodao
-    mdata[K_TIMESTAMP] = time.time()
-    mdata[K_RWLOCK].release()
+    mdata[K_LOCK].acquire()
+    try:
+        last = mdata[K_SYSINFO]
+        running = last.getRunningProcesses() if last else frozenset()
+
+        # Processes really started and finished since the stored data
+        if sinfodao.isProcessesDelta():
+            if not last or not last.getSequence() or \
+                    last.getSequence() + 1 != sinfodao.getSequence():
+                return False
+
+            started = sinfodao.getStartedProcesses() - running
+            finished = ( (running & sinfodao.getFinishedProcesses()) -
+                            sinfodao.getStartedProcesses() )
+            sinfodao.setRunningProcesses( (running - finished) | started )
+            sinfodao.setProcessesDelta(False)
+        else:
+            started = sinfodao.getRunningProcesses() - running
+            finished = running - sinfodao.getRunningProcesses()
+
+        mdata[K_SYSINFO] = sinfodao
+        mdata[K_XML] = None
+        mdata[K_TIMESTAMP] = time.time()
+
+        if mdata[K_HISTORY] is not None:
+            mdata[K_HISTORY].append(mdata[K_TIMESTAMP], sinfodao)
+
+        # Unless the monitor has been dropped meanwhile, its indexed data is
+        # removed with its lock held
+        if _getShard(mid).db.get(mid) is mdata:
+            fleet_metrics.update(mid, sinfodao)
+            process_index.update(mid, mdata, sinfodao.getRunningProcesses(),
+                                    started, finished)
+    finally:
+        mdata[K_LOCK].release()
+
+    return True
 
 def getMonitorData(mid):
     """getMonitorData(mid: str) -> SysInfoDAO, str, str
@@ -80,13 +207,96 @@ def getMonitorData(mid):
 
     mdata = _getMonitor(mid)
 
-    mdata[K_RWLOCK].acquireRead()
-    sinfodao = mdata[K_SYSINFO]
-    port = mdata[K_PORT]
-    ip = mdata[K_IP]
-    mdata[K_RWLOCK].release()
+    return mdata[K_SYSINFO], mdata[K_IP], mdata[K_PORT]
+
+def getMonitorAddress(mid):
+    """getMonitorAddress(mid: str) -> str, str
+
+    Returns the ip and port of a monitor or raises a KeyError exception if
+    it does not exist.
+
+    """
+    common.assertType(mid, str, "Expected monitor id to be a string value")
+
+    mdata = _getMonitor(mid)
+    return mdata[K_IP], mdata[K_PORT]
+
+def getMonitorHistory(mid, seconds=None):
+    """getMonitorHistory(mid: str, seconds: float) -> int, [ (tuple, tuple) ]
+
+    Returns the metrics of the updates of a monitor received in the last
+    'seconds' (all the stored ones if None) or raises a KeyError exception
+    if the monitor does not exist. See MetricsHistory.getSamples().
+
+    Returns the number of CPUs and the list of samples.
+
+    """
+    common.assertType(mid, str, "Expected monitor id to be a string value")
+
+    mdata = _getMonitor(mid)
+    since = time.time() - seconds if seconds is not None else None
+
+    if mdata[K_HISTORY] is None:
+        return 0, []
+
+    mdata[K_LOCK].acquire()
+    try:
+        return mdata[K_HISTORY].getSamples(since)
+    finally:
+        mdata[K_LOCK].release()
+
+def aggregateMonitorsData(metric, func):
+    """aggregateMonitorsData(metric: str, func: str) -> float, int
+
+    Computes an aggregate function of the latest value of a metric of all
+    the monitors, see FleetMetrics.aggregate().
+
+    Returns the value (None without monitors) and the number of monitors.
+
+    """
+    return fleet_metrics.aggregate(metric, func)
+
+def getMetricValues(metric):
+    """getMetricValues(metric: str) -> [float]
+
+    Returns the latest value of a metric of all the monitors, see
+    FleetMetrics.values().
+
+    """
+    return fleet_metrics.values(metric)
+
+def getTopMonitors(metric, n):
+    """getTopMonitors(metric: str, n: int) -> [ (str, str, str, float) ]
 
-    return sinfodao, ip, port
+    Returns the n monitors with the highest latest value of a metric, the
+    highest first, see FleetMetrics.top().
+
+    Returns a list of tuples with (mid, ip, port, value)
+
+    """
+    topl = []
+    for mid, value in fleet_metrics.top(metric, n):
+        mdata = _getShard(mid).db.get(mid)
+        if mdata is not None:           # Unless dropped meanwhile
+            topl.append( (mid, mdata[K_IP], mdata[K_PORT], value) )
+
+    return topl
+
+def findProcess(name):
+    """findProcess(name: str) -> [ (str, str, str, [int]) ]
+
+    Returns the monitors running a process called name.
+
+    Returns a list of tuples with (mid, ip, port, pids)
+
+    """
+    found = []
+    for mid, pids in process_index.find(name):
+        mdata = _getShard(mid).db.get(mid)
+        if mdata is not None:           # Unless dropped meanwhile
+            found.append( (mid, mdata[K_IP], mdata[K_PORT], pids) )
+
+    return found
 
 def getAllMonitorsData():
     """getAllMonitorsData() -> [ (SysInfoDAO, str, str) ]
@@ -96,22 +306,74 @@ def getAllMonitorsData():
     Returns a list of tuples with (SysInfoDAO, ip, port)
 
     """
-    monitor_db_lock.acquireRead()
-    mdatal = [ (v[K_SYSINFO], v[K_IP], v[K_PORT])
-                    for k, v in monitor_db.iteritems() ]
-    monitor_db_lock.release()
+    mdatal = []
+    for shard in monitor_db_shards:
+        mdatal.extend( (v[K_SYSINFO], v[K_IP], v[K_PORT])
+                        for v in shard.db.itervalues() )
 
     return mdatal
 
+def getMonitorXML(mid, sections=None):
+    """getMonitorXML(mid: str, sections: tuple) -> str, str, str
+
+    Returns the stored data of a monitor serialized as XML or raises a
+    KeyError exception if the monitor does not exist. The XML is built on
+    the first request after every update and reused by the next ones.
+
+    If sections is given only those XML sections are serialized, see
+    SysInfoXMLBuilder.setXMLData(). Every projection is cached on its own,
+    so the same sections should always be given in the same order.
+
+    Returns the tuple (xml, ip, port), xml is None if there isn't any data.
+
+    """
+    common.assertType(mid, str, "Expected monitor id to be a string value")
+
+    mdata = _getMonitor(mid)
+
+    return _getXML(mdata, sections), mdata[K_IP], mdata[K_PORT]
+
+def getAllMonitorsState():
+    """getAllMonitorsState() -> [ (str, SysInfoDAO, str, str, float) ]
+
+    Returns the id, data, ip, port and time of the last update or keep alive
+    of all the monitors on the DB, the data is None until the first update.
+
+    Returns a list of tuples with (mid, SysInfoDAO, ip, port, time)
+
+    """
+    statel = []
+    for shard in monitor_db_shards:
+        statel.extend( (mid, v[K_SYSINFO], v[K_IP], v[K_PORT], v[K_TIMESTAMP])
+                        for mid, v in shard.db.iteritems() )
+
+    return statel
+
+def getAllMonitorsXML(sections=None):
+    """getAllMonitorsXML(sections: tuple) -> [ (str, str, str) ]
+
+    Returns a list with the data of all the monitors on the DB serialized as
+    XML, see getMonitorXML(). Monitors without data are left out.
+
+    Returns a list of tuples with (xml, ip, port)
+
+    """
+    xmll = []
+    for shard in monitor_db_shards:
+        xmll.extend( (_getXML(mdata, sections), mdata[K_IP], mdata[K_PORT])
+                        for mdata in shard.db.itervalues() )
+
+    return [ mxml for mxml in xmll if mxml[0] is not None ]
+
 def getListOfMonitors():
     """getListOfMonitors() -> [str]
 
     Returns a list filled with the id of all the stored monitors.
 
     """
-    monitor_db_lock.acquireRead()
-    midlist = [k for k in monitor_db.iterkeys()]
-    monitor_db_lock.release()
+    midlist = []
+    for shard in monitor_db_shards:
+        midlist.extend(shard.db.iterkeys())
 
     return midlist
 
@@ -123,11 +385,7 @@ def keepAliveMonitor(mid):
     """
     common.assertType(mid, str, "Expected monitor id to be a string value")
 
-    mdata = _getMonitor(mid)
-
-    mdata[K_RWLOCK].acquireWrite()
-    mdata[K_TIMESTAMP] = time.time()
-    mdata[K_RWLOCK].release()
+    _getMonitor(mid)[K_TIMESTAMP] = time.time()
 
 def existsMonitorData(mid):
     """existsMonitorData(mid: str) -> bool
@@ -137,38 +395,144 @@ def existsMonitorData(mid):
     """
     common.assertType(mid, str, "Expected monitor id to be a string value")
 
-    monitor_db_lock.acquireRead()
-    ret = mid in monitor_db
-    monitor_db_lock.release()
+    return mid in _getShard(mid).db
 
-    return ret
+# Get the shard of a monitor
+def _getShard(mid):
+    return monitor_db_shards[hash(mid) % DB_SHARDS]
 
 # Get an internal reference to a monitor data
 def _getMonitor(mid):
+    return _getShard(mid).db[mid]
+
+# Get the cached XML of some sections of a monitor data, building it if
+# needed. The dict of cached XMLs is copied to add one
+def _getXML(mdata, sections=None):
+    sinfodao = mdata[K_SYSINFO]
+    cached = mdata[K_XML]
 
-    monitor_db_lock.acquireRead()
-    mdata = monitor_db[mid]
-    monitor_db_lock.release()
+    if cached and cached[0] is sinfodao and sections in cached[1]:
+        return cached[1][sections]
+    elif not sinfodao:
+        return None
 
-    return mdata
+    xmlbuilder = common.SysInfoXMLBuilder()
+    xmlbuilder.setXMLData(sinfodao, sections=sections)
+    xml = xmlbuilder.getAsString()
+
+    # Don't cache it if the data has been updated meanwhile
+    mdata[K_LOCK].acquire()
+    if mdata[K_SYSINFO] is sinfodao:
+        cached = mdata[K_XML]
+        xmls = dict(cached[1]) if cached and cached[0] is sinfodao else {}
+        xmls[sections] = xml
+        mdata[K_XML] = (sinfodao, xmls)
+    mdata[K_LOCK].release()
+
+    return xml
+
+def removeMonitorData(mid):
+    """removeMonitorData(mid: str) -> void
+
+    Removes the data of a monitor from the DB, if it exists.
+
+    """
+    shard = _getShard(mid)
+
+    shard.lock.acquire()
+    mdata = shard.db.get(mid)
+    if mdata is not None:
+        db = dict(shard.db)
+        del db[mid]
+        shard.db = db
+    shard.lock.release()
+
+    if mdata is not None:
+        _unindexMonitor(mid, mdata)
+        logging.debug("Droped data of: %s" % mid)
 
 def removeOldMonitorData(max_time):
-    """removeOldMonitorData(max_time: float) -> void
+    """removeOldMonitorData(max_time: float) -> float
 
     Remove data in the monitor's DB older than max_time seconds.
 
-    """
-    monitor_db_lock.acquireWrite()
-    cur_time = time.time()
+    Only the monitors at the top of the expiry indexes are checked and every
+    shard is locked just to publish a version without its expired monitors.
 
-    for mid in monitor_db.keys():
-        if cur_time - monitor_db[mid][K_TIMESTAMP] > max_time:
-            del monitor_db[mid]
-            logging.debug("Droped data of: %s" % mid)
-    monitor_db_lock.release()
+    Returns the seconds until the next monitor data could get old.
+
+    """
+    limit = time.time() - max_time
+    oldest = None
+
+    for shard in monitor_db_shards:
+        stamp = _removeOldShardData(shard, limit)
+        if stamp is not None and (oldest is None or stamp < oldest):
+            oldest = stamp
+
+    if oldest is None:
+        return max_time
+
+    return max(oldest + max_time - time.time(), 0.0)
+
+# Remove the data of a shard older than limit, returns the oldest time in
+# its expiry index (None if it is empty)
+def _removeOldShardData(shard, limit):
+    expired = []
+
+    shard.expiry_lock.acquire()
+    while shard.expiry and shard.expiry[0][0] < limit:
+        stamp, mid, mdata = heapq.heappop(shard.expiry)
+
+        if shard.db.get(mid) is not mdata:
+            continue                    # Replaced by a new registration
+        elif mdata[K_TIMESTAMP] < limit:
+            expired.append( (mid, mdata) )
+        else:
+            heapq.heappush(shard.expiry, (mdata[K_TIMESTAMP], mid, mdata))
+    shard.expiry_lock.release()
+
+    if expired:
+        shard.lock.acquire()
+        db = dict(shard.db)
+        for mid, mdata in expired:
+            if db.get(mid) is not mdata:
+                continue
+            elif mdata[K_TIMESTAMP] < limit:
+                del db[mid]
+                logging.debug("Droped data of: %s" % mid)
+            else:
+                _pushExpiry(shard, mid, mdata) # Kept alive meanwhile
+        shard.db = db
+        shard.lock.release()
+
+        for mid, mdata in expired:
+            if mid not in db:
+                _unindexMonitor(mid, mdata)
+
+    shard.expiry_lock.acquire()
+    oldest = shard.expiry[0][0] if shard.expiry else None
+    shard.expiry_lock.release()
+
+    return oldest
+
+# Remove the data of a dropped monitor from the fleet indexes
+def _unindexMonitor(mid, mdata):
+    mdata[K_LOCK].acquire()
+    fleet_metrics.remove(mid)
+    process_index.remove(mid, mdata)
+    mdata[K_LOCK].release()
+
+# Add a monitor to the expiry index of its shard
+def _pushExpiry(shard, mid, mdata):
+
+    shard.expiry_lock.acquire()
+    heapq.heappush(shard.expiry, (mdata[K_TIMESTAMP], mid, mdata))
+    shard.expiry_lock.release()
 
 #
-## Cleans the database every data life time
+## Cleans the database when the monitors data gets old, sleeping until the
+## next monitor data could expire but at most gc_time
 class DBGarbageCollector(threading.Thread):
 
     def __init__(self, gc_time, data_life_time):
@@ -184,15 +548,17 @@ class DBGarbageCollector(threading.Thread):
     def run(self):
 
         self._setRunState()
+        wait = min(self._data_time, self._gc_time)
 
         self._mutex.acquire() # lock and check active state
         while self._active:
             self._mutex.release() # unlock and wait
 
-            if self._awakener.wait(self._gc_time):
+            if self._awakener.wait(wait):
                 self._awakener.clear()  # Resets the internal flag
 
-            removeOldMonitorData(self._data_time)
+            wait = removeOldMonitorData(self._data_time)
+            wait = min(max(wait, MIN_GC_TIME), self._gc_time)
 
             self._mutex.acquire() # lock to check the active state
 
@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+"""srvevents.py - Event loop engine of the broker
+
+A single thread multiplexes all the monitor and command connections with
+poll() (select() where poll is not available). Complete requests are
+executed by a WorkerPool, so the XML parsing and the connections to the
+monitors never block the loop, and the results are written back by the
+loop once the workers hand them over.
+
+"""
+
+# Imports
+# -------
+
+import time
+import errno
+import Queue
+import socket
+import logging
+
+import gdata
+import common
+import helper
+import srvpool
+import srvhandlers
+
+# Maximum time blocked waiting for events, bounds the timeouts detection delay
+POLL_INTERVAL = 0.5
+
+# Blocks of a streamed response produced ahead of the ones sent
+STREAM_BLOCKS = 4
+
+# Errors meaning that a non-blocking operation must be retried later
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Classes
+# -------
+
+class EventLoopServer(object):
+
+    def __init__(self, mon_sock, cmd_sock, m_sock, mg_ip, mg_port, timeout,
+                    workers, queue_size=0, session_timeout=None):
+        self.mon_sock = mon_sock
+        self.cmd_sock = cmd_sock
+        self.m_sock = m_sock
+        self.mg_ip = mg_ip
+        self.mg_port = mg_port
+        self.timeout = timeout
+        self.session_timeout = session_timeout or timeout
+
+        self._pool = srvpool.WorkerPool(workers, queue_size)
+        self._poller = common.Poller()
+        self._conns = {}                # fileno -> _Connection
+        self._results = Queue.Queue()   # (connection, response) from workers
+        self._ready = Queue.Queue()     # Connections with new streamed blocks
+        self._wake_r, self._wake_w = common.createWakeUpPair()
+        self._next_check = 0.0          # Time of the next timeouts check
+
+    def serveForever(self):
+        """serveForever() -> void
+
+        Runs the event loop until an exception (KeyboardInterrupt) stops it.
+
+        """
+        self._pool.start()
+
+        for s in (self.mon_sock, self.cmd_sock, self._wake_r):
+            s.setblocking(0)
+            self._poller.register(s.fileno())
+
+        listeners = { self.mon_sock.fileno() : self._acceptMonitor,
+                      self.cmd_sock.fileno() : self._acceptCommand }
+        wake_fd = self._wake_r.fileno()
+
+        while True:
+            for fd, readable, writable in self._poller.poll(POLL_INTERVAL):
+                if fd in listeners:
+                    self._accept(fd, listeners[fd])
+                elif fd == wake_fd:
+                    self._drainWakeUp()
+                else:
+                    conn = self._conns.get(fd)
+                    if conn and readable: self._read(conn)
+                    if conn and writable: self._write(conn)
+
+            self._dispatchResults()
+            self._checkTimeouts()
+
+    def close(self):
+        """close() -> void
+
+        Closes all the client connections and waits the termination of the
+        running jobs.
+
+        """
+        for conn in self._conns.values():
+            self.closeConnection(conn)
+        self._pool.stop()
+
+        self._wake_r.close()
+        self._wake_w.close()
+
+    # Called from the worker threads. The streamed responses are produced
+    # here (compressed or not) a few blocks ahead of the loop, which only
+    # sends them
+    def _execute(self, conn, func, args):
+        try:
+            msg = func(*args)
+        except Exception, e:
+            logging.error("Error processing request from %s:%d: %s"
+                            % (conn.addr[0], conn.addr[1], str(e)) )
+            msg = helper.getGenericError(str(e))
+
+        if msg is None or isinstance(msg, str):
+            self._post(self._results, (conn, msg))
+            return
+
+        stream = _Stream(STREAM_BLOCKS)
+        self._post(self._results, (conn, stream))
+        try:
+            for block in msg:
+                if not stream.put(block):
+                    return      # Connection closed, stop producing
+                self._post(self._ready, conn)
+            stream.put(_Stream.END)
+        except Exception, e:
+            logging.error("Error streaming response to %s:%d: %s"
+                            % (conn.addr[0], conn.addr[1], str(e)) )
+            stream.put(_Stream.ABORT)
+        self._post(self._ready, conn)
+
+    def _post(self, queue, item):
+        queue.put(item)
+        try:
+            self._wake_w.send('x')
+        except socket.error:
+            pass    # The loop is already awake
+
+    def submit(self, conn, func, *args):
+        try:
+            self._pool.submit(self._execute, conn, func, args)
+            conn.busy = True
+        except Queue.Full:
+            logging.warning("Workers queue full, rejected %s:%d" % conn.addr)
+            conn.reply(helper.getBusyError("Server busy, try again later"),
+                        True)
+
+    def send(self, conn, msg):
+        conn.outbuf.append(msg)
+        self._poller.modify(conn.fileno, write=True)
+
+    def _accept(self, fd, createfunc):
+        lsock = self.mon_sock if fd == self.mon_sock.fileno() else self.cmd_sock
+
+        while True:
+            try:
+                ns, addr = lsock.accept()
+            except socket.error, e:
+                if e.args[0] in _RETRY_ERRNOS: break
+                raise
+
+            ns.setblocking(0)
+            conn = createfunc(ns, addr)
+            self._conns[conn.fileno] = conn
+            self._poller.register(conn.fileno)
+
+    def _acceptMonitor(self, ns, addr):
+        logging.debug("New monitor connexion from %s:%d" % addr)
+        return _MonitorConnection(self, ns, addr)
+
+    def _acceptCommand(self, ns, addr):
+        logging.debug("New command connexion from %s:%d" % addr)
+        processor = srvhandlers.CommandProcessor(addr, self.m_sock,
+                                        self.mg_ip, self.mg_port, self.timeout)
+        return _CommandConnection(self, ns, addr, processor)
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(common.sockutil.DEF_RECV_BUFFER_SIZE)
+        except socket.error, e:
+            if e.args[0] in _RETRY_ERRNOS: return
+            data = ''
+
+        if data:
+            conn.deadline = time.time() + conn.timeout
+            conn.frames.feed(data)
+            conn.onData()
+        else:
+            # No data implies disconnection
+            conn.eof = True
+            self._poller.modify(conn.fileno, read=False,
+                                write=len(conn.outbuf) > 0)
+            if not conn.busy:
+                conn.onData()
+                if not conn.busy and not conn.outbuf:
+                    self.closeConnection(conn)
+
+    def _write(self, conn):
+        while conn.outbuf:
+            data = conn.outbuf[0]
+
+            if isinstance(data, _Stream):   # Streamed, send its next block
+                chunk = data.get()
+                if chunk is None:
+                    # Not produced yet, the worker wakes the loop up
+                    self._poller.modify(conn.fileno, write=False)
+                    return
+                elif chunk is _Stream.END:
+                    conn.outbuf.pop(0)
+                elif chunk is _Stream.ABORT:
+                    self.closeConnection(conn)  # Truncated response
+                    return
+                else:
+                    conn.outbuf.insert(0, chunk)
+                continue
+
+            try:
+                sent = conn.sock.send(buffer(data, conn.outoff))
+            except socket.error, e:
+                if e.args[0] in _RETRY_ERRNOS: return
+                logging.warning("Error sending data to %s:%d" % conn.addr)
+                self.closeConnection(conn)
+                return
+
+            conn.outoff += sent
+            if conn.outoff < len(data):
+                return
+
+            conn.outbuf.pop(0)
+            conn.outoff = 0
+
+        if conn.closing or (conn.eof and not conn.busy):
+            self.closeConnection(conn)
+        else:
+            self._poller.modify(conn.fileno, write=False)
+
+    def closeConnection(self, conn):
+        if self._conns.get(conn.fileno) is conn:
+            del self._conns[conn.fileno]
+            self._poller.unregister(conn.fileno)
+            conn.sock.close()
+            logging.debug("Closed socket to %s:%d" % conn.addr)
+
+        for data in conn.outbuf:
+            if isinstance(data, _Stream):
+                data.close()        # Releases its producer
+
+    def _drainWakeUp(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _dispatchResults(self):
+        while True:
+            try:
+                conn = self._ready.get_nowait()
+            except Queue.Empty:
+                break
+
+            if self._conns.get(conn.fileno) is conn and conn.outbuf:
+                self._poller.modify(conn.fileno, write=True)
+
+        while True:
+            try:
+                conn, msg = self._results.get_nowait()
+            except Queue.Empty:
+                break
+
+            conn.busy = False
+            if self._conns.get(conn.fileno) is conn:
+                conn.deadline = time.time() + conn.timeout
+                conn.onResult(msg)
+                if conn.eof and not conn.busy and not conn.outbuf:
+                    self.closeConnection(conn)
+
+    def _checkTimeouts(self):
+        now = time.time()
+        if now < self._next_check:
+            return
+
+        self._next_check = now + POLL_INTERVAL
+        for conn in self._conns.values():
+            if not conn.busy and not conn.closing and conn.deadline < now:
+                logging.debug("Socket TIMEOUT %s:%d" % conn.addr)
+                conn.closing = True
+                self.send(conn, helper.getTimeoutError(
+                            "Reached timeout of %.1f seconds" % conn.timeout))
+
+#
+## Streamed response, bounded queue of the blocks produced by a worker
+class _Stream(object):
+
+    END = object()      # Response complete
+    ABORT = object()    # Production failed, the response is truncated
+
+    def __init__(self, size):
+        self._blocks = Queue.Queue(size)
+        self._closed = False
+
+    def put(self, block):
+        """put(block) -> bool
+
+        Waits until there is room for block, returns False if the stream was
+        closed meanwhile.
+
+        """
+        while not self._closed:
+            try:
+                self._blocks.put(block, True, POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(self):
+        """get() -> str / END / ABORT / None if no block is ready"""
+        try:
+            return self._blocks.get_nowait()
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        self._closed = True
+
+#
+#
+class _Connection(object):
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.addr = addr
+        self.frames = common.FrameBuffer()
+        self.outbuf = []        # Pending responses
+        self.outoff = 0         # Bytes of outbuf[0] already sent
+        self.busy = False       # A request is being processed by a worker
+        self.closing = False    # Close once the pending responses are sent
+        self.eof = False        # The peer closed the connection
+        self.timeout = server.timeout
+        self.deadline = time.time() + self.timeout
+
+    def reply(self, msg, close=False):
+        self.closing = self.closing or close
+        self.server.send(self, msg)
+
+    def onData(self):
+        """Called when there is new data in self.frames"""
+        raise NotImplementedError()
+
+    def onResult(self, msg):
+        """Called with the response of the request submitted to the pool"""
+        raise NotImplementedError()
+
+#
+#
+class _MonitorConnection(_Connection):
+
+    def __init__(self, server, sock, addr):
+        super(_MonitorConnection, self).__init__(server, sock, addr)
+        self._head = None
+        self.session = False
+        self.relay = None       # Monitors of a child broker's session
+
+    def onData(self):
+        while not self.busy and not self.closing:
+            if self._head is None:
+                data = self.frames.getFrame(gdata.ETX)
+                if data is None and self.eof:
+                    data = self.frames.flush()
+                if not data:
+                    return
+
+                logging.debug("%s:%d Data:\n%s" % (self.addr[0], self.addr[1],
+                                                    data))
+                head, body = srvhandlers.splitMonitorHead(data)
+
+                if helper.isSYN(head) and self.relay is None:
+                    msg, opened = srvhandlers.openMonitorSession(body)
+                    self.reply(msg, not opened)
+                    if opened and not self.session:
+                        self._openSession()
+                    continue
+
+                elif helper.isDC2(head) and not self.session:
+                    msg, self.relay = srvhandlers.openRelaySession(body)
+                    self.reply(msg, self.relay is None)
+                    if self.relay is not None:
+                        self._openSession()
+                    continue
+
+                if self.relay is not None:
+                    known = helper.isETB(head)
+                else:
+                    known = srvhandlers.isMonitorHead(head) and \
+                            (not self.session or helper.isSOH(head))
+
+                if not known:
+                    logging.info("Unknown monitor message '%s' from %s:%d" %
+                                    (data, self.addr[0], self.addr[1]) )
+                    self.reply(helper.getBadMessageError("Wrong message"),
+                                True)
+                    return
+
+                try:
+                    if self.relay is not None:
+                        size = srvhandlers.parseBatchBody(body)
+                    else:
+                        arg, fmt, size = srvhandlers.parseMonitorBody(head,
+                                                                        body)
+                except ValueError, e:
+                    self.reply(helper.getBadMessageError(str(e)), True)
+                    return
+
+                self._head = (head, body, size)
+
+            payload = self._getPayload(self._head[2])
+            if payload is None:
+                return
+
+            head, body, size = self._head
+            self._head = None
+            if self.relay is not None:
+                self.server.submit(self, srvhandlers.processRelayBatch,
+                                    self.relay, payload)
+            else:
+                self.server.submit(self, srvhandlers.processMonitorMessage,
+                                    self.addr, head, body, payload)
+
+    # The connection stays open for the next messages of a session
+    def _openSession(self):
+        self.session = True
+        self.timeout = self.server.session_timeout
+        self.deadline = time.time() + self.timeout
+
+    # Returns the payload of the current message, None if it is incomplete
+    # or malformed (the connection is closed)
+    def _getPayload(self, size):
+        if size is None:
+            payload = self.frames.getFrame(gdata.ETX)
+            if payload is None and self.eof:
+                payload = self.frames.flush()
+            return payload
+
+        payload = self.frames.getBytes(size + len(gdata.ETX))
+        if payload is None:
+            if not self.eof: return None
+            payload = self.frames.flush()
+
+        if payload[size:] != gdata.ETX:
+            self.reply(helper.getBadMessageError(
+                        "Payload does not match its size (%d)" % size), True)
+            return None
+
+        return payload[:size]
+
+    def onResult(self, msg):
+        if self.session:
+            self.reply(msg)
+            self.onData()       # Next update of the session
+        else:
+            self.reply(msg, True)
+
+#
+#
+class _CommandConnection(_Connection):
+
+    def __init__(self, server, sock, addr, processor):
+        super(_CommandConnection, self).__init__(server, sock, addr)
+        self.processor = processor
+
+    def onData(self):
+        if self.busy or self.closing:
+            return
+
+        data = self.frames.getFrame('\n')
+        if data is None and self.eof:
+            data = self.frames.flush()
+        if data is None:
+            return
+
+        # Connection closed or QUIT
+        if not data or helper.isCmdQuit(data.strip()):
+            self.closing = True
+            if not self.outbuf:
+                self.server.closeConnection(self)
+            return
+
+        self.server.submit(self, self.processor.process, data)
+
+    def onResult(self, msg):
+        if msg is None:
+            self.closing = True
+            self.server.closeConnection(self)
+        else:
+            self.reply(msg)
+            self.onData()       # Next pipelined command
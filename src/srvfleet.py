@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""srvfleet.py - Column store of the latest metrics of all the monitors
+
+Every monitor gets a dense slot, reused once the monitor is dropped, and
+every metric a column of doubles indexed by slot. Aggregates over the whole
+fleet are computed in a single pass over a column, vectorized with NumPy
+when it is available.
+
+The metrics of TOP_METRICS also have an ordered index of (value, mid) kept
+up to date on every update, so the monitors with the highest values are
+read from its tail without sorting the fleet.
+
+"""
+
+# Imports
+# -------
+
+import math
+import array
+import bisect
+import logging
+import itertools
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Data
+# ----
+
+# Name of the metrics, 'cpu' is the mean usage of all the CPUs
+METRICS = ('cpu', 'load1', 'load5', 'load15', 'ram_total', 'ram_used',
+            'ram_free', 'ram_avaliable', 'swap_total', 'swap_used',
+            'swap_free', 'processes')
+
+# Metrics with an ordered index, every changed value costs a removal and an
+# insertion in its index
+TOP_METRICS = ('cpu', 'load1', 'load5', 'load15', 'ram_used', 'swap_used',
+                'processes')
+
+# Aggregate functions, besides the percentiles pN (0 <= N <= 100)
+AGGREGATES = ('avg', 'min', 'max', 'sum', 'count')
+
+# Implementation of the aggregate functions
+_NUMPY_FUNCS = { 'avg' : 'mean', 'min' : 'min', 'max' : 'max', 'sum' : 'sum' }
+_PYTHON_FUNCS = { 'min' : min, 'max' : max, 'sum' : sum }
+
+# Slots allocated when the columns are full
+_MIN_GROWTH = 64
+
+
+# Classes
+# -------
+
+class FleetMetrics(object):
+    """Latest metrics of every monitor, one column per metric.
+
+    Thread safe, the columns are only accessed with the internal lock held.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}            # mid -> slot
+        self._free = []             # Slots of the removed monitors
+        self._size = 0              # Allocated slots
+        self._valid = array.array('b')  # 1 if the slot holds metrics
+        self._columns = dict( (metric, array.array('d'))
+                                for metric in METRICS )
+        self._indexes = dict( (metric, _OrderedIndex())
+                                for metric in TOP_METRICS )
+
+    def update(self, mid, sinfodao):
+        """update(mid: str, sinfodao: SysInfoDAO) -> void
+
+        Stores the metrics of sinfodao as the latest ones of the monitor mid.
+        An update with a non-finite value (nan, inf) is ignored, the previous
+        metrics of the monitor are kept.
+
+        """
+        row = metricsRow(sinfodao)
+        if not all(_isFinite(value) for value in row):
+            # nan never equals itself, it couldn't be removed from the indexes
+            logging.warning("Ignored the non-finite metrics of %s" % mid)
+            return
+
+        self._lock.acquire()
+        try:
+            slot = self._slots.get(mid)
+            if slot is None:
+                slot = self._slots[mid] = self._allocSlot()
+
+            valid = self._valid[slot]
+            for metric, value in zip(METRICS, row):
+                column = self._columns[metric]
+                index = self._indexes.get(metric)
+                if index is not None:
+                    if valid and column[slot] == value:
+                        continue
+                    elif valid:
+                        index.remove( (column[slot], mid) )
+                    index.insert( (value, mid) )
+                column[slot] = value
+            self._valid[slot] = 1
+        finally:
+            self._lock.release()
+
+    def remove(self, mid):
+        """remove(mid: str) -> void
+
+        Drops the metrics of the monitor mid, if any.
+
+        """
+        self._lock.acquire()
+        try:
+            slot = self._slots.pop(mid, None)
+            if slot is not None:
+                if self._valid[slot]:
+                    for metric in TOP_METRICS:
+                        self._indexes[metric].remove(
+                                    (self._columns[metric][slot], mid) )
+                self._valid[slot] = 0
+                self._free.append(slot)
+        finally:
+            self._lock.release()
+
+    def aggregate(self, metric, func):
+        """aggregate(metric: str, func: str) -> float, int
+
+        Computes the aggregate func (see AGGREGATES and percentiles pN) of a
+        metric over all the monitors with data.
+
+        Returns the value (None without monitors) and the number of monitors.
+
+        Raises a ValueError if the metric or the function are unknown.
+
+        """
+        if metric not in self._columns:
+            raise ValueError("Unknown metric: %s" % metric)
+        _checkAggregate(func)
+
+        self._lock.acquire()
+        try:
+            if numpy is not None:
+                values = self._numpyValues(metric)
+            else:
+                values = list(itertools.compress(self._columns[metric],
+                                                    self._valid))
+        finally:
+            self._lock.release()
+
+        return aggregateValues(values, func)
+
+    def values(self, metric):
+        """values(metric: str) -> [float]
+
+        Returns the values of a metric of all the monitors with data.
+
+        Raises a ValueError if the metric is unknown.
+
+        """
+        if metric not in self._columns:
+            raise ValueError("Unknown metric: %s" % metric)
+
+        self._lock.acquire()
+        try:
+            return list(itertools.compress(self._columns[metric],
+                                            self._valid))
+        finally:
+            self._lock.release()
+
+    def top(self, metric, n):
+        """top(metric: str, n: int) -> [ (str, float) ]
+
+        Returns the ids and values of the n monitors with the highest values
+        of a metric, the highest first.
+
+        Raises a ValueError if the metric is not one of TOP_METRICS.
+
+        """
+        if metric not in self._indexes:
+            raise ValueError("Metric without index: %s" % metric)
+
+        self._lock.acquire()
+        try:
+            return [ (mid, value) for value, mid in
+                        itertools.islice(self._indexes[metric].descending(),
+                                            n) ]
+        finally:
+            self._lock.release()
+
+    # Values of the valid slots of a metric as an array of NumPy. The mask
+    # copies them, the column may be resized once the lock is released
+    def _numpyValues(self, metric):
+        column = numpy.frombuffer(self._columns[metric], numpy.float64)
+        valid = numpy.frombuffer(self._valid, numpy.int8)
+        return column[valid != 0]
+
+    # Returns a free slot, growing the columns if there isn't any
+    def _allocSlot(self):
+        if not self._free:
+            growth = max(self._size, _MIN_GROWTH)
+            zeros = array.array('d', [0.0]) * growth
+            for column in self._columns.itervalues():
+                column.extend(zeros)
+            self._valid.extend(array.array('b', [0]) * growth)
+            self._free.extend(xrange(self._size + growth - 1,
+                                        self._size - 1, -1))
+            self._size += growth
+
+        return self._free.pop()
+
+#
+## Sorted sequence split in buckets of at most 2 * BUCKET_SIZE items, so an
+## insertion or removal only moves the items of a bucket. Not thread safe.
+class _OrderedIndex(object):
+
+    BUCKET_SIZE = 512
+
+    def __init__(self):
+        self._buckets = [ ]
+        self._maxes = [ ]       # Last item of every bucket
+
+    def insert(self, item):
+        if not self._buckets:
+            self._buckets.append([item])
+            self._maxes.append(item)
+            return
+
+        b = min(bisect.bisect_left(self._maxes, item), len(self._maxes) - 1)
+        bucket = self._buckets[b]
+        bisect.insort(bucket, item)
+        self._maxes[b] = bucket[-1]
+
+        if len(bucket) > 2 * self.BUCKET_SIZE:
+            half = bucket[self.BUCKET_SIZE:]
+            del bucket[self.BUCKET_SIZE:]
+            self._buckets.insert(b + 1, half)
+            self._maxes[b] = bucket[-1]
+            self._maxes.insert(b + 1, half[-1])
+
+    def remove(self, item):
+        b = bisect.bisect_left(self._maxes, item)
+        if b == len(self._maxes):
+            return
+        bucket = self._buckets[b]
+        i = bisect.bisect_left(bucket, item)
+        if i == len(bucket) or bucket[i] != item:
+            return
+
+        del bucket[i]
+        if bucket:
+            self._maxes[b] = bucket[-1]
+        else:
+            del self._buckets[b]
+            del self._maxes[b]
+
+    def descending(self):
+        for bucket in reversed(self._buckets):
+            for item in reversed(bucket):
+                yield item
+
+# Functions
+# ---------
+
+def metricsRow(sinfodao):
+    """metricsRow(sinfodao: SysInfoDAO) -> tuple
+
+    Returns the values of METRICS in sinfodao, in the same order.
+
+    """
+    cpu_usage = sinfodao.getUsedCPUPercentage()
+    cpu = sum(cpu_usage) / len(cpu_usage) if cpu_usage else 0.0
+
+    return ( (cpu,) + tuple(sinfodao.getCPULoadAvg()) +
+                sinfodao.getVirtualMemory() + sinfodao.getSwapMemory() +
+                (len(sinfodao.getRunningProcesses()),) )
+
+def aggregateValues(values, func):
+    """aggregateValues(values: sequence, func: str) -> float, int
+
+    Computes the aggregate func (see AGGREGATES and percentiles pN) of the
+    values of a metric, a list or an array of NumPy.
+
+    Returns the value (None without values) and the number of values.
+
+    Raises a ValueError if the function is unknown.
+
+    """
+    percent = _checkAggregate(func)
+
+    count = len(values)
+    if func == 'count':
+        return float(count), count
+    elif not count:
+        return None, 0
+    elif percent is not None:
+        return _percentile(values, percent), count
+
+    if numpy is not None:
+        values = numpy.asarray(values, numpy.float64)
+        return float(getattr(values, _NUMPY_FUNCS[func])()), count
+    elif func == 'avg':
+        return sum(values) / count, count
+    return _PYTHON_FUNCS[func](values), count
+
+# Raises a ValueError if func is not an aggregate function, returns the
+# percent of the percentiles
+def _checkAggregate(func):
+    percent = _parsePercentile(func)
+    if percent is None and func not in AGGREGATES:
+        raise ValueError("Unknown aggregate function: %s" % func)
+    return percent
+
+# Percent of a pN function name, None if it is not one
+def _parsePercentile(func):
+    if not func.startswith('p'):
+        return None
+    try:
+        percent = float(func[1:])
+    except ValueError:
+        return None
+    return percent if 0.0 <= percent <= 100.0 else None
+
+# Percentile with linear interpolation between the closest ranks, as
+# numpy.percentile() does by default
+def _percentile(values, percent):
+    if numpy is not None:
+        return float(numpy.percentile(values, percent))
+
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+# Tests if value is neither nan nor infinite
+def _isFinite(value):
+    return not (math.isnan(value) or math.isinf(value))
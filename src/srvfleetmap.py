@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""srvfleetmap.py - Latest state of the fleet published in a memory-mapped file
+
+The broker (FleetMapWriter) keeps a file with a fixed layout updated with the
+latest metrics of every monitor, so the tools running in the same host read
+them straight from a shared mapping (FleetMapReader) instead of asking the
+broker for GET ALL.
+
+Layout (version 1, little endian):
+
+    header      HEADER_SIZE bytes: magic 'DRM', version, generation, capacity
+                (slots), used slots, monitors, size of a record, number of
+                metrics and time of the last publication
+    records     capacity slots of RECORD_SIZE bytes: time of the last update
+                or keep alive, the values of srvfleet.METRICS (same order),
+                port, in use flag, id and ip. The doubles are aligned to 8
+                bytes. Only the first used slots may be in use.
+
+The generation works as a seqlock: the writer makes it odd before changing
+the file and even again when it is done, a reader takes what it needs
+between two reads of the same even generation or retries. The file only
+grows, in place. A restarted broker replaces it with a new file, the readers
+map it again when the path points to another file.
+
+"""
+
+# Imports
+# -------
+
+import os
+import mmap
+import time
+import struct
+import logging
+import srvdata
+import srvfleet
+import threading
+
+# Data
+# ----
+
+FLEETMAP_MAGIC = 'DRM'
+FLEETMAP_VERSION = 1
+
+HEADER_SIZE = 64
+
+# Slots of a new file, it doubles every time it gets full
+INITIAL_CAPACITY = 1024
+
+# Attempts of a reader to find the file not being written, and time between
+# them, before giving up
+READ_ATTEMPTS = 1000
+READ_RETRY_DELAY = 0.001
+
+_header = struct.Struct('<3sB4xQIIIHHd')
+_generation = struct.Struct('<Q')
+_GENERATION_OFFSET = 8
+
+_record_format = '<d%ddHBx64s46s' % len(srvfleet.METRICS)
+_record = struct.Struct(_record_format +
+                        'x' * (-struct.calcsize(_record_format) % 8))
+_stamp = struct.Struct('<d')
+
+RECORD_SIZE = _record.size
+
+_EMPTY_RECORD = '\0' * RECORD_SIZE
+
+# Classes
+# -------
+
+class FleetMapWriter(threading.Thread):
+    """Publishes the monitors DB in the fleet map file path every interval
+    seconds, only the records of the monitors changed since the previous
+    publication are written.
+
+    """
+
+    def __init__(self, path, interval):
+        super(FleetMapWriter, self).__init__()
+
+        self.path = path
+        self.interval = interval
+
+        self._written = { }     # mid -> (slot, sinfodao, time) published
+        self._free = [ ]        # Slots of the removed monitors
+        self._used = 0
+        self._capacity = 0
+        self._generation = 0
+        self._file = None
+        self._map = None
+        self._broken = False    # A write failed, the file must be replaced
+        self._awakener = threading.Event()
+        self._active = True
+
+    def create(self):
+        """create() -> void
+
+        Creates an empty fleet map file, replacing the previous one. Must be
+        called before starting the writer, it is called again to replace the
+        file after a write error.
+
+        Raises IOError or OSError if it can't be written.
+
+        """
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w+b')
+        try:
+            f.write(_EMPTY_RECORD * INITIAL_CAPACITY + '\0' * HEADER_SIZE)
+            f.flush()
+            fmap = mmap.mmap(f.fileno(), 0)
+            os.rename(tmp, self.path)
+        except:
+            f.close()
+            raise
+
+        self.close()
+        self._file = f
+        self._map = fmap
+        self._written = { }
+        self._free = [ ]
+        self._used = 0
+        self._capacity = INITIAL_CAPACITY
+        self._writeHeader(0, 0.0)
+        self._broken = False
+
+    ## Override
+    def run(self):
+        self.publish()
+
+        while self._active:
+            self._awakener.wait(self.interval)
+            self._awakener.clear()
+            self.publish()
+
+    def stop(self):
+        """stop() -> void
+
+        Publishes the last changes, waits until the writer thread ends and
+        closes the file, that keeps the last state.
+
+        """
+        self._active = False
+        self._awakener.set()
+        self.join()
+        self.close()
+
+    def close(self):
+        """close() -> void
+
+        Unmaps and closes the file.
+
+        """
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def publish(self):
+        """publish() -> void
+
+        Writes the monitors updated, kept alive, added and removed since the
+        previous publication, or all of them to a new file if the previous
+        write failed.
+
+        """
+        try:
+            if self._broken:
+                self.create()
+            self._publish(srvdata.getAllMonitorsState())
+        except (IOError, OSError, mmap.error), e:
+            self._broken = True
+            logging.error("Error publishing the fleet map %s: %s"
+                            % (self.path, str(e)) )
+
+    def _publish(self, state):
+        written = {}
+        records = []            # (slot, record)
+        stamps = []             # (slot, time)
+
+        for mid, sinfodao, ip, port, stamp in state:
+            if sinfodao is not None:
+                written[mid] = self._written.get(mid)
+
+        removed = [ self._written[mid][0] for mid in self._written
+                        if mid not in written ]
+        self._free.extend(removed)
+
+        for mid, sinfodao, ip, port, stamp in state:
+            if sinfodao is None:
+                continue
+
+            last = written[mid]
+            if last is not None and last[1] is sinfodao:
+                if last[2] != stamp:
+                    stamps.append( (last[0], stamp) )
+                    written[mid] = (last[0], sinfodao, stamp)
+                continue
+
+            slot = last[0] if last is not None else self._allocSlot()
+            records.append( (slot, _record.pack(stamp,
+                                *(srvfleet.metricsRow(sinfodao) +
+                                  (int(port), 1, mid, ip)) )) )
+            written[mid] = (slot, sinfodao, stamp)
+
+        self._beginWrite()
+        try:
+            if self._used > self._capacity:
+                self._grow(max(2 * self._capacity, self._used))
+
+            for slot in removed:
+                offset = HEADER_SIZE + slot * RECORD_SIZE
+                self._map[offset:offset + RECORD_SIZE] = _EMPTY_RECORD
+            for slot, record in records:
+                offset = HEADER_SIZE + slot * RECORD_SIZE
+                self._map[offset:offset + RECORD_SIZE] = record
+            for slot, stamp in stamps:
+                _stamp.pack_into(self._map, HEADER_SIZE + slot * RECORD_SIZE,
+                                    stamp)
+
+            self._writeHeader(len(written), time.time())
+        finally:
+            self._endWrite()
+
+        self._written = written
+
+    # Returns a free slot, the used slots may outgrow the capacity
+    def _allocSlot(self):
+        if self._free:
+            return self._free.pop()
+        self._used += 1
+        return self._used - 1
+
+    # Extends the file and its mapping to capacity slots. The new space is
+    # written, not only truncated, so a full disk fails here and not while
+    # writing in the map
+    def _grow(self, capacity):
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(_EMPTY_RECORD * (capacity - self._capacity))
+        self._file.flush()
+        self._map.resize(HEADER_SIZE + capacity * RECORD_SIZE)
+        self._capacity = capacity
+        logging.debug("Fleet map grown to %d slots" % capacity)
+
+    def _writeHeader(self, monitors, stamp):
+        _header.pack_into(self._map, 0, FLEETMAP_MAGIC, FLEETMAP_VERSION,
+                            self._generation, self._capacity, self._used,
+                            monitors, RECORD_SIZE, len(srvfleet.METRICS),
+                            stamp)
+
+    # The generation is odd while the file is being written
+    def _beginWrite(self):
+        self._generation += 1
+        _generation.pack_into(self._map, _GENERATION_OFFSET, self._generation)
+
+    def _endWrite(self):
+        self._generation += 1
+        _generation.pack_into(self._map, _GENERATION_OFFSET, self._generation)
+
+#
+#
+class FleetMapReader(object):
+    """Reads the fleet state published by a broker in the fleet map file
+    path. Not thread safe, every thread needs its own reader.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self._file = None
+        self._map = None
+        self._inode = None
+
+    def read(self):
+        """read() -> float, [ (str, str, int, float, tuple) ]
+
+        Returns the time of the last publication and the id, ip, port, time
+        of the last update or keep alive and the values of srvfleet.METRICS
+        of every monitor.
+
+        Raises ValueError if the file is not a fleet map, IOError or OSError
+        if it can't be read or it is being written for too long.
+
+        """
+        for attempt in xrange(READ_ATTEMPTS):
+            if attempt:
+                time.sleep(READ_RETRY_DELAY)
+
+            self._open()
+            generation = _generation.unpack_from(self._map,
+                                                    _GENERATION_OFFSET)[0]
+            if generation & 1:
+                continue
+
+            magic, version, _, capacity, used, monitors, record_size, \
+                    nmetrics, stamp = _header.unpack_from(self._map, 0)
+            if (magic, version, record_size, nmetrics) != \
+                    (FLEETMAP_MAGIC, FLEETMAP_VERSION, RECORD_SIZE,
+                     len(srvfleet.METRICS)):
+                raise ValueError("Unknown fleet map format")
+
+            if used > capacity:
+                continue
+            elif HEADER_SIZE + capacity * RECORD_SIZE > len(self._map):
+                self.close()    # Grown, map it again
+                continue
+
+            fleet = []
+            for slot in xrange(used):
+                record = _record.unpack_from(self._map,
+                                                HEADER_SIZE + slot * RECORD_SIZE)
+                if record[-3]:
+                    fleet.append( (record[-2], record[-1].rstrip('\0'),
+                                    record[-4], record[0], record[1:-4]) )
+
+            if _generation.unpack_from(self._map,
+                                        _GENERATION_OFFSET)[0] == generation:
+                return stamp, fleet
+
+        raise IOError("The fleet map %s is being written for too long"
+                        % self.path)
+
+    def close(self):
+        """close() -> void
+
+        Unmaps the file, it is mapped again by the next read.
+
+        """
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    # Maps the file if it isn't yet or the path points to a new one
+    def _open(self):
+        if self._map is not None and \
+                os.stat(self.path).st_ino == self._inode:
+            return
+
+        self.close()
+        f = open(self.path, 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size < HEADER_SIZE:
+                raise ValueError("Unknown fleet map format")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            f.close()
+            raise
+
+        self._file = f
+        self._inode = os.fstat(f.fileno()).st_ino
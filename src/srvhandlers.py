@@ -6,55 +6,52 @@
 import gdata
 import common
 import helper
+import zlib
+import time
 import socket
+import itertools
 import srvdata
+import srvcluster
+import srvrelay
 import logging
+import srvhistory
 import threading
 
+# Maximum size of a decompressed update
+MAX_INFLATED_SIZE = 64 << 20
+
+# Maximum size of the first frame of a monitor message peeked to find its
+# owner process
+MAX_HEAD_SIZE = 1024
 
 # Classes
 # -------
 
-class ThreadWithRegister(threading.Thread):
-
-    _reg_lock = threading.RLock()
-    _reg = set()
-
-    @staticmethod
-    def _registerThread(cls, thread):
-        cls._reg_lock.acquire()
-        cls._reg.add(thread)
-        cls._reg_lock.release()
-
-    @staticmethod
-    def _unregisterThread(cls, thread):
-        cls._reg_lock.acquire()
-        cls._reg.remove(thread)
-        cls._reg_lock.release()
-
-    @staticmethod
-    def _waitAll(cls):
-        cls._reg_lock.acquire()
-
-        while len(cls._reg) > 0:
-            rt = cls._reg.pop()
-            cls._reg.add(rt)
-            cls._reg_lock.release()
-            rt.join()
-
-            cls._reg_lock.acquire()
-            if len(cls._reg) == 0:
-                cls._reg_lock.release()
-                break
 #
 #
-class MonitorHandler(ThreadWithRegister):
+class MonitorHandler(object):
+    """Serves a connection of the monitors interface, run() is executed by a
+    thread of the server's WorkerPool.
+
+    If the monitor opens a session the connection is handed to 'sessions'
+    (an IdleSessions) after every served update, and resume() is executed
+    by a worker when the next update arrives.
+
+    When the broker runs several processes (see srvcluster) run() hands the
+    connections of the monitors owned by other processes over to them.
+
+    The connection of a child broker (see srvrelay) is served as a session
+    too, 'relay' holds the monitors relayed through it.
 
-    def __init__(self, sock, timeout):
-        super(MonitorHandler, self).__init__()
+    """
+
+    def __init__(self, sock, timeout, sessions=None):
         self.sock = sock
         self.timeout = timeout
+        self.sessions = sessions
         self.addr = sock.getpeername()  # Save socket address
+        self.reader = common.SocketReader(sock)
+        self.relay = None
 
     def run(self):
         """run() -> void
@@ -62,103 +59,224 @@ class MonitorHandler(ThreadWithRegister):
         Handles the communication events and errors with a resource monitor.
 
         """
-        MonitorHandler._registerThread(MonitorHandler, self)
+        if srvcluster.workers > 1 and self._handOff():
+            return
+        self._serve(self._handleMessage)
+
+    def resume(self):
+        """resume() -> void
+
+        Handles the updates received through an open session.
+
+        """
+        if self.relay is not None:
+            self._serve(self._handleRelayBatches)
+        else:
+            self._serve(self._handleSessionUpdates)
+
+    def expire(self):
+        """expire() -> void
+
+        Closes a session that has been idle for too long.
+
+        """
+        logging.debug("Session TIMEOUT %s:%d" % self.addr)
+        try:
+            self.sock.sendall( helper.getTimeoutError("Session expired") )
+        except IOError:
+            pass
+        finally:
+            self.sock.close()
+
+    # Hands the connection over to the process owning the monitor, found
+    # with the first frame, returns True if it has been handed over
+    def _handOff(self):
         sock = self.sock
         sock.settimeout( self.timeout )
 
         try:
-            data = common.recvEnd(sock, gdata.ETX)
-
-            if data:
-                logging.debug("%s:%d Data:\n%s" % (self.addr[0], self.addr[1],
-                                                    data))
-                head, sep, body = data.partition(' ')
-                head = head.strip()
-                body = body.strip()
-
-                if helper.isBEL(head):      # New monitor
-                    self._newMonitor(body)
-                elif helper.isSOH(head):    # Monitor data update
-                    self._updateMonitor(body)
-                else:                       # Unknown data
-                    logging.info("Unknown monitor message '%s' from %s:%d" %
-                                    (data, self.addr[0], self.addr[1]) )
-                    sock.sendall( helper.getBadMessageError("Wrong message") )
+            data = srvcluster.peekFrame(sock, gdata.ETX, MAX_HEAD_SIZE)
+            head, body = splitMonitorHead(data.partition(gdata.ETX)[0])
+            arg = (body.split() or [''])[0]
+
+            if helper.isBEL(head):
+                mid = srvdata.monitorId(self.addr[0], arg)
+            elif helper.isSOH(head) or helper.isSYN(head):
+                mid = arg
+            else:
+                return False            # Rejected by this process
+
+            if srvcluster.isLocal(mid):
+                return False
+
+            srvcluster.handOff(sock, mid)
+            logging.debug("Monitor %s handed over to worker %d"
+                            % (mid, srvcluster.ownerOf(mid)) )
+
+        except socket.timeout:
+            return False                # Answered by _serve()
+        except (IOError, OSError), e:
+            logging.warning("Error handing over the connection of %s:%d: %s"
+                            % (self.addr[0], self.addr[1], str(e)) )
+
+        sock.close()
+        return True
+
+    def _serve(self, handlefunc):
+        sock = self.sock
+        sock.settimeout( self.timeout )
+        keep = False
+
+        try:
+            keep = handlefunc()
 
         except socket.timeout:
             logging.debug("Socket TIMEOUT %s:%d" % self.addr)
             sock.sendall( helper.getTimeoutError(
                             "Reached timeout of %.1f seconds" % self.timeout) 
                         )
-        except AttributeError, e:
-            sock.sendall( helper.getGenericError(str(e)) )
         except ValueError, e:
-            sock.sendall( helper.getGenericError(str(e)) )
+            logging.info("Malformed monitor message from %s:%d: %s"
+                            % (self.addr[0], self.addr[1], str(e)) )
+            sock.sendall( helper.getBadMessageError(str(e)) )
         except IOError, e:
             logging.warning("Error sending data to (%s:%d)" 
                 % self.addr)
         finally:
-            sock.close()
-            logging.debug("Monitor handler closed socket to %s:%s" % self.addr)
-            MonitorHandler._unregisterThread(MonitorHandler, self)
-
-    def _newMonitor(self, port):
-        
-        iport = int(port)
-        if iport < gdata.SOCK_MIN_PORT or iport > gdata.SOCK_MAX_PORT:
-            raise ValueError("Port value (%d) out of range [%d-%d]" 
-                % (iport, gdata.SOCK_MIN_PORT, gdata.SOCK_MAX_PORT))
-
-        mid = srvdata.initializeNewMonitorData(self.addr[0], port)
-
-        opt = gdata.getCommandLineOptions()
-        msg = helper.getOkMessage(
-                "",
-                "%s %s %d" 
-                % (mid, opt.multicast_group, opt.multicast_group_port)
-            )
+            if keep:
+                self.sessions.park(self)
+            else:
+                sock.close()
+                logging.debug("Monitor handler closed socket to %s:%s" 
+                                % self.addr)
+
+    # Returns True if the connection becomes a session
+    def _handleMessage(self):
+        reader = self.reader
+        data = reader.recvEnd(gdata.ETX)
+
+        if data:
+            logging.debug("%s:%d Data:\n%s" % (self.addr[0], self.addr[1],
+                                                data))
+            head, body = splitMonitorHead(data)
+
+            if helper.isSYN(head) and self.sessions:
+                msg, opened = openMonitorSession(body)
+                self.sock.sendall(msg)
+                return opened and self._handleSessionUpdates(False)
+
+            elif helper.isDC2(head) and self.sessions:
+                msg, self.relay = openRelaySession(body)
+                self.sock.sendall(msg)
+                return self.relay is not None and \
+                        self._handleRelayBatches(False)
+
+            elif isMonitorHead(head):
+                payload = self._readPayload(head, body)
+                self.sock.sendall(
+                    processMonitorMessage(self.addr, head, body, payload))
+            else:                       # Unknown data
+                logging.info("Unknown monitor message '%s' from %s:%d" %
+                                (data, self.addr[0], self.addr[1]) )
+                self.sock.sendall( helper.getBadMessageError("Wrong message") )
+
+        return False
+
+    # Serves the session updates, waiting for the first one if 'wait', until
+    # there is no more received data. Returns False if the session ends.
+    def _handleSessionUpdates(self, wait=True):
+        reader = self.reader
+
+        while wait or reader.hasPendingData():
+            wait = False
+            data = reader.recvEnd(gdata.ETX)
+            if not data:
+                return False    # Session closed by the monitor
+
+            head, body = splitMonitorHead(data)
+
+            if helper.isSYN(head):      # Keep alive, the data hasn't changed
+                msg, opened = openMonitorSession(body)
+                self.sock.sendall(msg)
+                if not opened:
+                    return False
+                continue
+
+            if not helper.isSOH(head):
+                logging.info("Unknown session message '%s' from %s:%d" %
+                                (data, self.addr[0], self.addr[1]) )
+                self.sock.sendall( helper.getBadMessageError("Wrong message") )
+                return False
+
+            payload = self._readPayload(head, body)
+            self.sock.sendall(
+                processMonitorMessage(self.addr, head, body, payload))
 
-        self.sock.sendall(msg)
+        return True
 
-        self._updateMonitor(mid)
+    # Applies the batches received through a relay session, waiting for the
+    # first one if 'wait', until there is no more received data. Returns
+    # False if the session ends.
+    def _handleRelayBatches(self, wait=True):
+        reader = self.reader
 
-    def _updateMonitor(self, mid):
-        
-        if srvdata.existsMonitorData(mid):
-            srvdata.keepAliveMonitor(mid)
+        while wait or reader.hasPendingData():
+            wait = False
+            data = reader.recvEnd(gdata.ETX)
+            if not data:
+                logging.info("Relay session closed by %s:%d" % self.addr)
+                return False
 
-            data = common.recvEnd(self.sock, gdata.ETX).strip()
-            #logging.debug("%s:%d Data:\n%s" % (self.addr[0], self.addr[1], data))
+            head, body = splitMonitorHead(data)
+            if not helper.isETB(head):
+                logging.info("Unknown relay message '%s' from %s:%d" %
+                                (data, self.addr[0], self.addr[1]) )
+                self.sock.sendall( helper.getBadMessageError("Wrong message") )
+                return False
 
-            infoparser = common.SysInfoXMLParser()
-            infoparser.parseXML(data)
-            infodao = infoparser.getSysInfoData()
-            srvdata.updateMonitorData(mid, infodao)
-            self.sock.sendall( helper.getOkMessage("Update successful") )                   
-            logging.debug("Update %s successful" % mid)
-        else:
-            self.sock.sendall( 
-                helper.getMonitorNotFoundError(
-                    "There isn't any monitor with id: %s" % mid)
-                )
+            payload = self._recvSized(parseBatchBody(body))
+            self.sock.sendall( processRelayBatch(self.relay, payload) )
+
+        return True
 
-    @staticmethod
-    def waitAll():
-        MonitorHandler._waitAll(MonitorHandler)
+    # Reads the payload that follows the head of a monitor message, raises
+    # ValueError if the head is malformed or the payload is truncated
+    def _readPayload(self, head, body):
+        arg, fmt, size = parseMonitorBody(head, body)
+        if size is None:
+            return self.reader.recvEnd(gdata.ETX)
+
+        return self._recvSized(size)
+
+    # Reads a payload of size bytes followed by ETX, raises ValueError if it
+    # is truncated
+    def _recvSized(self, size):
+        payload = self.reader.recvSize(size + len(gdata.ETX))
+        if payload[size:] != gdata.ETX:
+            raise ValueError("Payload does not match its size (%d)" % size)
+
+        return payload[:size]
 
 #
 #
-class CommandHandler(ThreadWithRegister):
-    
-    def __init__(self, sock, m_sock, mg_ip, mg_port, timeout):
-        super(CommandHandler, self).__init__()
+class CommandHandler(object):
+    """Serves a connection of the commands interface, run() is executed by a
+    thread of the server's WorkerPool.
+
+    Once the received commands are answered the connection is handed to
+    'sessions' (an IdleSessions) until the client sends the next one, so a
+    client that keeps its connection open does not hold a worker thread.
+
+    """
+
+    def __init__(self, sock, m_sock, mg_ip, mg_port, timeout, sessions=None):
         self.sock = sock
-        self.m_sock = m_sock
-        self.mg_ip = mg_ip
-        self.mg_port = mg_port
         self.timeout = timeout
+        self.sessions = sessions
         self.addr = sock.getpeername()
-
+        self.reader = common.SocketReader(sock)
+        self.processor = CommandProcessor(self.addr, m_sock, mg_ip, mg_port,
+                                            timeout)
 
     def run(self):
         """run() -> void
@@ -166,142 +284,318 @@ class CommandHandler(ThreadWithRegister):
         Handles the communication events and errors with a client.
 
         """
-        CommandHandler._registerThread(CommandHandler, self)
         sock = self.sock
         sock.settimeout(self.timeout)
+        keep = False
 
         try:
-            while True:
-                data = common.recvEnd(sock, '\n')
-                # Connection closed
-                if not data: break
+            keep = self._handleCommands()
 
-                data = data.strip()
+        except socket.timeout:
+            logging.debug("Socket TIMEOUT %s:%d" % self.addr)
+            sock.sendall( helper.getTimeoutError(
+                            "Reached timeout of %.1f seconds" % self.timeout)
+                        )
+        except IOError:
+            logging.warning("Error sending data to %s:%d" % self.addr)
+        finally:
+            if keep:
+                self.sessions.park(self)
+            else:
+                sock.close()
+                logging.debug("Command handler closed socket to %s:%s"
+                                % self.addr)
 
-                if helper.isCmdQuit(data):          # QUIT
-                    break
+    def resume(self):
+        """resume() -> void
 
-                elif helper.isCmdList(data):        # LIST
-                    self._sendMonitorsList()
+        Handles the commands received through an idle connection.
 
-                elif helper.isCmdGetAll(data):      # GET ALL
-                    self._sendGetAll()
+        """
+        self.run()
 
-                elif helper.isCmdUpdateAll(data):   # UPDATE ALL
-                    self._sendUpdateAll()
+    def expire(self):
+        """expire() -> void
 
-                else:
-                    cmd, sep, body = data.partition(' ')
-                    body = body.strip()
+        Closes a connection that has been idle for too long.
 
-                    if helper.isCmdGet(cmd):        # GET
-                        self._handleGet(body)
+        """
+        logging.debug("Socket TIMEOUT %s:%d" % self.addr)
+        try:
+            self.sock.sendall( helper.getTimeoutError(
+                            "Reached timeout of %.1f seconds" % self.timeout) )
+        except IOError:
+            pass
+        finally:
+            self.sock.close()
 
-                    elif helper.isCmdUpdate(cmd):   # UPDATE
-                        self._handleUpdate(body)
+    # Answers the first command and the ones already received, all of them
+    # until the client quits if there is no 'sessions'. Returns False if the
+    # connection ends.
+    def _handleCommands(self):
+        reader = self.reader
+        wait = True
 
-                    else:
-                        logging.info("Unknown command from %s:%d" % self.addr)
-                        self.sock.sendall(
-                                helper.getUnknownCmdError(
-                                "Unknown command: %s" % data)
-                            )           
+        while wait or reader.hasPendingData():
+            wait = self.sessions is None
+            data = reader.recvEnd('\n')
+            # Connection closed
+            if not data: return False
 
-        except socket.timeout:
-            logging.debug("Socket TIMEOUT %s:%d" % self.addr)
-            sock.sendall( helper.getTimeoutError(
-                            "Reached timeout of %.1f seconds" % self.timeout) 
-                        )
-        except IOError:
-            logging.warning("Error sending data to %s:%d" % self.addr)
-        finally:
-            sock.close()
-            logging.debug("Command handler closed socket to %s:%s" % self.addr)
-            CommandHandler._unregisterThread(CommandHandler, self)
+            msg = self.processor.process(data)
+            if msg is None: return False            # QUIT
+
+            if isinstance(msg, str):
+                self.sock.sendall(msg)
+            else:
+                common.sendAllChunks(self.sock, msg)
+
+        return True
+
+#
+#
+class CommandProcessor(object):
+    """Executes the commands received from a client and builds the responses.
+
+    The processor does not own the client socket, it is shared by the
+    threaded handlers and the event loop engine (srvevents).
+
+    """
+
+    def __init__(self, addr, m_sock, mg_ip, mg_port, timeout):
+        self.addr = addr
+        self.m_sock = m_sock
+        self.mg_ip = mg_ip
+        self.mg_port = mg_port
+        self.timeout = timeout
+
+    def process(self, data):
+        """process(data: str) -> str | iterator of str
+
+        Executes the command in data and returns the response message. Returns
+        None if the command asks to close the connection.
+
+        Long responses are returned as an iterator of the blocks to send, they
+        are produced as they are sent and must not be joined.
+
+        """
+        data = data.strip()
+
+        if helper.isCmdQuit(data):          # QUIT
+            return None
+
+        elif helper.isCmdList(data):        # LIST
+            return self._sendMonitorsList()
+
+        elif helper.isCmdGetAll(data):      # GET ALL
+            return self._sendGetAll()
+
+        elif helper.isCmdUpdateAll(data):   # UPDATE ALL
+            return self._sendUpdateAll()
+
+        elif helper.isCmdFindProcess(data): # FIND PROCESS
+            return self._handleFindProcess(data.split(None, 2)[2:])
+
+        cmd, sep, body = data.partition(' ')
+        body = body.strip()
+
+        if helper.isCmdGet(cmd):            # GET
+            return self._handleGet(body)
+
+        elif helper.isCmdUpdate(cmd):       # UPDATE
+            return self._handleUpdate(body)
+
+        elif helper.isCmdHistory(cmd):      # HISTORY
+            return self._handleHistory(body)
+
+        elif helper.isCmdAgg(cmd):          # AGG
+            return self._handleAgg(body)
 
-    def _handleGet(self, mid):
+        elif helper.isCmdTop(cmd):          # TOP
+            return self._handleTop(body)
 
-        if srvdata.existsMonitorData(mid):
-            sinfodao, ip, port = srvdata.getMonitorData(mid)
-            xmlbuilder = common.SysInfoXMLBuilder()
-            xmlbuilder.setXMLData(sinfodao)
+        logging.info("Unknown command from %s:%d" % self.addr)
+        return helper.getUnknownCmdError("Unknown command: %s" % data)
 
-            data = "IP: %s\nPORT: %s\n%s" % (ip, port, xmlbuilder.getAsString())
+    ## Handles GET <mid> and GET <mid>|ALL [FIELDS <section>[,<section>...]]
+    ## [ZLIB], FIELDS only serializes the given sections of the XML and ZLIB
+    ## compresses the response
+    def _handleGet(self, body):
+        words = body.split()
+        compress = len(words) > 1 and helper.isCmdZlib(words[-1])
+        if compress:
+            body = body.rsplit(None, 1)[0]
 
-            msg = helper.getOkMessage('Data of %s' % mid, data)
-            self.sock.sendall( msg )
+        mid, sep, option = body.partition(' ')
+        opt, sep, fields = option.strip().partition(' ')
+        sections = None
+
+        if helper.isCmdFields(opt):
+            try:
+                sections = _parseSections(fields)
+            except ValueError, e:
+                return helper.getUnknownCmdError(str(e))
+        else:
+            mid = body
+
+        if helper.isCmdGetAll('%s %s' % (gdata.CMD_GET, mid)):
+            return self._sendGetAll(sections, compress)
+
+        if srvcluster.existsMonitorData(mid):
+            xml, ip, port = srvcluster.getMonitorXML(mid, sections)
+
+            data = "IP: %s\nPORT: %s\n%s" % (ip, port, xml)
+
+            if compress:
+                return _compressResponse('Data of %s' % mid, [data])
+            return helper.getOkMessage('Data of %s' % mid, data)
         else:
-            self.sock.sendall( 
-                helper.getMonitorNotFoundError(
+            return helper.getMonitorNotFoundError(
+                    "Monitor %s is not registered" % mid)
+
+    ## Returns the metrics history of a monitor as a table, a line with the
+    ## name of the columns followed by a line per sample
+    def _handleHistory(self, body):
+        mid, sep, seconds = body.partition(' ')
+
+        try:
+            seconds = float(seconds) if seconds.strip() else None
+        except ValueError:
+            return helper.getUnknownCmdError(
+                            "Bad formatted parameters: %s" % body)
+
+        if not srvcluster.existsMonitorData(mid):
+            return helper.getMonitorNotFoundError(
                     "Monitor %s is not registered" % mid)
-                )
+
+        ncpus, samples = srvcluster.getMonitorHistory(mid, seconds)
+
+        columns = srvhistory.MetricsHistory.FIELDS + \
+                    tuple('cpu%d' % i for i in xrange(ncpus))
+        lines = [ ' '.join(columns) ]
+
+        for values, cpu_usage in samples:
+            lines.append( "%.3f %s %s %s" % (values[0],
+                            ' '.join(map(str, values[1:4])),
+                            ' '.join('%d' % v for v in values[4:]),
+                            ' '.join(map(str, cpu_usage))) )
+
+        return helper.getOkMessage('History of %s' % mid, '\n'.join(lines))
+
+    ## Returns an aggregate of a metric of all the monitors, a line with its
+    ## value and the number of monitors aggregated
+    def _handleAgg(self, body):
+        params = body.lower().split()
+        if len(params) != 2:
+            return helper.getUnknownCmdError(
+                            "Bad formatted parameters: %s" % body)
+
+        metric, func = params
+        try:
+            value, count = srvcluster.aggregateMonitorsData(metric, func)
+        except ValueError, e:
+            return helper.getUnknownCmdError(str(e))
+
+        value = '%.3f' % value if value is not None else '-'
+        return helper.getOkMessage('Aggregate %s of %s' % (func, metric),
+                                    '%s %d' % (value, count))
+
+    ## Returns the monitors with the highest values of a metric, a line with
+    ## the id, ip, port and value of each one
+    def _handleTop(self, body):
+        params = body.lower().split()
+        try:
+            n, metric = int(params[0]), params[1]
+            if n < 0 or len(params) != 2:
+                raise ValueError()
+        except (ValueError, IndexError):
+            return helper.getUnknownCmdError(
+                            "Bad formatted parameters: %s" % body)
+
+        try:
+            topl = srvcluster.getTopMonitors(metric, n)
+        except ValueError, e:
+            return helper.getUnknownCmdError(str(e))
+
+        lines = [ "%s %s %s %.3f" % mtop for mtop in topl ]
+        return helper.getOkMessage('Top %d by %s' % (n, metric),
+                                    '\n'.join(lines))
+
+    ## Returns the monitors running a process, a line with the id, ip, port
+    ## and pids (separated by commas) of each one
+    def _handleFindProcess(self, params):
+        if not params:
+            return helper.getUnknownCmdError("Expected a process name")
+
+        name = params[0].strip()
+        lines = [ "%s %s %s %s" % (mid, ip, port, ','.join(map(str, pids)))
+                    for mid, ip, port, pids in srvcluster.findProcess(name) ]
+
+        return helper.getOkMessage('Monitors running %s' % name,
+                                    '\n'.join(lines))
 
     ## Checks if the given monitor id exists and then tries to send the update
     ## message to the monitor
     def _handleUpdate(self, mid):
-        if srvdata.existsMonitorData(mid):
-            sinfodao, ip, port = srvdata.getMonitorData(mid)
-            srvdata.keepAliveMonitor(mid)
+        if srvcluster.existsMonitorData(mid):
+            ip, port = srvcluster.getMonitorAddress(mid)
+            srvcluster.keepAliveMonitor(mid)
 
-            s = None
             try:
-                self._sendUpdateToMonitor(ip, port)
+                return self._sendUpdateToMonitor(ip, port)
 
-            except socket.error:
-                logging.debug("Error updating %s:%s" % (ip, port))
-                self.sock.sendall(
-                        helper.getMonitorUnreachableError(
-                            "Error connecting to %s:%s" % (ip, port)
-                        )
-                    )
             except socket.timeout:
                 logging.debug("Timeout updating %s:%s" % (ip, port))
-                self.sock.sendall(
-                        helper.getMonitorUnreachableError(
-                            "Error connecting to %s:%s [Timeout]" % (ip, port)
-                        )
-                    )
-            finally:
-                if s: s.close()
+                return helper.getMonitorUnreachableError(
+                            "Error connecting to %s:%s [Timeout]" % (ip, port))
+            except socket.error:
+                logging.debug("Error updating %s:%s" % (ip, port))
+                return helper.getMonitorUnreachableError(
+                            "Error connecting to %s:%s" % (ip, port))
         else:
-            self.sock.sendall(
-                        helper.getMonitorNotFoundError(
+            return helper.getMonitorNotFoundError(
                             "Monitor %s does not exists" % mid)
-                    )
 
     ## Sends the update message to the specified ip and port, waits for the
-    ## response and propagate the response to the applicant
+    ## response and returns the response for the applicant
     def _sendUpdateToMonitor(self, ip, port):
         # Send Update to monitor and get response
         s = socket.create_connection( (ip, port), self.timeout )
-        s.sendall("%s\n" % gdata.CMD_UPDATE)
+        try:
+            s.sendall("%s\n" % gdata.CMD_UPDATE)
+            ret = common.SocketReader(s).recvEnd('\n').strip()
+        finally:
+            s.close()
 
-        ret = common.recvEnd(s, '\n').strip()
         code, sep, desc = ret.partition(' ')
 
-        # Send result to client
-        msg = None
+        # Result for the client
         if code == gdata.K_OK:
-            msg = helper.getOkMessage(desc)
+            return helper.getOkMessage(desc)
         else:
-            msg = helper.getGenericError("Received error: %s" % ret)
-
-        self.sock.sendall(msg)
-
-    ## Generates and sends the response to the message get all
-    def _sendGetAll(self):
-        mlist = srvdata.getAllMonitorsData()
-        xmlbuilder = common.SysInfoXMLBuilder()
-
-        data = []
-        for sinfodao, ip, port in mlist:
-            xmlbuilder.setXMLData(sinfodao)
-            data.append("IP: %s\nPORT: %s\n%s"
-                        % (ip, port, xmlbuilder.getAsString()) )
-
-        strdata = '\n'.join(data)
-        msg = helper.getOkMessage('Here goes the data', strdata)
-        self.sock.sendall( msg )
+            return helper.getGenericError("Received error: %s" % ret)
+
+    ## Generates the response to the message get all, streamed from the
+    ## cached XML of the monitors
+    def _sendGetAll(self, sections=None, compress=False):
+        mlist = srvcluster.getAllMonitorsXML(sections)
+
+        if compress:
+            return _compressResponse('Here goes the data',
+                                        self._streamGetAll(mlist))
+        elif not mlist:
+            return helper.getOkMessage('Here goes the data')
+
+        return common.joinChunks(itertools.chain(
+                    [ helper.getOkMessageHead('Here goes the data') ],
+                    self._streamGetAll(mlist), [ '\n\n' ]))
+
+    def _streamGetAll(self, mlist):
+        sep = ''
+        for xml, ip, port in mlist:
+            yield "%sIP: %s\nPORT: %s\n" % (sep, ip, port)
+            yield xml
+            sep = '\n'
 
     ## Sends the update message throug the multicast channel
     def _sendUpdateAll(self):
@@ -313,18 +607,394 @@ class CommandHandler(ThreadWithRegister):
         snt = self.m_sock.sendto(msg, (self.mg_ip, self.mg_port) )
 
         if snt == len(msg):
-            self.sock.sendall( helper.getOkMessage('Update all sent') )
+            return helper.getOkMessage('Update all sent')
         else:
-            self.sock.sendall( helper.getGenericError(
-                                'Error sending to Multicast group'))
+            return helper.getGenericError('Error sending to Multicast group')
 
-    ## Generates and sends a list with all the monitors id's
+    ## Generates a list with all the monitors id's
     def _sendMonitorsList(self):
-        mlist = srvdata.getListOfMonitors()
+        mlist = srvcluster.getListOfMonitors()
         strlist = '\n'.join(mlist)
-        msg = helper.getOkMessage('Here goes the list', strlist)
-        self.sock.sendall( msg )
+        return helper.getOkMessage('Here goes the list', strlist)
+
+#
+#
+class IdleSessions(object):
+    """Monitor sessions (or command connections) waiting for their next
+    update.
+
+    Workers hand the sessions over with park() once they have served the
+    received updates. The server loop watches the parked sockets with its
+    Poller and takes a session back with resume() when new data arrives, so
+    an idle session does not hold a worker thread.
+
+    Only park() may be called from other threads than the server loop.
+
+    """
+
+    def __init__(self, poller, timeout):
+        self.poller = poller
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._parked = []       # Handed over by the workers
+        self._idle = {}         # fileno -> (handler, deadline)
+        self._wake_r, self._wake_w = common.createWakeUpPair()
+        self._wake_r.setblocking(0)
+
+    def fileno(self):
+        """fileno() -> int
+
+        Returns the descriptor to watch for parked sessions, collect() must be
+        called when it is readable.
+
+        """
+        return self._wake_r.fileno()
+
+    def park(self, handler):
+        """park(handler: MonitorHandler | CommandHandler) -> void
+
+        Hands over a session waiting for its next update.
+
+        """
+        self._lock.acquire()
+        self._parked.append(handler)
+        self._lock.release()
+
+        try:
+            self._wake_w.send('x')
+        except socket.error:
+            pass    # The loop is already awake
+
+    def collect(self):
+        """collect() -> void
+
+        Starts watching the sessions parked since the last call.
+
+        """
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+        self._lock.acquire()
+        parked = self._parked
+        self._parked = []
+        self._lock.release()
+
+        deadline = time.time() + self.timeout
+        for handler in parked:
+            fd = handler.sock.fileno()
+            self._idle[fd] = (handler, deadline)
+            self.poller.register(fd)
+
+    def resume(self, fd):
+        """resume(fd: int) -> MonitorHandler | CommandHandler
+
+        Stops watching the session of the descriptor fd and returns its
+        handler, or None if fd is not an idle session.
+
+        """
+        handler, deadline = self._idle.pop(fd, (None, None))
+        if handler:
+            self.poller.unregister(fd)
+        return handler
+
+    def expire(self):
+        """expire() -> void
+
+        Closes the sessions that have been idle for longer than the timeout.
+
+        """
+        now = time.time()
+        for fd, (handler, deadline) in self._idle.items():
+            if deadline < now:
+                self.resume(fd).expire()
+
+    def closeAll(self):
+        """closeAll() -> void
+
+        Closes all the idle sessions.
+
+        """
+        self.collect()
+        for fd in self._idle.keys():
+            self.resume(fd).sock.close()
+
+        self._wake_r.close()
+        self._wake_w.close()
+
+# Functions
+# ---------
+
+def rejectBusy(sock):
+    """rejectBusy(sock: socket) -> void
+
+    Answers a connection that can't be served because the workers queue is
+    full with a busy error and closes it. Never blocks.
+
+    """
+    try:
+        sock.setblocking(0)
+        sock.send( helper.getBusyError("Server busy, try again later") )
+        sock.shutdown(socket.SHUT_WR)
+
+        # Discard the request already received, closing a socket with unread
+        # data resets the connection and the client could lose the error
+        while sock.recv(common.sockutil.DEF_RECV_BUFFER_SIZE):
+            pass
+    except socket.error:
+        pass
+    finally:
+        sock.close()
+
+# Ok response with its data compressed, streamed in blocks preceded by their
+# size (see common.compressChunks())
+def _compressResponse(desc, parts):
+    return itertools.chain([ helper.getOkMessageHead(desc) ],
+                            common.compressChunks(common.joinChunks(parts)))
+
+# Sections of the XML given to the FIELDS option, in document order
+def _parseSections(fields):
+    names = set(f.strip().lower() for f in fields.split(',') if f.strip())
+    unknown = names - set(common.sysinfoxml.section_names)
+
+    if not names:
+        raise ValueError("Expected the fields: %s" %
+                            ','.join(common.sysinfoxml.section_names))
+    elif unknown:
+        raise ValueError("Unknown fields: %s" % ','.join(sorted(unknown)))
+
+    return tuple(s for s in common.sysinfoxml.section_names if s in names)
 
-    @staticmethod
-    def waitAll():
-        CommandHandler._waitAll(CommandHandler)
+def splitMonitorHead(data):
+    """splitMonitorHead(data: str) -> str, str
+
+    Splits the first frame of a monitor message in its head (BEL, SOH) and
+    its body (listen port, monitor id).
+
+    """
+    head, sep, body = data.partition(' ')
+    return head.strip(), body.strip()
+
+def openMonitorSession(mid):
+    """openMonitorSession(mid: str) -> str, bool
+
+    Opens a session for the monitor mid, returns the response for the monitor
+    and whether the session has been opened.
+
+    """
+    if srvdata.existsMonitorData(mid):
+        srvdata.keepAliveMonitor(mid)
+        logging.debug("Session opened for %s" % mid)
+        return helper.getOkMessage("Session opened"), True
+
+    return helper.getMonitorNotFoundError(
+                "There isn't any monitor with id: %s" % mid), False
+
+def openRelaySession(name):
+    """openRelaySession(name: str) -> str, set
+
+    Opens a relay session for the child broker name, returns the response
+    for the child and the set to hold its monitors, None if it is rejected.
+
+    """
+    if srvcluster.workers > 1:
+        return helper.getGenericError(
+                    "Relays need a broker with a single process"), None
+
+    logging.info("Relay session opened for %s" % name)
+    return helper.getOkMessage("Relay opened"), set()
+
+def parseBatchBody(body):
+    """parseBatchBody(body: str) -> int
+
+    Returns the size of the payload of a relayed batch from the body of its
+    head ('<records> <size>').
+
+    Raises ValueError if the body is malformed.
+
+    """
+    try:
+        records, size = map(int, body.split())
+    except ValueError:
+        raise ValueError("Malformed batch head '%s'" % body)
+
+    if size < 0:
+        raise ValueError("Negative payload size (%d)" % size)
+    return size
+
+def processRelayBatch(mids, payload):
+    """processRelayBatch(mids: set, payload: str) -> str
+
+    Applies a compressed batch of a relay session with the monitors mids
+    and returns the response for the child broker.
+
+    """
+    opt = gdata.getCommandLineOptions()
+    try:
+        srvrelay.applyBatch(mids, _inflate(payload), opt.history_size)
+    except (AttributeError, ValueError), e:
+        return helper.getGenericError(str(e))
+
+    return helper.getOkMessage("Batch applied")
+
+def isMonitorHead(head):
+    """isMonitorHead(head: str) -> bool
+
+    Tests if head starts a message of the monitors protocol.
+
+    """
+    return helper.isBEL(head) or helper.isSOH(head)
+
+def parseMonitorBody(head, body):
+    """parseMonitorBody(head: str, body: str) -> str, str, int
+
+    Splits the body of a monitor message head in its argument (listen port,
+    monitor id), the encoding of the payload and the payload size.
+
+    A BEL body may list the encodings and options offered by the monitor after
+    the port ('6667 bin,delta'), they are returned in place of the encoding
+    because the payload of a BEL is always XML. A SOH body carries the
+    encoding and the size when the payload is not plain XML ('<mid> bin 1234',
+    '<mid> bin+zlib 567'). The size is None for the payloads delimited by ETX.
+
+    Raises ValueError if the body is malformed.
+
+    """
+    fields = body.split()
+    arg = fields[0] if fields else ''
+
+    if helper.isBEL(head):
+        return arg, ','.join(fields[1:]), None
+
+    if len(fields) == 3:
+        size = int(fields[2])
+        if size < 0:
+            raise ValueError("Negative payload size (%d)" % size)
+        return arg, fields[1], size
+
+    if len(fields) > 1:
+        raise ValueError("Malformed message head '%s'" % body)
+
+    return arg, gdata.FMT_XML, None
+
+def decodeSysInfo(fmt, payload):
+    """decodeSysInfo(fmt: str, payload: str) -> SysInfoDAO
+
+    Decodes the payload of a monitor message encoded with fmt, decompressing
+    it first if fmt is '<format>+zlib'.
+
+    Raises AttributeError if the payload can't be decoded.
+
+    """
+    fmt, sep, compression = fmt.partition('+')
+    if compression == gdata.OPT_ZLIB:
+        payload = _inflate(payload)
+    elif compression:
+        raise AttributeError("Unknown update compression: %s" % compression)
+
+    if fmt == gdata.FMT_BIN:
+        parser = common.SysInfoBinParser()
+        parser.parseBin(payload)
+    elif fmt == gdata.FMT_XML:
+        parser = common.SysInfoXMLParser()
+        parser.parseXML(payload.strip())
+    else:
+        raise AttributeError("Unknown update format: %s" % fmt)
+
+    return parser.getSysInfoData()
+
+def processMonitorMessage(addr, head, body, payload):
+    """processMonitorMessage(addr: (str, int), head: str, body: str, 
+                             payload: str) -> str
+
+    Executes a monitor message (new monitor or data update) received from addr
+    and returns the response to send back to the monitor.
+
+    """
+    msgs = []
+    try:
+        arg, fmt, size = parseMonitorBody(head, body)
+
+        if helper.isBEL(head):      # New monitor
+            mid = _newMonitor(addr, arg, fmt, msgs)
+            _updateMonitor(mid, payload, gdata.FMT_XML, msgs)
+        elif helper.isSOH(head):    # Monitor data update
+            _updateMonitor(arg, payload, fmt, msgs)
+        else:
+            msgs.append( helper.getBadMessageError("Wrong message") )
+
+    except AttributeError, e:
+        msgs.append( helper.getGenericError(str(e)) )
+    except ValueError, e:
+        msgs.append( helper.getGenericError(str(e)) )
+
+    return ''.join(msgs)
+
+def _newMonitor(addr, port, offers, msgs):
+
+    iport = int(port)
+    if iport < gdata.SOCK_MIN_PORT or iport > gdata.SOCK_MAX_PORT:
+        raise ValueError("Port value (%d) out of range [%d-%d]" 
+            % (iport, gdata.SOCK_MIN_PORT, gdata.SOCK_MAX_PORT))
+
+    opt = gdata.getCommandLineOptions()
+    mid = srvdata.initializeNewMonitorData(addr[0], port, opt.history_size)
+
+    data = "%s %s %d" % (mid, opt.multicast_group, opt.multicast_group_port)
+
+    # Only the monitors offering encodings expect the accepted one, followed
+    # by the accepted options
+    if offers:
+        fmt = _chooseUpdateFormat(offers)
+        options = [ o for o in gdata.UPDATE_OPTIONS if o in offers.split(',') ]
+        data = ' '.join([data, fmt] + options)
+        logging.debug("Monitor %s sends %s updates %s" % (mid, fmt,
+                                                        ','.join(options)))
+
+    msgs.append( helper.getOkMessage("", data) )
+
+    return mid
+
+# First of the encodings offered by a monitor supported by the broker
+def _chooseUpdateFormat(offers):
+    for fmt in offers.split(','):
+        if fmt in gdata.UPDATE_FORMATS:
+            return fmt
+
+    return gdata.FMT_XML
+
+# Decompresses a zlib payload, bounding its decompressed size
+def _inflate(payload):
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, MAX_INFLATED_SIZE)
+    except zlib.error, e:
+        raise AttributeError("Corrupted compressed payload: %s" % str(e))
+
+    if decompressor.unconsumed_tail:
+        raise AttributeError("Decompressed payload bigger than %d bytes"
+                                % MAX_INFLATED_SIZE)
+    return data
+
+def _updateMonitor(mid, payload, fmt, msgs):
+    
+    if srvdata.existsMonitorData(mid):
+        srvdata.keepAliveMonitor(mid)
+
+        infodao = decodeSysInfo(fmt, payload)
+        if srvdata.updateMonitorData(mid, infodao):
+            msgs.append( helper.getOkMessage("Update successful") )
+            logging.debug("Update %s successful" % mid)
+        else:
+            msgs.append( helper.getResyncError(
+                            "Update %d does not follow the stored data"
+                            % infodao.getSequence()) )
+            logging.debug("Update %s needs resync" % mid)
+    else:
+        msgs.append(
+            helper.getMonitorNotFoundError(
+                "There isn't any monitor with id: %s" % mid)
+            )
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Imports
+# -------
+
+import array
+
+
+# Classes
+# -------
+
+class MetricsHistory(object):
+    """Fixed capacity ring buffer with the numeric metrics of the last samples
+    of a monitor, the oldest sample is overwritten when it is full.
+
+    The values are stored in flat arrays of doubles, one row of FIELDS per
+    sample plus one row with the usage of every CPU.
+
+    Not thread safe, the monitor data lock must be held to use it.
+
+    """
+
+    FIELDS = ('time', 'load1', 'load5', 'load15', 'ram_total', 'ram_used',
+                'ram_free', 'ram_avaliable', 'swap_total', 'swap_used',
+                'swap_free')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+        self._ncpus = 0
+        self._values = array.array('d', [0.0]) * (capacity * len(self.FIELDS))
+        self._cpus = array.array('d')
+        self._next = 0      # Slot of the next sample
+        self._count = 0     # Number of stored samples
+
+    def append(self, stamp, sinfodao):
+        """append(stamp: float, sinfodao: SysInfoDAO) -> void
+
+        Stores the metrics of sinfodao received at time stamp, stamps must be
+        appended in increasing order.
+
+        """
+        nfields = len(self.FIELDS)
+        cpu_usage = sinfodao.getUsedCPUPercentage()
+
+        # A different number of CPUs invalidates the previous samples
+        if len(cpu_usage) != self._ncpus:
+            self._ncpus = len(cpu_usage)
+            self._cpus = array.array('d', [0.0]) * (self.capacity * self._ncpus)
+            self._count = 0
+
+        row = ( (stamp,) + tuple(sinfodao.getCPULoadAvg()) +
+                sinfodao.getVirtualMemory() + sinfodao.getSwapMemory() )
+
+        slot = self._next
+        self._values[slot * nfields:(slot + 1) * nfields] = \
+                                                    array.array('d', row)
+        self._cpus[slot * self._ncpus:(slot + 1) * self._ncpus] = \
+                                                    array.array('d', cpu_usage)
+
+        self._next = (slot + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def getSamples(self, since=None):
+        """getSamples(since: float) -> int, [ (tuple, tuple) ]
+
+        Returns the number of CPUs and the samples appended at time 'since'
+        or later (all of them if None), the oldest first.
+
+        Every sample is a tuple with the values of FIELDS and a tuple with the
+        usage of every CPU.
+
+        """
+        nfields = len(self.FIELDS)
+        ncpus = self._ncpus
+
+        # Samples are sorted by time, binary search of the first one
+        lo, hi = 0, self._count
+        if since is not None:
+            while lo < hi:
+                half = (lo + hi) / 2
+                if self._values[self._slot(half) * nfields] < since:
+                    lo = half + 1
+                else:
+                    hi = half
+
+        samples = []
+        for i in xrange(lo, self._count):
+            slot = self._slot(i)
+            samples.append(
+                ( tuple(self._values[slot * nfields:(slot + 1) * nfields]),
+                  tuple(self._cpus[slot * ncpus:(slot + 1) * ncpus]) ) )
+
+        return ncpus, samples
+
+    def __len__(self):
+        return self._count
+
+    # Slot of the i-th stored sample, the oldest is 0
+    def _slot(self, i):
+        return (self._next - self._count + i) % self.capacity
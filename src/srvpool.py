@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# Imports
+# -------
+
+import Queue
+import logging
+import threading
+
+
+# Classes
+# -------
+
+class WorkerPool(object):
+    """Fixed set of threads executing the jobs submitted to a shared queue.
+
+    A queue_size of 0 means that the queue of pending jobs is unbounded.
+
+    """
+
+    def __init__(self, size, queue_size=0):
+        self._jobs = Queue.Queue(queue_size)
+        self._workers = [ threading.Thread(target=self._work)
+                            for i in xrange(size) ]
+
+    def start(self):
+        """start() -> void
+
+        Starts the worker threads.
+
+        """
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, func, *args):
+        """submit(func: callable, *args) -> void
+
+        Queues the call func(*args) to be executed by a worker thread.
+
+        Raises Queue.Full if the queue of pending jobs is full.
+
+        """
+        self._jobs.put_nowait( (func, args) )
+
+    def stop(self):
+        """stop() -> void
+
+        Waits until the already submitted jobs are done and stops the workers.
+
+        """
+        for worker in self._workers:
+            self._jobs.put(None)
+
+        for worker in self._workers:
+            worker.join()
+
+    def size(self):
+        """size() -> int
+
+        Returns the number of worker threads.
+
+        """
+        return len(self._workers)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+
+            func, args = job
+            try:
+                func(*args)
+            except Exception, e:
+                logging.error("Unhandled exception in worker thread: %s"
+                                % str(e))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""srvprocs.py - Inverted index of the processes running in the monitors
+
+Maps every process name to the monitors running it and their pids. It is
+maintained with the processes started and finished since the previous
+update of every monitor, so an update costs in proportion to its changes
+and a search in proportion to its results.
+
+"""
+
+# Imports
+# -------
+
+import threading
+
+
+# Classes
+# -------
+
+class ProcessIndex(object):
+    """Process name -> { monitor id -> set of pids }
+
+    The entries of every monitor belong to an owner (its registration in the
+    DB), changes from other owners replace them and removals from other
+    owners are ignored.
+
+    Thread safe.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}            # name -> { mid -> set(pid) }
+        self._monitors = {}         # mid -> (owner, indexed processes)
+
+    def update(self, mid, owner, running, started, finished):
+        """update(mid: str, owner: object, running: frozenset,
+                    started: frozenset, finished: frozenset) -> void
+
+        Applies the processes (pid, name) started and finished by a monitor
+        since its previous update, running are all of its processes after
+        them.
+
+        """
+        self._lock.acquire()
+        try:
+            indexed = self._monitors.get(mid)
+            if indexed is not None and indexed[0] is not owner:
+                self._unindex(mid, indexed[1])
+                indexed = None
+            if indexed is None:
+                started, finished = running, ()
+
+            for pid, name in finished:
+                self._discard(name, mid, pid)
+
+            for pid, name in started:
+                mids = self._names.setdefault(name, {})
+                mids.setdefault(mid, set()).add(pid)
+
+            self._monitors[mid] = (owner, running)
+        finally:
+            self._lock.release()
+
+    def remove(self, mid, owner):
+        """remove(mid: str, owner: object) -> void
+
+        Drops all the processes of a monitor, if they belong to owner.
+
+        """
+        self._lock.acquire()
+        try:
+            indexed = self._monitors.get(mid)
+            if indexed is not None and indexed[0] is owner:
+                del self._monitors[mid]
+                self._unindex(mid, indexed[1])
+        finally:
+            self._lock.release()
+
+    def find(self, name):
+        """find(name: str) -> [ (str, [int]) ]
+
+        Returns the monitors running a process called name with its pids.
+
+        """
+        self._lock.acquire()
+        try:
+            return [ (mid, sorted(pids))
+                        for mid, pids in self._names.get(name, {}).iteritems() ]
+        finally:
+            self._lock.release()
+
+    # Removes a process of a monitor from the index
+    def _discard(self, name, mid, pid):
+        mids = self._names.get(name)
+        if mids is None or mid not in mids:
+            return
+
+        pids = mids[mid]
+        pids.discard(pid)
+        if not pids:
+            del mids[mid]
+            if not mids:
+                del self._names[name]
+
+    # Removes all the given processes of a monitor from the index
+    def _unindex(self, mid, processes):
+        for pid, name in processes:
+            self._discard(name, mid, pid)
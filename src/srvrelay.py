@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""srvrelay.py - Relay of the monitors of a child broker to its upstream
+
+A broker started with an upstream broker becomes its child: it serves its
+monitors as usual and a RelayForwarder sends their parsed data to the
+upstream through one persistent connection (a relay session), so the
+upstream answers the commands for the whole tree of brokers.
+
+Relay session, on the monitors port of the upstream:
+
+    DC2 <name> ETX                          opens it, answered with OK
+    ETB <records> <size> ETX <batch> ETX    every interval, answered with OK
+
+The batch is a zlib compressed sequence of srvsnapshot records, the monitors
+updated and removed since the previous batch (all of them in the first one
+of a session). An empty batch keeps the session and its monitors alive: the
+upstream refreshes all the monitors of a relay with every batch, and they
+expire as usual when the relay stops.
+
+"""
+
+# Imports
+# -------
+
+import zlib
+import gdata
+import socket
+import struct
+import common
+import logging
+import srvdata
+import threading
+import srvsnapshot
+
+# Data
+# ----
+
+# Maximum records of a batch, the changes of an interval are split in
+# several batches to bound their size
+MAX_BATCH_RECORDS = 1000
+
+# Functions
+# ---------
+
+def applyBatch(mids, data, history_size):
+    """applyBatch(mids: set, data: str, history_size: int) -> void
+
+    Applies the records of a batch (decompressed) to the monitors DB of the
+    upstream broker, mids are the monitors of the relay and it is updated
+    with the batch. Then all of them are kept alive. The records that can't
+    be applied are skipped, and logged.
+
+    """
+    for rtype, stamp, mid, ip, port, payload in srvsnapshot.iterRecords(data):
+        if rtype == srvsnapshot.REC_REMOVED:
+            srvdata.removeMonitorData(mid)
+            mids.discard(mid)
+            continue
+        elif rtype == srvsnapshot.REC_ALIVE:
+            continue                    # All of them are kept alive below
+
+        try:
+            parser = common.SysInfoBinParser()
+            parser.parseBin(payload)
+            sinfodao = parser.getSysInfoData()
+
+            if srvdata.existsMonitorData(mid):
+                srvdata.updateMonitorData(mid, sinfodao)
+            else:
+                srvdata.restoreMonitorData(mid, ip, port, sinfodao,
+                                            history_size)
+        except (AttributeError, ValueError, struct.error), e:
+            logging.warning("Discarded relayed record of %s: %s"
+                            % (mid, str(e)) )
+            continue
+        mids.add(mid)
+
+    for mid in list(mids):
+        if srvdata.existsMonitorData(mid):
+            srvdata.keepAliveMonitor(mid)
+        else:
+            mids.discard(mid)           # Dropped by the upstream
+
+# Classes
+# -------
+
+class RelayForwarder(threading.Thread):
+    """Sends the changes of the monitors DB to the upstream broker every
+    interval seconds. The session is opened again, resending all the
+    monitors, after any error.
+
+    """
+
+    def __init__(self, name, host, port, interval, timeout):
+        super(RelayForwarder, self).__init__()
+
+        self.name = name
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.timeout = timeout
+
+        self._sock = None
+        self._reader = None
+        self._written = { }     # mid -> (sinfodao, size, time) relayed
+        self._awakener = threading.Event()
+        self._active = True
+
+    ## Override
+    def run(self):
+        while self._active:
+            self.forward()
+            self._awakener.wait(self.interval)
+            self._awakener.clear()
+
+        self._close()
+
+    def stop(self):
+        """stop() -> void
+
+        Closes the relay session and waits until the forwarder thread ends.
+
+        """
+        self._active = False
+        self._awakener.set()
+        self.join()
+
+    def forward(self):
+        """forward() -> void
+
+        Sends a batch with the monitors updated and removed since the
+        previous one, opening a relay session first if there isn't any.
+
+        """
+        try:
+            if self._sock is None:
+                self._open()
+
+            records, written = srvsnapshot.encodeChanges(
+                                    srvdata.getAllMonitorsState(),
+                                    self._written)
+
+            for i in xrange(0, max(len(records), 1), MAX_BATCH_RECORDS):
+                self._sendBatch(records[i:i + MAX_BATCH_RECORDS])
+            self._written = written
+
+            if records:
+                logging.debug("Relayed %d records" % len(records))
+
+        except IOError, e:
+            logging.warning("Error relaying to %s:%d: %s"
+                            % (self.host, self.port, str(e)) )
+            self._close()
+        except Exception, e:
+            # Keeps relaying, the session is opened again resending all
+            logging.error("Relay to %s:%d failed: %s"
+                            % (self.host, self.port, str(e)) )
+            self._close()
+
+    def _open(self):
+        self._sock = socket.create_connection( (self.host, self.port),
+                                                self.timeout )
+        self._reader = common.SocketReader(self._sock)
+        self._written = { }
+
+        self._sock.sendall("%s %s%s" % (gdata.DC2, self.name, gdata.ETX))
+        self._readResponse()
+        logging.info("Relay session opened with %s:%d"
+                        % (self.host, self.port))
+
+    def _sendBatch(self, records):
+        batch = zlib.compress(''.join(records))
+        self._sock.sendall("%s %d %d%s%s%s" % (gdata.ETB, len(records),
+                                len(batch), gdata.ETX, batch, gdata.ETX))
+        self._readResponse()
+
+    # Raises IOError unless the upstream answers OK
+    def _readResponse(self):
+        line = self._reader.recvEnd('\n')
+        code, sep, desc = line.partition(' ')
+
+        if code != gdata.K_OK:
+            raise IOError("Answered '%s'" % line.strip())
+        self._reader.recvEnd('\n')      # Empty line after an OK
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = self._reader = None
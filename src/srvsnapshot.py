@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""srvsnapshot.py - Snapshot of the monitors DB on disk for warm restarts
+
+The snapshot is a log of records appended by a SnapshotWriter, only the
+monitors updated since its previous flush are written. When the dead
+records outgrow the live ones the file is compacted, rewritten whole in a
+temporary file that replaces it.
+
+Layout (version 2):
+
+    header      magic 'DRS', version
+    records     type, time of the last update, size of the id, ip, port and
+                data, followed by them. The data of a monitor is its last
+                SysInfoDAO encoded by SysInfoBinBuilder, a removed monitor
+                and a monitor only kept alive since its last record only have
+                id
+
+Version 1 files, without keep alive records, are read too.
+
+A truncated record at the end (the broker died while writing) is ignored.
+
+The records are also the batches relayed by a child broker (see srvrelay).
+
+"""
+
+# Imports
+# -------
+
+import os
+import time
+import struct
+import common
+import logging
+import srvdata
+import threading
+
+# Data
+# ----
+
+SNAPSHOT_MAGIC = 'DRS'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_READ_VERSIONS = (1, 2)
+
+REC_MONITOR = 1     # Data of a monitor, replaces the previous one
+REC_REMOVED = 2     # The monitor has been dropped
+REC_ALIVE = 3       # Only the time of the monitor, kept alive without updates
+
+# Minimum size of the file to compact it
+MIN_COMPACT_SIZE = 1 << 20
+
+_header = struct.Struct('!3sB')
+_record = struct.Struct('!BdHHHI')
+
+# Functions
+# ---------
+
+def loadSnapshot(path, data_life_time, history_size):
+    """loadSnapshot(path: str, data_life_time: float, history_size: int)
+        -> int
+
+    Restores into srvdata the monitors saved in the snapshot file path that
+    were alive when it was written for the last time. They get a new data life
+    time to reconnect to the broker.
+
+    Returns the number of restored monitors.
+
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return 0                # No snapshot yet
+
+    try:
+        data = f.read()
+        stopped = os.fstat(f.fileno()).st_mtime
+    finally:
+        f.close()
+
+    restored = 0
+    for mid, (stamp, ip, port, payload) in readRecords(data).iteritems():
+        if stamp < stopped - data_life_time:
+            continue
+
+        parser = common.SysInfoBinParser()
+        try:
+            parser.parseBin(payload)
+        except AttributeError, e:
+            logging.warning("Discarded snapshot of %s: %s" % (mid, str(e)))
+            continue
+
+        srvdata.restoreMonitorData(mid, ip, port, parser.getSysInfoData(),
+                                    history_size)
+        restored += 1
+
+    return restored
+
+def readRecords(data):
+    """readRecords(data: str) -> { str : (float, str, str, str) }
+
+    Replays the records of the snapshot data.
+
+    Returns the last (time, ip, port, encoded data) of every monitor not
+    removed by its id.
+
+    Raises ValueError if data is not a snapshot.
+
+    """
+    if len(data) < _header.size:
+        raise ValueError("Unknown snapshot format")
+    magic, version = _header.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC or version not in SNAPSHOT_READ_VERSIONS:
+        raise ValueError("Unknown snapshot format")
+
+    monitors = {}
+    for rtype, stamp, mid, ip, port, payload in \
+            iterRecords(data, _header.size):
+        if rtype == REC_REMOVED:
+            monitors.pop(mid, None)
+        elif rtype == REC_ALIVE:
+            if mid in monitors:
+                monitors[mid] = (stamp,) + monitors[mid][1:]
+        else:
+            monitors[mid] = (stamp, ip, port, payload)
+
+    return monitors
+
+def iterRecords(data, offset=0):
+    """iterRecords(data: str, offset: int)
+        -> iterator of (int, float, str, str, str, str)
+
+    Returns the type, time, id, ip, port and encoded data of the records in
+    data from offset, up to the end or a truncated record.
+
+    """
+    while offset + _record.size <= len(data):
+        rtype, stamp, lmid, lip, lport, lpayload = \
+                                        _record.unpack_from(data, offset)
+        end = offset + _record.size + lmid + lip + lport + lpayload
+        if end > len(data):
+            return              # Truncated
+
+        offset += _record.size
+        mid = data[offset:offset + lmid]
+        offset += lmid
+        ip = data[offset:offset + lip]
+        offset += lip
+        port = data[offset:offset + lport]
+
+        yield rtype, stamp, mid, ip, port, data[end - lpayload:end]
+        offset = end
+
+def encodeChanges(state, written, alive=False):
+    """encodeChanges(state: list, written: dict, alive: bool) -> [str], dict
+
+    Encodes the records of the monitors in state (see
+    srvdata.getAllMonitorsState()) with data changed since written, the dict
+    returned by the previous call, and of the monitors removed since then.
+    If alive, also the keep alive records of the monitors with the same data
+    and a later time.
+
+    The monitors whose data can't be encoded are left as in written, and
+    logged.
+
+    Returns the records and the dict of the monitors encoded after them.
+
+    """
+    records = []
+    encoded = {}
+
+    for mid, sinfodao, ip, port, stamp in state:
+        if sinfodao is None:
+            continue
+
+        last = written.get(mid)
+        if last and last[0] is sinfodao:
+            if alive and stamp > last[2]:
+                record = encodeAliveRecord(mid, stamp)
+                records.append(record)
+                last = (sinfodao, last[1], stamp)
+            encoded[mid] = last
+            continue
+
+        record = _encodeMonitor(mid, sinfodao, ip, port, stamp)
+        if record is None:
+            if last:
+                encoded[mid] = last     # Not removed, its last record stays
+            continue
+
+        records.append(record)
+        encoded[mid] = (sinfodao, len(record), stamp)
+
+    for mid in written:
+        if mid not in encoded:
+            records.append(encodeRecord(mid, stamp=time.time()))
+
+    return records, encoded
+
+def encodeRecord(mid, sinfodao=None, ip='', port='', stamp=0.0):
+    """encodeRecord(mid: str, sinfodao: SysInfoDAO, ip: str, port: str,
+                    stamp: float) -> str
+
+    Returns the record with the data of a monitor, or of its removal if
+    sinfodao is None.
+
+    Raises ValueError if a value of sinfodao is out of the range of the
+    binary encoding.
+
+    """
+    if sinfodao is None:
+        return _record.pack(REC_REMOVED, stamp, len(mid), 0, 0, 0) + mid
+
+    binbuilder = common.SysInfoBinBuilder()
+    try:
+        binbuilder.setBinData(sinfodao)
+    except struct.error, e:
+        raise ValueError("Data out of range: %s" % str(e))
+    payload = binbuilder.getAsString()
+
+    return ''.join( (_record.pack(REC_MONITOR, stamp, len(mid), len(ip),
+                                    len(port), len(payload)),
+                     mid, ip, port, payload) )
+
+# Record of a monitor, None if its data can't be encoded
+def _encodeMonitor(mid, sinfodao, ip, port, stamp):
+    try:
+        return encodeRecord(mid, sinfodao, ip, port, stamp)
+    except ValueError, e:
+        logging.warning("Can't encode the data of %s: %s" % (mid, str(e)))
+        return None
+
+def encodeAliveRecord(mid, stamp):
+    """encodeAliveRecord(mid: str, stamp: float) -> str
+
+    Returns the record of a monitor kept alive until stamp without updates.
+
+    """
+    return _record.pack(REC_ALIVE, stamp, len(mid), 0, 0, 0) + mid
+
+#
+## Appends the changes of the monitors DB to the snapshot file every interval
+## seconds. The first flush, and the one after a write error, compacts it
+class SnapshotWriter(threading.Thread):
+
+    def __init__(self, path, interval):
+        super(SnapshotWriter, self).__init__()
+
+        self.path = path
+        self.interval = interval
+
+        self._written = { }     # mid -> (sinfodao, size, time) last written
+        self._file_size = 0
+        self._broken = True     # Not compacted yet or a write failed
+        self._awakener = threading.Event()
+        self._active = True
+
+    ## Override
+    def run(self):
+        self.flush()
+
+        while self._active:
+            self._awakener.wait(self.interval)
+            self._awakener.clear()
+            self.flush()
+
+    def stop(self):
+        """stop() -> void
+
+        Writes the pending changes and waits until the writer thread ends.
+
+        """
+        self._active = False
+        self._awakener.set()
+        self.join()
+
+    def flush(self):
+        """flush() -> void
+
+        Appends the monitors updated and removed since the last flush, or
+        compacts the file if most of it would be dead records.
+
+        """
+        try:
+            self._flush(srvdata.getAllMonitorsState())
+        except (IOError, OSError), e:
+            self._broken = True     # May end with a partial record
+            logging.error("Error writing the snapshot %s: %s"
+                            % (self.path, str(e)) )
+
+    def _flush(self, state):
+        if self._broken:
+            self._compact(state)
+            return
+
+        records, written = encodeChanges(state, self._written, True)
+
+        size = sum(len(r) for r in records)
+        live_size = sum(s for sinfodao, s, stamp in written.itervalues())
+        if self._file_size + size > max(2 * live_size, MIN_COMPACT_SIZE):
+            self._compact(state)
+            return
+
+        if records:
+            self._write(records, 'ab')
+            self._file_size += size
+            logging.debug("Snapshot: %d records appended" % len(records))
+        self._written = written
+
+    def _compact(self, state):
+        records = [ _header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) ]
+        written = {}
+
+        for mid, sinfodao, ip, port, stamp in state:
+            record = None
+            if sinfodao is not None:
+                record = _encodeMonitor(mid, sinfodao, ip, port, stamp)
+            if record is not None:
+                records.append(record)
+                written[mid] = (sinfodao, len(record), stamp)
+
+        tmp = self.path + '.tmp'
+        self._write(records, 'wb', tmp)
+        os.rename(tmp, self.path)
+
+        self._written = written
+        self._file_size = sum(len(r) for r in records)
+        self._broken = False
+        logging.debug("Snapshot compacted: %d monitors, %d bytes"
+                        % (len(written), self._file_size))
+
+    def _write(self, records, mode, path=None):
+        f = open(path or self.path, mode)
+        try:
+            f.write(''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Updates of the fleet metrics and of their ordered indexes."""
+
+import os
+import sys
+import unittest
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_DIR)
+
+import common
+import srvfleet
+
+
+def _sysInfo(cpu):
+    dao = common.SysInfoDAO()
+    dao.setUsedCPUPercentage([cpu])
+    return dao
+
+
+class FleetMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fleet = srvfleet.FleetMetrics()
+
+    def test_non_finite_update_is_ignored(self):
+        self.fleet.update('a', _sysInfo(10.0))
+        self.fleet.update('b', _sysInfo(20.0))
+
+        for value in (float('nan'), float('inf'), float('-inf')):
+            self.fleet.update('a', _sysInfo(value))
+            self.assertEqual(self.fleet.top('cpu', 5),
+                                [('b', 20.0), ('a', 10.0)])
+
+        self.fleet.update('c', _sysInfo(float('nan')))
+        self.assertEqual(self.fleet.aggregate('cpu', 'count'), (2, 2))
+
+    def test_update_after_non_finite_moves_the_monitor(self):
+        self.fleet.update('a', _sysInfo(10.0))
+        self.fleet.update('a', _sysInfo(float('nan')))
+        self.fleet.update('a', _sysInfo(30.0))
+        self.fleet.remove('a')
+
+        self.assertEqual(self.fleet.top('cpu', 5), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
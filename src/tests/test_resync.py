@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Resync round trip of a monitor session with delta updates, against a
+broker running in a subprocess."""
+
+import os
+import sys
+import time
+import random
+import socket
+import unittest
+import threading
+import subprocess
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC_DIR)
+
+import cli
+import gdata
+import common
+
+
+# A free port in the range accepted by the broker for the monitors
+def _freePort():
+    while True:
+        port = random.randint(gdata.SOCK_MIN_PORT * 40, gdata.SOCK_MAX_PORT - 1)
+        sock = socket.socket()
+        try:
+            sock.bind( ('127.0.0.1', port) )
+            return port
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+def _waitPort(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection( ('127.0.0.1', port), 1.0 ).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise AssertionError("Broker not listening on %d" % port)
+
+
+class SessionResyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mon_port = _freePort()
+        self.cmd_port = _freePort()
+        self.devnull = open(os.devnull, 'w')
+        self.addCleanup(self.devnull.close)
+        self.broker = subprocess.Popen([sys.executable, 'srv.py',
+                                        '-mon-port', str(self.mon_port),
+                                        '-cmd-port', str(self.cmd_port)],
+                                        cwd=SRC_DIR, stdout=self.devnull,
+                                        stderr=self.devnull)
+        self.addCleanup(self._stopBroker)
+        _waitPort(self.mon_port)
+
+        self.sinfo = common.SysInfo()
+        self.sinfo.update()
+        client_id, group, mport, fmt, delta, compress = cli.beginConnection(
+                    '127.0.0.1', self.mon_port, _freePort(), self.sinfo, 3.0,
+                    gdata.FMT_BIN, True, True)
+        self.assertTrue(delta)
+
+        self.updater = cli.AutoUpdater(1.0, '127.0.0.1', self.mon_port,
+                                client_id, self.sinfo, threading.Event(),
+                                3.0, 1, True, fmt, delta, compress)
+
+    def tearDown(self):
+        self.updater.closeSession()
+
+    def _stopBroker(self):
+        self.broker.terminate()
+        self.broker.wait()
+
+    def _update(self):
+        sock, reader = self.updater.connect()
+        started = time.time()
+        self.updater.update(sock, reader, self.sinfo, self.updater.client_id)
+        self.assertTrue(time.time() - started < 2.0, "Response not read")
+
+    def test_resync_keeps_the_session(self):
+        self._update()
+        self.assertFalse(self.updater.resync)
+        session = self.updater.session
+        self.assertTrue(session)
+
+        # A missed update, the next delta does not follow the stored one
+        dao = self.sinfo.getSysInfoData()
+        dao.setSequence(dao.getSequence() + 5)
+
+        self._update()
+        self.assertTrue(self.updater.resync)
+        self.assertTrue(self.updater.awakener.is_set())
+        self.assertTrue(self.updater.session is session)
+
+        # The full update is accepted through the same session
+        self._update()
+        self.assertFalse(self.updater.resync)
+        self.assertTrue(self.updater.session is session)
+
+
+if __name__ == '__main__':
+    unittest.main()